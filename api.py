@@ -22,7 +22,12 @@ from fastapi import (
     Query,
     Body,
 )
-from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
+from fastapi.responses import (
+    FileResponse,
+    StreamingResponse,
+    JSONResponse,
+    PlainTextResponse,
+)
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware  # Import CORS middleware
@@ -47,6 +52,10 @@ import signal  # Import signal module
 
 # Import path resolution logic from run_augmentoolkit
 from resolve_path import resolve_path
+from augmentoolkit.generation_functions.request_metrics import (
+    METRICS_FILENAME,
+    render_openmetrics,
+)
 
 # Import helpers
 from file_operation_helpers import (
@@ -222,6 +231,35 @@ async def read_root():
     return {"message": "Augmentoolkit API is running."}
 
 
+@app.get("/metrics", summary="Request metrics of pipeline runs (OpenMetrics).")
+def get_request_metrics():
+    """
+    Per-engine, per-step request latency, time to first token, throughput and error counts of every task whose output directory has a request metrics summary, in OpenMetrics text format.
+    Pipelines run in worker processes, so this reads the summaries they write to their output directories rather than in-process counters.
+    """
+    summaries = []
+    task_output_keys = (
+        redis_client.scan_iter("output_dir_for_task:*") if redis_client else []
+    )
+    for redis_key in task_output_keys:
+        task_id = redis_key.split(":", 1)[1]
+        output_dir_str = redis_client.get(redis_key)
+        if not output_dir_str:
+            continue
+        metrics_path = PyPath(output_dir_str) / METRICS_FILENAME
+        if not metrics_path.is_file():
+            continue
+        try:
+            with open(metrics_path, "r", encoding="utf-8") as f:
+                summaries.append(({"task_id": task_id}, json.load(f)))
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Could not read request metrics for task {task_id}: {e}")
+    return PlainTextResponse(
+        render_openmetrics(summaries),
+        media_type="application/openmetrics-text; version=1.0.0; charset=utf-8",
+    )
+
+
 @app.post(
     "/pipelines/run",
     response_model=PipelineRunResponse,
@@ -0,0 +1,179 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from augmentoolkit.generation_functions.queue_time import queued
+from augmentoolkit.generation_functions.transport_retry import (
+    RETRYABLE_ERRORS,
+    classify_error,
+)
+
+# AIMD (additive increase, multiplicative decrease) concurrency window for one endpoint, the same scheme TCP uses for its congestion window.
+# A fixed concurrency_limit is either too low for a fast provider (throughput left on the table) or too high for a slow one (429s and timeouts that run_task_with_limit quietly turns into None). Instead, every EngineWrapper request takes a slot from its engine's limiter. Healthy responses grow the window by about one slot per window's worth of responses. A 429, a 5xx or a timeout halves it, and so does time-to-first-token climbing far above the best seen so far, which is the server queueing our requests (only streamed requests have a time-to-first-token; non-streamed ones only grow the window or halve it on errors). A decrease is applied at most once per cooldown, so a burst of failures from one overloaded window only counts once.
+
+DEFAULT_MAX_LIMIT_FACTOR = 4  # the window may grow to this multiple of concurrency_limit
+DECREASE_FACTOR = 0.5
+LATENCY_DECREASE_FACTOR = 0.9  # rising latency is an early warning, so it backs off more gently than an error does
+LATENCY_TOLERANCE = 3.0  # smoothed time-to-first-token above this multiple of the best smoothed value counts as congestion
+LATENCY_EWMA_ALPHA = 0.1
+DECREASE_COOLDOWN_SECONDS = 5.0
+
+
+def is_overload_error(error):
+    """True for the errors that mean "send less": rate limits, server errors, dropped connections and timeouts. Anything else (a bad request, a refused prompt) says nothing about load."""
+    return classify_error(error) in RETRYABLE_ERRORS
+
+
+class RequestTicket:
+    """Handed to the code holding a slot so it can report the first token and failures that do not raise (e.g. a stream that breaks off)."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_token_latency = None
+        self.streamed = True
+        self.error = None
+        self.cancelled = False
+
+    def first_token(self):
+        if self.first_token_latency is None:
+            self.first_token_latency = time.monotonic() - self.started
+
+    def whole_response(self):
+        # a non-streamed response arrives in one piece, so its "first token" time grows with the length of the output and says nothing about queueing
+        self.first_token()
+        self.streamed = False
+
+    def fail(self, error):
+        self.error = error
+
+
+class AdaptiveConcurrencyLimiter:
+    def __init__(
+        self,
+        initial_limit,
+        min_limit=1,
+        max_limit=None,
+        name="engine",
+        decrease_factor=DECREASE_FACTOR,
+        latency_tolerance=LATENCY_TOLERANCE,
+        decrease_cooldown=DECREASE_COOLDOWN_SECONDS,
+    ):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = (
+            max_limit
+            if max_limit is not None
+            else initial_limit * DEFAULT_MAX_LIMIT_FACTOR
+        )
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.decrease_cooldown = decrease_cooldown
+        self.in_flight = 0
+        self.latency_ewma = None
+        self.best_latency_ewma = None
+        self.last_decrease = 0.0
+        self.successes = 0
+        self.overloads = 0
+        self.other_errors = 0
+        self.condition = None  # created lazily, inside the event loop that uses it
+
+    @property
+    def current_limit(self):
+        return int(self.limit)
+
+    async def acquire(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            with queued():  # waiting for a slot does not count towards rtwl's timeout
+                while self.in_flight >= self.current_limit:
+                    await self.condition.wait()
+            self.in_flight += 1
+
+    async def release(self, ticket):
+        self.in_flight -= 1
+        error = ticket.error
+        if ticket.cancelled:
+            pass  # cut off by an outer timeout or a cancellation; says nothing reliable about the endpoint
+        elif error is None:
+            if not ticket.streamed:
+                self.record_success(None)
+            elif ticket.first_token_latency is not None:
+                self.record_success(ticket.first_token_latency)
+            else:
+                self.record_success(time.monotonic() - ticket.started)
+        elif is_overload_error(error):
+            self.overloads += 1
+            self.decrease(self.decrease_factor, f"{type(error).__name__}")
+        else:
+            self.other_errors += 1
+        async with self.condition:
+            self.condition.notify_all()  # a slot is free, and the window may have grown
+
+    def record_success(self, latency):
+        # latency is None when the request was not streamed: the window still grows, but there is no time-to-first-token to judge congestion by
+        self.successes += 1
+        if latency is None:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            return
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += LATENCY_EWMA_ALPHA * (latency - self.latency_ewma)
+        if self.best_latency_ewma is None or self.latency_ewma < self.best_latency_ewma:
+            self.best_latency_ewma = self.latency_ewma
+
+        if self.latency_ewma > self.best_latency_ewma * self.latency_tolerance:
+            self.decrease(LATENCY_DECREASE_FACTOR, "rising latency")
+        else:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+    def decrease(self, factor, reason):
+        now = time.monotonic()
+        if now - self.last_decrease < self.decrease_cooldown:
+            return
+        self.last_decrease = now
+        old_limit = self.current_limit
+        self.limit = max(float(self.min_limit), self.limit * factor)
+        if reason == "rising latency":
+            # judge the smaller window against the latency it actually gets, otherwise one slow phase would shrink it forever
+            self.best_latency_ewma = self.latency_ewma
+        if self.current_limit != old_limit:
+            print(
+                f"[Concurrency] {self.name}: window {old_limit} -> {self.current_limit} ({reason})"
+            )
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        ticket = RequestTicket()
+        try:
+            yield ticket
+        except asyncio.CancelledError:
+            ticket.cancelled = True
+            raise
+        except BaseException as e:
+            if ticket.error is None:
+                ticket.fail(e)
+            raise
+        finally:
+            await self.release(ticket)
+
+    def metrics(self):
+        return {
+            "name": self.name,
+            "current_limit": self.current_limit,
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "overloads": self.overloads,
+            "other_errors": self.other_errors,
+            "latency_ewma_seconds": self.latency_ewma,
+        }
+
+
+@asynccontextmanager
+async def unlimited_slot():
+    # what an EngineWrapper without a limiter uses, so the request code does not need two paths
+    yield RequestTicket()
@@ -0,0 +1,92 @@
+import asyncio
+
+import httpx
+from openai import AsyncOpenAI
+
+# One pooled HTTP client per (base_url, api_key, timeouts) for the whole process, shared by every EngineWrapper that talks to the same server.
+# Each AsyncOpenAI client otherwise brings its own connection pool, so every new EngineWrapper (the GRPO reward function used to build one per call) paid fresh TCP/TLS handshakes and left another pool of sockets open. At high concurrency that is both latency and file descriptors.
+# httpx connections belong to the event loop that opened them, so clients are also keyed by the running loop; a pipeline that runs several asyncio.run()s in one process gets a fresh pool for each instead of reusing dead connections.
+# Call close_clients() at the end of the coroutine you pass to asyncio.run() (run_augmentoolkit.py does this for every async pipeline) so the loop's pools are closed while it is still running. Clients of a loop that was closed without that are closed, as far as that is still possible, when the next client is created.
+# HTTP/2 is used when the optional h2 package is installed (pip install httpx[http2]); it only kicks in for https servers that offer it, plain http stays on HTTP/1.1 keep-alive.
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+MAX_CONNECTIONS = 1000  # per client, i.e. per server; the concurrency limiters keep the real number of requests in flight well below this
+MAX_KEEPALIVE_CONNECTIONS = 200
+KEEPALIVE_EXPIRY = 60.0  # seconds an idle connection is kept around for the next request
+
+_clients = {}
+_closing = set()  # close() tasks of evicted clients, referenced until they finish
+
+
+def make_timeout(timeout_total, timeout_read):
+    return httpx.Timeout(
+        timeout=timeout_total,  # Total operation timeout
+        connect=10.0,  # Connection timeout
+        read=timeout_read,  # Read timeout between chunks (increased for streaming)
+        write=30.0,  # Write timeout
+        pool=10.0,  # Pool timeout
+    )
+
+
+def running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def get_openai_client(base_url, api_key, timeout_total, timeout_read):
+    loop = running_loop()
+    key = (base_url, api_key, timeout_total, timeout_read, loop)
+    client = _clients.get(key)
+    if client is None:
+        # forget clients whose event loop is gone; their connections cannot be used any more
+        for stale_key in [k for k in _clients if k[-1] is not None and k[-1].is_closed()]:
+            close_stale_client(_clients.pop(stale_key), loop)
+        timeout = make_timeout(timeout_total, timeout_read)
+        client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=timeout,
+            max_retries=0,  # EngineWrapper.with_transport_retries does the retrying; the SDK's own retries would hide the failures from it, the adaptive limiter and the request metrics
+            http_client=httpx.AsyncClient(
+                timeout=timeout,
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=KEEPALIVE_EXPIRY,
+                ),
+                http2=HTTP2_AVAILABLE,
+            ),
+        )
+        _clients[key] = client
+    return client
+
+
+async def close_quietly(client):
+    try:
+        await client.close()
+    except Exception:
+        pass  # the transports of a closed loop may refuse to close cleanly; their sockets are released all the same
+
+
+def close_stale_client(client, loop):
+    if loop is None:
+        asyncio.run(close_quietly(client))
+        return
+    task = loop.create_task(close_quietly(client))
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+
+
+async def close_clients():
+    """Closes the clients that belong to the running event loop. Await it before the loop is shut down."""
+    loop = running_loop()
+    for key in [k for k in _clients if k[-1] is loop]:
+        await close_quietly(_clients.pop(key))
@@ -90,6 +90,7 @@ class DepthFirstPipelineStep(PipelineStep):
                         completion_mode,
                         use_stop,
                         error_message=error_message,
+                        cache_variant=self.max_retries - max_retries,
                         **kwargs,
                         **additional_kwargs,
                     )
@@ -0,0 +1,174 @@
+import asyncio
+import hashlib
+import time
+from contextlib import contextmanager
+
+from augmentoolkit.generation_functions.transport_retry import classify_error
+
+# Several OpenAI-compatible replicas behind one EngineWrapper. Pass a list as base_url and every request is routed to the replica that looks least busy, so throughput grows with the number of replicas without a proxy in front of them (which would also hide queue depth from the pipeline).
+# Routing is either "least_outstanding" (fewest requests in flight, ties broken by latency) or "ewma_latency" (smoothed time-to-first-token, scaled by the requests already queued on the replica). A replica that fails FAILURES_TO_EJECT times in a row with a connection error, timeout or 5xx is ejected. Once its cooldown is over it is probed with a cheap GET /models and re-admitted if that works; otherwise the cooldown doubles.
+# Requests can carry a prefix hint (e.g. a hash of the source chunk that every validation prompt for it starts with). Hinted requests go to the replica that the hint hashes to (rendezvous hashing over the healthy replicas, so only the hints of a replica that drops out move), which lets the server's prefix cache (vLLM automatic prefix caching, llama.cpp cache_prompt) reuse the shared prefill instead of every replica recomputing it. The pin is dropped for a request when its replica already has more than AFFINITY_LOAD_FACTOR times the average load, so one hot chunk cannot pile everything onto one replica.
+
+FAILURES_TO_EJECT = 3
+EJECT_SECONDS = 10.0
+MAX_EJECT_SECONDS = 300.0
+PROBE_TIMEOUT_SECONDS = 10.0
+LATENCY_EWMA_ALPHA = 0.2
+AFFINITY_LOAD_FACTOR = 1.5
+ENDPOINT_FAILURES = {"connection", "timeout", "server_error"}  # a 429 means the replica is alive, just busy
+
+
+class Endpoint:
+    def __init__(self, base_url, get_client):
+        self.base_url = base_url
+        self.get_client = get_client  # returns the client to use from the current event loop (see client_registry.py)
+        self.outstanding = 0
+        self.latency_ewma = None
+        self.consecutive_failures = 0
+        self.ejected_until = None  # None while the endpoint is healthy
+        self.eject_seconds = EJECT_SECONDS
+        self.probing = False
+        self.requests = 0
+        self.failures = 0
+        self.pinned = 0  # requests routed here by their prefix hint
+
+    @property
+    def client(self):
+        return self.get_client()
+
+    @property
+    def healthy(self):
+        return self.ejected_until is None
+
+    def record_success(self, latency):
+        self.consecutive_failures = 0
+        self.eject_seconds = EJECT_SECONDS
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += LATENCY_EWMA_ALPHA * (latency - self.latency_ewma)
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.healthy and self.consecutive_failures >= FAILURES_TO_EJECT:
+            self.eject()
+
+    def eject(self):
+        self.ejected_until = time.monotonic() + self.eject_seconds
+        print(
+            f"[Endpoints] ejecting {self.base_url} for {self.eject_seconds:.0f}s after {self.consecutive_failures} consecutive failures"
+        )
+        self.eject_seconds = min(MAX_EJECT_SECONDS, self.eject_seconds * 2)
+
+    def readmit(self):
+        print(f"[Endpoints] re-admitting {self.base_url}")
+        self.ejected_until = None
+        self.consecutive_failures = 0
+
+
+class EndpointPool:
+    def __init__(self, endpoints, routing="least_outstanding"):
+        assert endpoints, "An endpoint pool needs at least one endpoint"
+        assert routing in (
+            "least_outstanding",
+            "ewma_latency",
+        ), f"Unknown routing strategy {routing}"
+        self.endpoints = endpoints
+        self.routing = routing
+        self.probe_tasks = set()  # the event loop only keeps weak references to tasks, so running probes are held here until they finish
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def score(self, endpoint):
+        latency = endpoint.latency_ewma if endpoint.latency_ewma is not None else 0.0
+        if self.routing == "ewma_latency":
+            # an unmeasured replica scores 0 and gets tried first
+            return (latency * (endpoint.outstanding + 1), endpoint.outstanding)
+        return (endpoint.outstanding, latency)
+
+    def rendezvous_weight(self, prefix_hint, endpoint):
+        return hashlib.blake2b(
+            f"{prefix_hint}|{endpoint.base_url}".encode("utf-8"), digest_size=8
+        ).digest()
+
+    def choose(self, prefix_hint=None):
+        if len(self.endpoints) == 1:
+            return self.endpoints[0]
+        now = time.monotonic()
+        for endpoint in self.endpoints:
+            if (
+                not endpoint.healthy
+                and not endpoint.probing
+                and now >= endpoint.ejected_until
+            ):
+                endpoint.probing = True
+                task = asyncio.ensure_future(self.probe(endpoint))
+                self.probe_tasks.add(task)
+                task.add_done_callback(self.probe_tasks.discard)
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+        if not candidates:
+            # everything is down; keep trying the one that has been out the longest rather than failing outright, and let the transport retries deal with it
+            return min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)
+        if prefix_hint is not None and len(candidates) > 1:
+            pinned = max(
+                candidates,
+                key=lambda endpoint: self.rendezvous_weight(prefix_hint, endpoint),
+            )
+            average_load = sum(endpoint.outstanding for endpoint in candidates) / len(
+                candidates
+            )
+            if pinned.outstanding <= AFFINITY_LOAD_FACTOR * (average_load + 1):
+                pinned.pinned += 1
+                return pinned
+        return min(candidates, key=self.score)
+
+    async def probe(self, endpoint):
+        try:
+            await asyncio.wait_for(
+                endpoint.client.models.list(), timeout=PROBE_TIMEOUT_SECONDS
+            )
+            endpoint.readmit()
+        except Exception as e:
+            print(f"[Endpoints] health check of {endpoint.base_url} failed: {e}")
+            endpoint.eject()
+        finally:
+            endpoint.probing = False
+
+    @contextmanager
+    def route(self, ticket, prefix_hint=None):
+        """Picks an endpoint for one request and keeps its load and health up to date. ticket is the request's RequestTicket, which knows when the first token arrived; prefix_hint, if given, pins requests that share a prompt prefix to one endpoint."""
+        endpoint = self.choose(prefix_hint)
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        try:
+            yield endpoint
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if classify_error(e) in ENDPOINT_FAILURES:
+                endpoint.record_failure()
+            raise
+        else:
+            endpoint.record_success(
+                ticket.first_token_latency
+                if ticket.first_token_latency is not None
+                else time.monotonic() - ticket.started
+            )
+        finally:
+            endpoint.outstanding -= 1
+
+    def metrics(self):
+        return [
+            {
+                "base_url": endpoint.base_url,
+                "healthy": endpoint.healthy,
+                "outstanding": endpoint.outstanding,
+                "latency_ewma_seconds": endpoint.latency_ewma,
+                "requests": endpoint.requests,
+                "failures": endpoint.failures,
+                "pinned_by_prefix": endpoint.pinned,
+            }
+            for endpoint in self.endpoints
+        ]
@@ -1,16 +1,65 @@
 import asyncio
+import time
 import uuid
-from openai import AsyncOpenAI
 import cohere
-from httpx import Timeout
 import traceback
 import json
+import logging
+from collections import Counter
+from functools import partial
+from augmentoolkit.generation_functions.client_registry import get_openai_client
+from augmentoolkit.generation_functions.response_cache import make_cache_key
+from augmentoolkit.generation_functions.endpoint_pool import Endpoint, EndpointPool
+from augmentoolkit.generation_functions.observer_dispatch import dispatch_observers
+from augmentoolkit.generation_functions.request_metrics import (
+    record_error,
+    record_request,
+    register_engine,
+)
+from augmentoolkit.generation_functions.hedging import (
+    DEFAULT_HEDGE_BUDGET,
+    RequestHedger,
+)
+from augmentoolkit.generation_functions.adaptive_limiter import unlimited_slot
+from augmentoolkit.generation_functions.rate_limiter import (
+    RateLimiter,
+    estimate_payload_tokens,
+    estimate_tokens,
+)
+from augmentoolkit.generation_functions.transport_retry import (
+    DEFAULT_MAX_TRANSPORT_RETRIES,
+    DEFAULT_RETRY_BASE_DELAY,
+    DEFAULT_RETRY_MAX_DELAY,
+    RETRYABLE_ERRORS,
+    classify_error,
+    retry_delay,
+)
+
+logger = logging.getLogger(__name__)  # per-request output, like full prompts, is logged at DEBUG
 
 
 def make_id():
     return str(uuid.uuid4())
 
 
+def usage_dict(usage):
+    # the provider's token counts for one request, or None if it did not send (complete) ones
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    if prompt_tokens is None or completion_tokens is None:
+        return None
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+
+
+def cohere_usage_dict(response):
+    billed_units = getattr(getattr(response, "meta", None), "billed_units", None)
+    input_tokens = getattr(billed_units, "input_tokens", None)
+    output_tokens = getattr(billed_units, "output_tokens", None)
+    if input_tokens is None or output_tokens is None:
+        return None
+    return {"prompt_tokens": int(input_tokens), "completion_tokens": int(output_tokens)}
+
+
 # How it'll work:
 # Things that we want to attach to the engine wrapper will execute either before or after a generation
 # it's like input or output observers
@@ -26,39 +75,549 @@ class EngineWrapper:
         self,
         model,
         api_key=None,
-        base_url=None,
+        base_url=None,  # one URL, or a list of URLs of identical replicas to spread requests over (see endpoint_pool.py)
         mode="api",  # can be one of api, aphrodite, llama.cpp, cohere
         input_observers=[],
         output_observers=[],
         timeout_total=500.0,  # Total operation timeout
         timeout_read=240.0,  # Read timeout between chunks
         timeout_api_call=600,  # Timeout for individual API calls
+        response_cache=None,  # a ResponseCache; only consulted by calls made with cache=True
+        concurrency_limiter=None,  # an AdaptiveConcurrencyLimiter bounding this engine's in-flight requests
+        requests_per_minute=None,  # the provider's quotas for this model, if you want to stay under them instead of running into 429s
+        tokens_per_minute=None,
+        max_transport_retries=DEFAULT_MAX_TRANSPORT_RETRIES,  # retries for 429/5xx/connection/timeout failures, separate from a step's validation retries
+        retry_base_delay=DEFAULT_RETRY_BASE_DELAY,
+        retry_max_delay=DEFAULT_RETRY_MAX_DELAY,
+        routing="least_outstanding",  # how requests are spread over several base_urls: least_outstanding or ewma_latency
+        hedge_percentile=None,  # e.g. 0.95: send a duplicate of any request that runs longer than 95% of requests do, and keep whichever finishes first
+        hedge_budget=DEFAULT_HEDGE_BUDGET,  # largest share of requests that may be duplicated
+        stream=True,  # False asks for each response in one piece; cheaper when nothing looks at partial output, which is the case for batch generation. Can be overridden per call
+        request_usage=True,  # ask streaming responses to end with a usage block (stream_options.include_usage) so observers get the provider's token counts
+        name=None,  # what this engine is called in the request metrics; defaults to the model
         **kwargs,
     ):
         self.mode = mode
         self.model = model
+        self.name = name or model
+        self.stream = stream
+        self.request_usage = request_usage
+        self.response_cache = response_cache
+        self.concurrency_limiter = concurrency_limiter
+        self.rate_limiter = None
+        if requests_per_minute or tokens_per_minute:
+            self.rate_limiter = RateLimiter(
+                requests_per_minute=requests_per_minute,
+                tokens_per_minute=tokens_per_minute,
+                name=model,
+            )
+        self.max_transport_retries = max_transport_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.transport_stats = Counter()  # requests sent, retried_<class>, failed_<class>, gave_up
+        self.hedger = (
+            RequestHedger(percentile=hedge_percentile, budget=hedge_budget)
+            if hedge_percentile
+            else None
+        )
         self.input_observers = input_observers
         self.output_observers = output_observers
         self.timeout_api_call = timeout_api_call  # Store for use in API calls
+        self.endpoint_pool = None
         if mode == "cohere":
-            self.client = cohere.AsyncClient(api_key=api_key)
+            self.cohere_client = cohere.AsyncClient(api_key=api_key)
         elif mode == "api":
-            self.client = AsyncOpenAI(
-                timeout=Timeout(
-                    timeout=timeout_total,  # Total operation timeout
-                    connect=10.0,  # Connection timeout
-                    read=timeout_read,  # Read timeout between chunks (increased for streaming)
-                    write=30.0,  # Write timeout
-                    pool=10.0,  # Pool timeout
-                ),
-                api_key=api_key,
-                base_url=base_url,
+            base_urls = base_url if isinstance(base_url, (list, tuple)) else [base_url]
+            self.endpoint_pool = EndpointPool(
+                [
+                    Endpoint(
+                        url,
+                        # clients are shared with every other EngineWrapper pointed at the same server (see client_registry.py)
+                        partial(
+                            get_openai_client,
+                            url,
+                            api_key,
+                            timeout_total,
+                            timeout_read,
+                        ),
+                    )
+                    for url in base_urls
+                ],
+                routing=routing,
             )
+        register_engine(self)
+
+    @property
+    def client(self):
+        if self.endpoint_pool is None:
+            return self.cohere_client
+        # the interactive *_streaming methods always use the first endpoint
+        return self.endpoint_pool.endpoints[0].client
+
+    def cached_response(
+        self, payload, sampling_params, completion_mode, cache_variant, step_label
+    ):
+        # returns (cache key, cached completion or None); the key is None when caching does not apply to this call
+        if self.response_cache is None:
+            return None, None
+        cache_key = make_cache_key(
+            self.model, payload, sampling_params, completion_mode, cache_variant
+        )
+        return cache_key, self.response_cache.get(cache_key, label=step_label)
+
+    def concurrency_slot(self):
+        # every request holds a slot of this engine's adaptive window for as long as it is streaming
+        if self.concurrency_limiter is None:
+            return unlimited_slot()
+        return self.concurrency_limiter.slot()
+
+    async def reserve_rate_limit(self, payload, sampling_params):
+        # waits for RPM/TPM quota; returns the tokens reserved so that settle_rate_limit can correct the estimate
+        if self.rate_limiter is None:
+            return 0
+        return await self.rate_limiter.acquire(
+            estimate_payload_tokens(payload) + sampling_params["max_tokens"]
+        )
+
+    def settle_rate_limit(self, reserved_tokens, payload, completion, usage=None):
+        if self.rate_limiter is not None:
+            if usage is not None:
+                actual_tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+            else:
+                actual_tokens = estimate_payload_tokens(payload) + estimate_tokens(
+                    completion
+                )
+            self.rate_limiter.reconcile(reserved_tokens, actual_tokens)
+
+    def release_rate_limit(self, reserved_tokens, payload):
+        # the request failed or was cancelled before a response came in. The prompt counts as spent, since the provider may well have processed it; the rest of the reservation goes back
+        self.settle_rate_limit(reserved_tokens, payload, "")
+
+    def usage_options(self):
+        if not self.request_usage:
+            return {}
+        return {"stream_options": {"include_usage": True}}
+
+    async def observe(self, payload, completion_mode, usage, completion=None):
+        # called once the request is over, so that token counters can use the provider's count (usage is None when the provider did not report one, or the request failed). Output observers only run when there is a completion.
+        # The observers run on the observer thread, not here (see observer_dispatch.py)
+        calls = [
+            (input_observer, (payload, completion_mode), {"usage": usage})
+            for input_observer in self.input_observers
+        ]
+        if completion is not None:
+            calls += [
+                (
+                    output_observer,
+                    (payload, completion, completion_mode),  # input, output, completion_mode (this is the input format for output observers)
+                    {"usage": usage},
+                )
+                for output_observer in self.output_observers
+            ]
+        await dispatch_observers(calls)
+
+    def record_metrics(
+        self, step_label, request_started, ticket, completion, usage, timed_out
+    ):
+        finished = time.monotonic()
+        record_request(
+            self.name,
+            self.model,
+            step_label,
+            queue_wait=ticket.started - request_started,  # rate limit + concurrency slot
+            ttft=ticket.first_token_latency,
+            latency=finished - request_started,
+            service_time=finished - ticket.started,
+            output_tokens=(
+                usage["completion_tokens"]
+                if usage is not None
+                else estimate_tokens(completion)
+            ),
+            timed_out=timed_out,
+        )
+
+    def runtime_stats(self):
+        # the state of this engine's limiters, endpoints and retries, for the metrics summary (see request_metrics.py)
+        return {
+            "name": self.name,
+            "model": self.model,
+            "concurrency": (
+                self.concurrency_limiter.metrics()
+                if self.concurrency_limiter is not None
+                else None
+            ),
+            "rate_limit": (
+                self.rate_limiter.metrics() if self.rate_limiter is not None else None
+            ),
+            "endpoints": (
+                self.endpoint_pool.metrics() if self.endpoint_pool is not None else None
+            ),
+            "hedging": dict(self.hedger.stats) if self.hedger is not None else None,
+            "transport": dict(self.transport_stats),
+        }
+
+    def store_response(self, cache_key, completion, timed_out):
+        if cache_key is not None and completion and not timed_out:
+            self.response_cache.put(cache_key, completion)
+
+    async def send(self, request, *args, step_label=None, prefix_hint=None):
+        # one logical request: transport retries, and a hedge if the request is running long
+        if self.hedger is None:
+            return await self.with_transport_retries(
+                request, *args, step_label=step_label, prefix_hint=prefix_hint
+            )
+        return await self.hedger.run(
+            lambda: self.with_transport_retries(
+                request, *args, step_label=step_label, prefix_hint=prefix_hint
+            )
+        )
+
+    async def with_transport_retries(
+        self, request, *args, step_label=None, prefix_hint=None
+    ):
+        """Runs one request (a stream_* method), retrying transport failures -- rate limits, 5xx, dropped connections, timeouts -- with exponential backoff and jitter, or as long as the server's Retry-After asks. Anything else is raised straight away, to be handled by the step's validation retries."""
+        attempt = 0
+        while True:
+            self.transport_stats["requests"] += 1
+            try:
+                return await request(
+                    *args, step_label=step_label, prefix_hint=prefix_hint
+                )
+            except Exception as e:
+                error_class = classify_error(e)
+                record_error(self.name, self.model, step_label, error_class)
+                if (
+                    error_class == "other"
+                    and self.request_usage
+                    and "stream_options" in str(e)
+                ):
+                    # an older server that does not know stream_options; stop asking and fall back to counting tokens locally
+                    print(
+                        f"[Usage] {self.model}: server rejected stream_options, token counts will be estimated locally"
+                    )
+                    self.request_usage = False
+                    continue
+                if error_class not in RETRYABLE_ERRORS:
+                    self.transport_stats[f"failed_{error_class}"] += 1
+                    raise
+                if attempt >= self.max_transport_retries:
+                    self.transport_stats["gave_up"] += 1
+                    raise
+                delay = retry_delay(
+                    e, attempt, self.retry_base_delay, self.retry_max_delay
+                )
+                attempt += 1
+                self.transport_stats[f"retried_{error_class}"] += 1
+                print(
+                    f"[Retry] {self.model}: {error_class} ({type(e).__name__}), attempt {attempt}/{self.max_transport_retries} in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+
+    async def stream_completion(
+        self, prompt, sampling_params, use_min_p, step_label=None, prefix_hint=None
+    ):
+        chunks = []  # joined once at the end; adding to a string chunk by chunk is quadratic in the length of the output
+        timed_out = False
+        usage = None
+        request_started = time.monotonic()
+        reserved_tokens = await self.reserve_rate_limit(prompt, sampling_params)
+        try:
+            async with self.concurrency_slot() as ticket:
+                with self.endpoint_pool.route(ticket, prefix_hint) as endpoint:
+                    if use_min_p:
+                        stream = await endpoint.client.completions.create(
+                            model=self.model,
+                            prompt=prompt,
+                            temperature=sampling_params["temperature"],
+                            top_p=sampling_params["top_p"],
+                            stop=sampling_params["stop"],
+                            max_tokens=sampling_params["max_tokens"],
+                            extra_body={"min_p": sampling_params["min_p"]},
+                            stream=True,
+                            timeout=self.timeout_api_call,  # Use configurable timeout
+                            **self.usage_options(),
+                        )
+                    else:
+                        stream = await endpoint.client.completions.create(
+                            model=self.model,
+                            prompt=prompt,
+                            temperature=sampling_params["temperature"],
+                            top_p=sampling_params["top_p"],
+                            stop=sampling_params["stop"],
+                            max_tokens=sampling_params["max_tokens"],
+                            stream=True,
+                            timeout=self.timeout_api_call,  # Use configurable timeout
+                            **self.usage_options(),
+                        )
+                    async for chunk in stream:
+                        ticket.first_token()
+                        if getattr(chunk, "usage", None) is not None:
+                            usage = usage_dict(chunk.usage)
+                        if not chunk.choices:  # the usage chunk at the end has no choices
+                            continue
+                        try:
+                            chunks.append(chunk.choices[0].text)
+                        except Exception as e:
+                            timed_out = True
+        except BaseException:
+            self.release_rate_limit(reserved_tokens, prompt)
+            raise
+
+        completion = "".join(chunks)
+        self.settle_rate_limit(reserved_tokens, prompt, completion, usage)
+        self.record_metrics(
+            step_label, request_started, ticket, completion, usage, timed_out
+        )
+        return completion, timed_out, usage
+
+    async def stream_chat(
+        self, messages, sampling_params, use_min_p, step_label=None, prefix_hint=None
+    ):
+        chunks = []
+        timed_out = False
+        usage = None
+        request_started = time.monotonic()
+        reserved_tokens = await self.reserve_rate_limit(messages, sampling_params)
+        try:
+            async with self.concurrency_slot() as ticket:
+                with self.endpoint_pool.route(ticket, prefix_hint) as endpoint:
+                    if use_min_p:
+                        stream = await endpoint.client.chat.completions.create(
+                            model=self.model,
+                            messages=messages,
+                            temperature=sampling_params["temperature"],
+                            top_p=sampling_params["top_p"],
+                            stop=sampling_params["stop"],
+                            max_tokens=sampling_params["max_tokens"],
+                            extra_body={"min_p": sampling_params["min_p"]},
+                            stream=True,
+                            timeout=self.timeout_api_call,  # Use configurable timeout
+                            **self.usage_options(),
+                        )
+                    else:
+                        stream = await endpoint.client.chat.completions.create(
+                            model=self.model,
+                            messages=messages,
+                            temperature=sampling_params["temperature"],
+                            top_p=sampling_params["top_p"],
+                            stop=sampling_params["stop"],
+                            max_tokens=sampling_params["max_tokens"],
+                            stream=True,
+                            timeout=self.timeout_api_call,  # Use configurable timeout
+                            **self.usage_options(),
+                        )
+                    async for chunk in stream:
+                        ticket.first_token()
+                        if getattr(chunk, "usage", None) is not None:
+                            usage = usage_dict(chunk.usage)
+                        try:
+                            # print(chunk.choices)
+                            try:
+                                if chunk.choices[0].delta.content:
+                                    chunks.append(chunk.choices[0].delta.content)
+                            except Exception as e:
+                                # print("Really strange exception!")
+                                # print(chunk)
+                                # traceback.print_exc()
+                                pass
+                        except Exception as e:
+                            print("\n\n------------CAUGHT EXCEPTION DURING GENERATION")
+                            print(e)
+                            traceback.print_exc()
+                            timed_out = True
+                            print("\n\n-----/\------")
+        except BaseException:
+            self.release_rate_limit(reserved_tokens, messages)
+            raise
+
+        completion = "".join(chunks)
+        self.settle_rate_limit(reserved_tokens, messages, completion, usage)
+        self.record_metrics(
+            step_label, request_started, ticket, completion, usage, timed_out
+        )
+        return completion, timed_out, usage
+
+    async def stream_cohere_chat(
+        self, messages, sampling_params, step_label=None, prefix_hint=None
+    ):
+        chunks = []
+        timed_out = False
+        usage = None
+        messages_cohereified = [
+            {
+                "role": "USER" if message["role"] == "user" else "CHATBOT",
+                "message": message["content"],
+            }
+            for message in messages
+        ]
+        request_started = time.monotonic()
+        reserved_tokens = await self.reserve_rate_limit(messages, sampling_params)
+        try:
+            async with self.concurrency_slot() as ticket:
+                stream = self.client.chat_stream(
+                    model=self.model,
+                    chat_history=messages_cohereified[1:-1],
+                    message=messages_cohereified[-1]["message"],
+                    preamble=messages_cohereified[0]["message"],
+                    temperature=sampling_params["temperature"],
+                    p=sampling_params["top_p"],
+                    stop_sequences=sampling_params["stop"],
+                    max_tokens=sampling_params["max_tokens"],
+                )
+                async for chunk in stream:
+                    ticket.first_token()
+                    try:
+                        if chunk.event_type == "text-generation":
+                            chunks.append(chunk.text)
+                        elif chunk.event_type == "stream-end":
+                            usage = cohere_usage_dict(chunk.response)
+                    except Exception as e:
+                        print("THIS RESPONSE TIMED OUT PARTWAY THROUGH GENERATION!")
+                        print(e)
+                        timed_out = True
+        except BaseException:
+            self.release_rate_limit(reserved_tokens, messages)
+            raise
+
+        completion = "".join(chunks)
+        self.settle_rate_limit(reserved_tokens, messages, completion, usage)
+        self.record_metrics(
+            step_label, request_started, ticket, completion, usage, timed_out
+        )
+        return completion, timed_out, usage
+
+    # Non-streaming counterparts of the stream_* methods: one response body instead of a chunk per token. The whole response counts as the "first token" for the endpoint latencies and the metrics; the adaptive limiter does not judge congestion by it (see RequestTicket.whole_response).
+
+    async def fetch_completion(
+        self, prompt, sampling_params, use_min_p, step_label=None, prefix_hint=None
+    ):
+        timed_out = False
+        extra = {"extra_body": {"min_p": sampling_params["min_p"]}} if use_min_p else {}
+        request_started = time.monotonic()
+        reserved_tokens = await self.reserve_rate_limit(prompt, sampling_params)
+        try:
+            async with self.concurrency_slot() as ticket:
+                with self.endpoint_pool.route(ticket, prefix_hint) as endpoint:
+                    response = await endpoint.client.completions.create(
+                        model=self.model,
+                        prompt=prompt,
+                        temperature=sampling_params["temperature"],
+                        top_p=sampling_params["top_p"],
+                        stop=sampling_params["stop"],
+                        max_tokens=sampling_params["max_tokens"],
+                        timeout=self.timeout_api_call,
+                        **extra,
+                    )
+                    ticket.whole_response()
+        except BaseException:
+            self.release_rate_limit(reserved_tokens, prompt)
+            raise
+        try:
+            completion = response.choices[0].text or ""
+        except Exception as e:
+            print(f"Malformed response from {self.model}: {e}")
+            completion = ""
+            timed_out = True
+        usage = usage_dict(getattr(response, "usage", None))
+
+        self.settle_rate_limit(reserved_tokens, prompt, completion, usage)
+
+        self.record_metrics(
+            step_label, request_started, ticket, completion, usage, timed_out
+        )
+        return completion, timed_out, usage
+
+    async def fetch_chat(
+        self, messages, sampling_params, use_min_p, step_label=None, prefix_hint=None
+    ):
+        timed_out = False
+        extra = {"extra_body": {"min_p": sampling_params["min_p"]}} if use_min_p else {}
+        request_started = time.monotonic()
+        reserved_tokens = await self.reserve_rate_limit(messages, sampling_params)
+        try:
+            async with self.concurrency_slot() as ticket:
+                with self.endpoint_pool.route(ticket, prefix_hint) as endpoint:
+                    response = await endpoint.client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        temperature=sampling_params["temperature"],
+                        top_p=sampling_params["top_p"],
+                        stop=sampling_params["stop"],
+                        max_tokens=sampling_params["max_tokens"],
+                        timeout=self.timeout_api_call,
+                        **extra,
+                    )
+                    ticket.whole_response()
+        except BaseException:
+            self.release_rate_limit(reserved_tokens, messages)
+            raise
+        try:
+            completion = response.choices[0].message.content or ""
+        except Exception as e:
+            print(f"Malformed response from {self.model}: {e}")
+            completion = ""
+            timed_out = True
+        usage = usage_dict(getattr(response, "usage", None))
+
+        self.settle_rate_limit(reserved_tokens, messages, completion, usage)
+
+        self.record_metrics(
+            step_label, request_started, ticket, completion, usage, timed_out
+        )
+        return completion, timed_out, usage
+
+    async def fetch_cohere_chat(
+        self, messages, sampling_params, step_label=None, prefix_hint=None
+    ):
+        messages_cohereified = [
+            {
+                "role": "USER" if message["role"] == "user" else "CHATBOT",
+                "message": message["content"],
+            }
+            for message in messages
+        ]
+        request_started = time.monotonic()
+        reserved_tokens = await self.reserve_rate_limit(messages, sampling_params)
+        try:
+            async with self.concurrency_slot() as ticket:
+                response = await self.client.chat(
+                    model=self.model,
+                    chat_history=messages_cohereified[1:-1],
+                    message=messages_cohereified[-1]["message"],
+                    preamble=messages_cohereified[0]["message"],
+                    temperature=sampling_params["temperature"],
+                    p=sampling_params["top_p"],
+                    stop_sequences=sampling_params["stop"],
+                    max_tokens=sampling_params["max_tokens"],
+                )
+                ticket.whole_response()
+        except BaseException:
+            self.release_rate_limit(reserved_tokens, messages)
+            raise
+        completion = response.text or ""
+        usage = cohere_usage_dict(response)
+
+        self.settle_rate_limit(reserved_tokens, messages, completion, usage)
+
+        self.record_metrics(
+            step_label, request_started, ticket, completion, usage, False
+        )
+        return completion, False, usage
 
     async def submit_completion(
-        self, prompt, sampling_params, return_completion_only=False
+        self,
+        prompt,
+        sampling_params,
+        return_completion_only=False,
+        cache=False,  # look the response up in (and save it to) self.response_cache
+        cache_variant=None,  # which sample of this exact request this is; see response_cache.py
+        step_label=None,  # which step the call belongs to; cache hit/miss counters and request metrics are grouped by it
+        stream=None,  # None: use the engine's setting
+        prefix_hint=None,  # requests with the same hint share a long prompt prefix; with several endpoints they go to the same one, so its prefix cache is reused (see endpoint_pool.py)
     ):  # Submit request and wait for it to stream back fully
-        print(prompt)
+        logger.debug("Prompt:\n%s", prompt)
+        if stream is None:
+            stream = self.stream
         if "temperature" not in sampling_params:
             sampling_params["temperature"] = 1
         if "top_p" not in sampling_params:
@@ -79,45 +638,33 @@ class EngineWrapper:
         if "min_p" in sampling_params:
             use_min_p = True
 
-        for input_observer in self.input_observers:
-            input_observer(prompt, completion_mode=True)
+        cache_key = None
+        if cache:
+            cache_key, completion = self.cached_response(
+                prompt, sampling_params, True, cache_variant, step_label
+            )
+            if completion is not None:  # no tokens were spent, so the observers are not told
+                if not return_completion_only:
+                    return prompt + completion, False
+                return completion, False
 
         if self.mode == "api":
-            timed_out = False
-            completion = ""
-            if use_min_p:
-                stream = await self.client.completions.create(
-                    model=self.model,
-                    prompt=prompt,
-                    temperature=sampling_params["temperature"],
-                    top_p=sampling_params["top_p"],
-                    stop=sampling_params["stop"],
-                    max_tokens=sampling_params["max_tokens"],
-                    extra_body={"min_p": sampling_params["min_p"]},
-                    stream=True,
-                    timeout=self.timeout_api_call,  # Use configurable timeout
-                )
-            else:
-                stream = await self.client.completions.create(
-                    model=self.model,
-                    prompt=prompt,
-                    temperature=sampling_params["temperature"],
-                    top_p=sampling_params["top_p"],
-                    stop=sampling_params["stop"],
-                    max_tokens=sampling_params["max_tokens"],
-                    stream=True,
-                    timeout=self.timeout_api_call,  # Use configurable timeout
+            try:
+                completion, timed_out, usage = await self.send(
+                    self.stream_completion if stream else self.fetch_completion,
+                    prompt,
+                    sampling_params,
+                    use_min_p,
+                    step_label=step_label,
+                    prefix_hint=prefix_hint,
                 )
-            async for chunk in stream:
-                try:
-                    completion = completion + chunk.choices[0].text
-                except Exception as e:
-                    timed_out = True
+            except Exception:
+                await self.observe(prompt, True, None)  # the prompt may well have been billed anyway
+                raise
 
-            for output_observer in self.output_observers:
-                output_observer(
-                    prompt, completion, True
-                )  # input, output, completion_mode (this is the input format for output observers)
+            self.store_response(cache_key, completion, timed_out)
+
+            await self.observe(prompt, True, usage, completion)
 
             if not return_completion_only:
                 return prompt + completion, timed_out
@@ -128,8 +675,18 @@ class EngineWrapper:
             raise Exception("Cohere not compatible with completion mode!")
 
     async def submit_chat(
-        self, messages, sampling_params
+        self,
+        messages,
+        sampling_params,
+        cache=False,
+        cache_variant=None,
+        step_label=None,
+        stream=None,
+        prefix_hint=None,
     ):  # Submit request and wait for it to stream back fully
+        logger.debug("Messages:\n%s", messages)
+        if stream is None:
+            stream = self.stream
         if "temperature" not in sampling_params:
             sampling_params["temperature"] = 1
         if "top_p" not in sampling_params:
@@ -146,99 +703,59 @@ class EngineWrapper:
         if "min_p" in sampling_params:
             use_min_p = True
 
-        for input_observer in self.input_observers:
-            input_observer(messages, False)
+        cache_key = None
+        if cache:
+            cache_key, completion = self.cached_response(
+                messages, sampling_params, False, cache_variant, step_label
+            )
+            if completion is not None:
+                return completion, False
 
         if self.mode == "api":
-            completion = ""
-            timed_out = False
-            if use_min_p:
-                stream = await self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    temperature=sampling_params["temperature"],
-                    top_p=sampling_params["top_p"],
-                    stop=sampling_params["stop"],
-                    max_tokens=sampling_params["max_tokens"],
-                    extra_body={"min_p": sampling_params["min_p"]},
-                    stream=True,
-                    timeout=self.timeout_api_call,  # Use configurable timeout
-                )
-            else:
-                stream = await self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    temperature=sampling_params["temperature"],
-                    top_p=sampling_params["top_p"],
-                    stop=sampling_params["stop"],
-                    max_tokens=sampling_params["max_tokens"],
-                    stream=True,
-                    timeout=self.timeout_api_call,  # Use configurable timeout
-                )
-            async for chunk in stream:
-                try:
-                    # print(chunk.choices)
-                    try:
-                        if chunk.choices[0].delta.content:
-                            completion = completion + chunk.choices[0].delta.content
-                    except Exception as e:
-                        # print("Really strange exception!")
-                        # print(chunk)
-                        # traceback.print_exc()
-                        pass
-                except Exception as e:
-                    print("\n\n------------CAUGHT EXCEPTION DURING GENERATION")
-                    print(e)
-                    traceback.print_exc()
-                    timed_out = True
-                    print("\n\n-----/\------")
-
-            for output_observer in self.output_observers:
-                output_observer(messages, completion, False)
-
-            return completion, timed_out
-
+            request = self.stream_chat if stream else self.fetch_chat
+            args = (messages, sampling_params, use_min_p)
         elif self.mode == "cohere":
-            timed_out = False
-            completion = ""
-            messages_cohereified = [
-                {
-                    "role": "USER" if message["role"] == "user" else "CHATBOT",
-                    "message": message["content"],
-                }
-                for message in messages
-            ]
-            stream = self.client.chat_stream(
-                model=self.model,
-                chat_history=messages_cohereified[1:-1],
-                message=messages_cohereified[-1]["message"],
-                preamble=messages_cohereified[0]["message"],
-                temperature=sampling_params["temperature"],
-                p=sampling_params["top_p"],
-                stop_sequences=sampling_params["stop"],
-                max_tokens=sampling_params["max_tokens"],
-            )
-            async for chunk in stream:
-                try:
-                    if chunk.event_type == "text-generation":
-                        completion = completion + chunk.text
-                except Exception as e:
-                    print("THIS RESPONSE TIMED OUT PARTWAY THROUGH GENERATION!")
-                    print(e)
-                    timed_out = True
-
-            for output_observer in self.output_observers:
-                output_observer(messages, completion, False)
-
-            return completion, timed_out
+            request = self.stream_cohere_chat if stream else self.fetch_cohere_chat
+            args = (messages, sampling_params)
         else:
             raise Exception("Aphrodite not compatible with chat mode!")
 
+        try:
+            completion, timed_out, usage = await self.send(
+                request, *args, step_label=step_label, prefix_hint=prefix_hint
+            )
+        except Exception:
+            await self.observe(messages, False, None)
+            raise
+
+        self.store_response(cache_key, completion, timed_out)
+
+        await self.observe(messages, False, usage, completion)
+
+        return completion, timed_out
+
+    async def open_stream(self, create, payload, completion_mode, **kwargs):
+        # for the submit_*_streaming methods, which stream straight to their caller instead of going through send(): the same stream_options fallback as with_transport_retries, and the observers still hear about a request that failed to start
+        try:
+            try:
+                return await create(**kwargs, **self.usage_options())
+            except Exception as e:
+                if not (self.request_usage and "stream_options" in str(e)):
+                    raise
+                print(
+                    f"[Usage] {self.model}: server rejected stream_options, token counts will be estimated locally"
+                )
+                self.request_usage = False
+                return await create(**kwargs)
+        except Exception:
+            await self.observe(payload, completion_mode, None)
+            raise
+
     async def submit_completion_streaming(
         self, prompt, sampling_params, return_completion_only=False
     ):
         """Submit request and yield chunks as they arrive for streaming"""
-        print(prompt)
+        logger.debug("Prompt:\n%s", prompt)
         if "temperature" not in sampling_params:
             sampling_params["temperature"] = 1
         if "top_p" not in sampling_params:
@@ -257,15 +774,16 @@ class EngineWrapper:
         if "min_p" in sampling_params:
             use_min_p = True
 
-        for input_observer in self.input_observers:
-            input_observer(prompt, completion_mode=True)
-
         if self.mode == "api":
             timed_out = False
-            completion = ""
+            chunks = []  # joined once at the end, as in stream_completion
+            usage = None
 
             if use_min_p:
-                stream = await self.client.completions.create(
+                stream = await self.open_stream(
+                    self.client.completions.create,
+                    prompt,
+                    True,
                     model=self.model,
                     prompt=prompt,
                     temperature=sampling_params["temperature"],
@@ -277,7 +795,10 @@ class EngineWrapper:
                     timeout=self.timeout_api_call,
                 )
             else:
-                stream = await self.client.completions.create(
+                stream = await self.open_stream(
+                    self.client.completions.create,
+                    prompt,
+                    True,
                     model=self.model,
                     prompt=prompt,
                     temperature=sampling_params["temperature"],
@@ -289,9 +810,13 @@ class EngineWrapper:
                 )
 
             async for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    usage = usage_dict(chunk.usage)
+                if not chunk.choices:  # the usage chunk at the end has no choices
+                    continue
                 try:
                     text_chunk = chunk.choices[0].text
-                    completion += text_chunk
+                    chunks.append(text_chunk)
                     # Yield chunk in SSE format
                     yield f"data: {json.dumps({'text': text_chunk, 'done': False})}\n\n"
                 except Exception as e:
@@ -303,8 +828,7 @@ class EngineWrapper:
             if not timed_out:
                 yield f"data: {json.dumps({'text': '', 'done': True})}\n\n"
 
-            for output_observer in self.output_observers:
-                output_observer(prompt, completion, True)
+            await self.observe(prompt, True, usage, "".join(chunks))
 
         if self.mode == "cohere":
             raise Exception("Cohere not compatible with completion mode!")
@@ -327,15 +851,16 @@ class EngineWrapper:
         if "min_p" in sampling_params:
             use_min_p = True
 
-        for input_observer in self.input_observers:
-            input_observer(messages, False)
-
         if self.mode == "api":
-            completion = ""
+            chunks = []
             timed_out = False
+            usage = None
 
             if use_min_p:
-                stream = await self.client.chat.completions.create(
+                stream = await self.open_stream(
+                    self.client.chat.completions.create,
+                    messages,
+                    False,
                     model=self.model,
                     messages=messages,
                     temperature=sampling_params["temperature"],
@@ -347,7 +872,10 @@ class EngineWrapper:
                     timeout=self.timeout_api_call,
                 )
             else:
-                stream = await self.client.chat.completions.create(
+                stream = await self.open_stream(
+                    self.client.chat.completions.create,
+                    messages,
+                    False,
                     model=self.model,
                     messages=messages,
                     temperature=sampling_params["temperature"],
@@ -359,11 +887,13 @@ class EngineWrapper:
                 )
 
             async for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    usage = usage_dict(chunk.usage)
                 try:
                     try:
                         if chunk.choices[0].delta.content:
                             text_chunk = chunk.choices[0].delta.content
-                            completion += text_chunk
+                            chunks.append(text_chunk)
                             # Yield chunk in SSE format
                             yield f"data: {json.dumps({'text': text_chunk, 'done': False})}\n\n"
                     except Exception as e:
@@ -380,12 +910,12 @@ class EngineWrapper:
             if not timed_out:
                 yield f"data: {json.dumps({'text': '', 'done': True})}\n\n"
 
-            for output_observer in self.output_observers:
-                output_observer(messages, completion, False)
+            await self.observe(messages, False, usage, "".join(chunks))
 
         elif self.mode == "cohere":
             timed_out = False
-            completion = ""
+            chunks = []
+            usage = None
             messages_cohereified = [
                 {
                     "role": "USER" if message["role"] == "user" else "CHATBOT",
@@ -407,8 +937,10 @@ class EngineWrapper:
                 try:
                     if chunk.event_type == "text-generation":
                         text_chunk = chunk.text
-                        completion += text_chunk
+                        chunks.append(text_chunk)
                         yield f"data: {json.dumps({'text': text_chunk, 'done': False})}\n\n"
+                    elif chunk.event_type == "stream-end":
+                        usage = cohere_usage_dict(chunk.response)
                 except Exception as e:
                     print("THIS RESPONSE TIMED OUT PARTWAY THROUGH GENERATION!")
                     print(e)
@@ -419,7 +951,6 @@ class EngineWrapper:
             if not timed_out:
                 yield f"data: {json.dumps({'text': '', 'done': True})}\n\n"
 
-            for output_observer in self.output_observers:
-                output_observer(messages, completion, False)
+            await self.observe(messages, False, usage, "".join(chunks))
         else:
             raise Exception("Aphrodite not compatible with chat mode!")
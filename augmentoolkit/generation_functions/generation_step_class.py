@@ -1,9 +1,9 @@
 import re
-import os
 import traceback
 import logging
 import yaml
 from augmentoolkit.generation_functions.safe_formatter import safe_format
+from augmentoolkit.generation_functions.prompt_registry import get_prompt
 
 
 class OutputProcessorError(Exception):
@@ -49,6 +49,10 @@ class GenerationStep:
         prompt_folder="prompts",
         use_stop=True,
         messages=None,
+        cache_responses=False,  # replay responses from the engine wrapper's response cache, if it has one
+        cache_variant=None,  # which vote/variation/attempt of the calling step this generation is
+        stream=None,  # stream the response or fetch it in one piece; None leaves it to the engine wrapper
+        prefix_hint=None,  # same value for requests that share a long prompt prefix, e.g. the same source chunk; see EngineWrapper.submit_chat
     ):
         self.prompt_path = prompt_path
         self.regex = regex
@@ -70,38 +74,36 @@ class GenerationStep:
             level=self.logging_level, format="%(asctime)s - %(levelname)s - %(message)s"
         )
         self.messages = messages
+        self.cache_responses = cache_responses
+        self.cache_variant = cache_variant
+        self.stream = stream
+        self.prefix_hint = prefix_hint
 
     async def generate(self, **kwargs):
-        # Current file directory
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-
         if not self.messages:
-            # Get the full path of the prompt file
-            ideal_path = os.path.join(
-                current_dir, "..", "..", self.prompt_folder, self.prompt_path
+            # Resolved, read and parsed once per process; see prompt_registry
+            compiled_prompt = get_prompt(
+                self.prompt_folder,
+                self.default_prompt_folder,
+                self.prompt_path,
+                self.completion_mode,
             )
-            if os.path.exists(ideal_path):
-                full_prompt_path = ideal_path
-            else:
-                full_prompt_path = os.path.join(
-                    current_dir,
-                    "..",
-                    "..",
-                    self.default_prompt_folder,
-                    self.prompt_path,
-                )
-
-            with open(full_prompt_path, "r", encoding="utf-8", errors="ignore") as pf:
-                prompt = pf.read()
+            prompt = compiled_prompt.raw
 
         # Submit generation and return response, retrying as needed
         times_tried = 0
         if self.completion_mode:
-            prompt_formatted = safe_format(prompt, **kwargs)
+            prompt_formatted = compiled_prompt.format(**kwargs)
             while times_tried <= self.retries:
                 try:
                     response, timeout = await self.engine_wrapper.submit_completion(
-                        prompt_formatted, self.sampling_params
+                        prompt_formatted,
+                        self.sampling_params,
+                        cache=self.cache_responses,
+                        cache_variant=[self.cache_variant, times_tried],
+                        step_label=self.prompt_path,
+                        stream=self.stream,
+                        prefix_hint=self.prefix_hint,
                     )
                     filtered_response = re.search(self.regex, response).group(1)
                     try:
@@ -133,23 +135,22 @@ class GenerationStep:
             raise Exception("Generation step failed -- too many retries!")
         else:
             if not self.messages:
-                messages = yaml.safe_load(prompt)
+                messages = compiled_prompt.format_messages(**kwargs)
             else:
-                messages = self.messages
-            new_messages = []
-            for message in messages:
-                try:
-                    new_messages.append(
-                        {
-                            "role": message["role"],
-                            "content": safe_format(message["content"], **kwargs),
-                        }
-                    )
-                except Exception as e:
-                    new_messages.append(
-                        {"role": message["role"], "content": message["content"]}
-                    )
-            messages = new_messages
+                new_messages = []
+                for message in self.messages:
+                    try:
+                        new_messages.append(
+                            {
+                                "role": message["role"],
+                                "content": safe_format(message["content"], **kwargs),
+                            }
+                        )
+                    except Exception as e:
+                        new_messages.append(
+                            {"role": message["role"], "content": message["content"]}
+                        )
+                messages = new_messages
 
             # messages = [{
             #     "role": message["role"],
@@ -171,7 +172,13 @@ class GenerationStep:
                     # print(messages)
                     # print("END DEBUG\n\n\n")
                     response, timeout = await self.engine_wrapper.submit_chat(
-                        messages, self.sampling_params
+                        messages,
+                        self.sampling_params,
+                        cache=self.cache_responses,
+                        cache_variant=[self.cache_variant, times_tried],
+                        step_label=self.prompt_path,
+                        stream=self.stream,
+                        prefix_hint=self.prefix_hint,
                     )
                     try:
                         ret = self.output_processor(response)
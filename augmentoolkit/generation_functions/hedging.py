@@ -0,0 +1,77 @@
+import asyncio
+import time
+from collections import Counter, deque
+
+# Hedged requests: when a request has been running longer than most requests take (a configurable percentile of the latencies this engine has seen), a duplicate is sent, whichever finishes first wins and the other is cancelled. A handful of stuck generations would otherwise hold a whole stage open until its timeout.
+# Duplicates cost tokens, so the share of requests that may be hedged is capped by a budget.
+
+DEFAULT_HEDGE_BUDGET = 0.05  # at most 5% of requests get a duplicate
+MIN_SAMPLES = 20  # no hedging until there is enough history for the percentile to mean something
+LATENCY_WINDOW = 1000  # how many recent latencies the percentile is taken over
+RECOMPUTE_EVERY = 50  # requests between recomputing the threshold
+
+
+class RequestHedger:
+    def __init__(
+        self,
+        percentile=0.95,
+        budget=DEFAULT_HEDGE_BUDGET,
+        min_samples=MIN_SAMPLES,
+        window=LATENCY_WINDOW,
+    ):
+        assert 0 < percentile < 1, "hedge_percentile is a fraction, e.g. 0.95"
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.threshold = None
+        self.since_recompute = 0
+        self.stats = Counter()  # requests, hedged, hedge_won
+
+    def record_latency(self, latency):
+        self.latencies.append(latency)
+        self.since_recompute += 1
+        if len(self.latencies) >= self.min_samples and (
+            self.threshold is None or self.since_recompute >= RECOMPUTE_EVERY
+        ):
+            ordered = sorted(self.latencies)
+            self.threshold = ordered[int(self.percentile * (len(ordered) - 1))]
+            self.since_recompute = 0
+
+    def can_hedge(self):
+        return (
+            self.threshold is not None
+            and self.stats["hedged"] < self.budget * self.stats["requests"]
+        )
+
+    async def run(self, attempt):
+        """attempt is a zero-argument function returning a fresh coroutine for the request; it is called a second time for the hedge."""
+        self.stats["requests"] += 1
+        started = time.monotonic()
+        primary = asyncio.ensure_future(attempt())
+        tasks = {primary}
+        try:
+            if self.threshold is not None:
+                done, _ = await asyncio.wait(tasks, timeout=self.threshold)
+                if not done and self.can_hedge():
+                    self.stats["hedged"] += 1
+                    tasks.add(asyncio.ensure_future(attempt()))
+            first_error = None
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        first_error = first_error or task.exception()
+                        continue
+                    if task is not primary:
+                        self.stats["hedge_won"] += 1
+                    self.record_latency(time.monotonic() - started)
+                    return task.result()
+            raise first_error
+        finally:
+            # the loser (or both, if we were cancelled ourselves) is wasted work from here on
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,5 +1,3 @@
-import hashlib
-import json
 import random
 import traceback
 from tqdm import asyncio as tqdmasyncio
@@ -13,13 +11,15 @@ from augmentoolkit.generation_functions.pipeline_step_class import (
     filter_out_nonpresent_keys,
 )
 
-# TODO make this stop checking if/when it becomes impossible for either failing or passing to occur. I.e., early stopping in the event of the result being determined already.
+# NOTE with parallel_votes=True the votes for a key are generated concurrently and the step stops as soon as it becomes impossible for the result to change. I.e., early stopping in the event of the result being determined already.
 # Also note that working with abstractions makes the logic around skipping steps NICE AND EASY
 # we just put a majority vote and its "remove failed items" check into a conditional
 # and that's the branching
 # all nice and easy to look at
 # and easier to learn from too
 
+TASK_TIMEOUT_SECONDS = 600  # 10 minutes timeout, per key in execute_pipeline and per vote with parallel_votes
+
 
 class MajorityVoteStep(
     PipelineStep
@@ -38,6 +38,7 @@ class MajorityVoteStep(
         vote_count_needed=1,
         percent_true_to_pass=0.5,
         validation_function=lambda x, y: {"result": True, "message": "default message"},
+        parallel_votes=False,  # generate all missing votes for a key at once (each one takes its own slot from rtwl, which must accept a timeout= keyword) and cancel the rest once the verdict is decided
         **kwargs,
     ):
         # print(f"[DEBUG MajorityVoteStep __init__] Initializing MajorityVoteStep.")
@@ -45,6 +46,7 @@ class MajorityVoteStep(
         self.vote_count_needed = vote_count_needed
         self.percent_true_to_pass = percent_true_to_pass
         self.final_determination_key = final_determination_key
+        self.parallel_votes = parallel_votes
         super().__init__(
             prompt_path=prompt_path,
             regex=regex,
@@ -68,9 +70,26 @@ class MajorityVoteStep(
         if len(current_votes) >= self.vote_count_needed:
             # print(f"[DEBUG MajorityVoteStep read_previous_output] Vote count needed ({self.vote_count_needed}) met for key='{key}'. Returning True.")
             return True, current_votes
+        if self.parallel_votes and self.verdict_is_decided(current_votes):
+            return True, current_votes  # stopped early last time; the missing votes could not have changed anything
         # print(f"[DEBUG MajorityVoteStep read_previous_output] Vote count needed ({self.vote_count_needed}) not met for key='{key}'. Returning False.")
         return False, current_votes  # get the votes so far
 
+    def verdict_is_decided(self, current_votes):
+        # True once the remaining votes can no longer flip the outcome of evaluate_final_count_and_save.
+        # If it would pass even if every remaining vote were False, the judgement on the partial votes is a pass too, and the same goes for failing, so evaluating early gives the same verdict as evaluating all votes.
+        true_count = sum(1 for vote in current_votes if vote)
+        remaining = self.vote_count_needed - len(current_votes)
+        if remaining <= 0:
+            return True
+        passes_at_worst = (
+            true_count / self.vote_count_needed
+        ) >= self.percent_true_to_pass
+        fails_at_best = (
+            (true_count + remaining) / self.vote_count_needed
+        ) < self.percent_true_to_pass
+        return passes_at_worst or fails_at_best
+
     def save(
         self,
         result,
@@ -115,6 +134,7 @@ class MajorityVoteStep(
             # print(f"[DEBUG MajorityVoteStep save] Appended details. New details count for key='{key}': {len(entry[self.details_key])}.")
 
         input_dict[str(key)] = entry
+        self.record(key, entry)
         # print(f"[DEBUG MajorityVoteStep save] Saved entry for key='{key}'.")
 
         return entry
@@ -162,10 +182,106 @@ class MajorityVoteStep(
         input_dict[str(key)] = (
             entry  # where before we kept this up to date with the xisting data, now it IS the existing data. Much simpler eh?
         )
+        self.record(key, entry)
         # print(f"[DEBUG MajorityVoteStep evaluate_final_count_and_save] Updated entry in input_dict for key='{key}'.")
 
         return judgement
 
+    async def generate_vote(
+        self,
+        processed_data,
+        additional_kwargs,
+        input_data,
+        engine_wrapper,
+        full_prompt_path,
+        prompt_folder,
+        default_prompt_folder,
+        completion_mode,
+        use_stop,
+        vote_index=0,
+        **kwargs,
+    ):  # one vote, with validation retries. Returns (result, full_response, full_input), or None if every attempt failed.
+        error_message = ""
+        attempt = 0
+        while attempt < self.max_retries:
+            attempt += 1
+            # print(f"[DEBUG MajorityVoteStep run] Generation attempt {attempt}/{self.max_retries}.")
+            try:
+                result, full_output, full_response, full_input = (
+                    await self.generate_data(
+                        processed_data,
+                        engine_wrapper,
+                        full_prompt_path,
+                        prompt_folder,
+                        default_prompt_folder,
+                        completion_mode,
+                        use_stop,
+                        error_message=error_message,
+                        cache_variant=[vote_index, attempt - 1],
+                        **kwargs,
+                        **additional_kwargs,
+                    )
+                )
+                # print(f"[DEBUG MajorityVoteStep run] generate_data returned. Result: {result}.")
+                validation_result = self.validation_function(result, input_data)
+                if validation_result["result"]:
+                    return result, full_response, full_input
+                error_message = validation_result["message"]
+            except Exception as e:
+                # print(f"[DEBUG MajorityVoteStep run] Exception during generate_data, attempt {attempt}: {e}")
+                error_message = str(e)
+                traceback.print_exc()
+        return None
+
+    async def generate_vote_in_slot(self, vote_index, vote_kwargs, rtwl):
+        # one vote in its own rtwl slot, with the step's own timeout instead of rtwl's default. rtwl either returns None (setup_semaphore_and_engines') or raises (make_run_task_with_limit's) when the vote timed out or crashed, which says nothing about the answer, so the vote is tried again. Only a vote whose every validation attempt failed fails the key, as in the sequential loop.
+        async def tagged_vote():
+            return (await self.generate_vote(vote_index=vote_index, **vote_kwargs),)
+
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                outcome = await rtwl(tagged_vote(), timeout=TASK_TIMEOUT_SECONDS)
+            except Exception as e:
+                print(f"[Error] Exception in vote: {e}")
+                outcome = None
+            if outcome is not None:
+                return outcome[0]
+            print(
+                f"Vote {vote_index} for step '{self.output_file}' did not finish (attempt {attempt}/{self.max_retries})."
+            )
+        return None
+
+    async def generate_votes_in_parallel(
+        self, needed_generations, vote_kwargs, save_vote, key, input_dict, rtwl=None
+    ):  # returns False if a vote failed outright, like the sequential loop does
+        pending = set()
+        first_index = self.vote_count_needed - needed_generations
+        for vote_index in range(first_index, self.vote_count_needed):
+            if rtwl:
+                vote_coroutine = self.generate_vote_in_slot(vote_index, vote_kwargs, rtwl)
+            else:
+                vote_coroutine = self.generate_vote(vote_index=vote_index, **vote_kwargs)
+            pending.add(asyncio.ensure_future(vote_coroutine))
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    vote = future.result()
+                    if vote is None:
+                        return False
+                    save_vote(vote)
+                _, current_votes = await self.read_previous_output(key, input_dict)
+                if self.verdict_is_decided(current_votes):
+                    return True
+            return True
+        finally:
+            # the verdict is settled (or the key failed): the outstanding calls are wasted tokens
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
     async def run(
         self,
         key,
@@ -178,6 +294,7 @@ class MajorityVoteStep(
         include_details,
         completion_mode,
         use_stop,
+        rtwl=None,  # only used with parallel_votes, where each vote takes its own slot instead of the whole key taking one
         **kwargs,
     ):
 
@@ -206,75 +323,27 @@ class MajorityVoteStep(
 
         processed_data, additional_kwargs = self.process_input_data(input_data)
         # print(f"[DEBUG MajorityVoteStep run] Processed input data for key='{key}'.")
-        existing_variations = []
-
-        # Check existing variations using key
-        output_path = self.make_output_path(output_dir)
-        # print(f"[DEBUG MajorityVoteStep run] Checking for existing variations in file: '{output_path}' for key='{key}'.")
-        try:
-            # print(f"[DEBUG MajorityVoteStep run] Acquired lock for '{output_path}.lock'. Reading file.")
-            try:
-                with open(output_path, "r", encoding="utf-8") as f:
-                    existing_data = json.load(f)
-                    existing_variations = existing_data.get(str(key), {}).get(
-                        self.result_key, []
-                    )
-                    # print(f"[DEBUG MajorityVoteStep run] Loaded {len(existing_variations)} existing variations from file for key='{key}'.")
-            except (FileNotFoundError, json.JSONDecodeError) as e:
-                # print(f"[DEBUG MajorityVoteStep run] File '{output_path}' not found or JSON error for key='{key}': {e}. Starting with 0 existing variations.")
-                pass  # No existing data is fine
-        except Exception as e:
-            print(
-                f"[DEBUG MajorityVoteStep run] Error during file lock/read for '{output_path}': {e}"
-            )
-            # Decide if we should continue or raise
+        # Votes collected so far are already in memory: load_dataset put the saved entry into input_dict and save() appends to it. No need to touch the output file here.
+        existing_variations = current_votes
 
         # Generate remaining variations (it is in a loop we generate like random variations does)
         needed_generations = self.vote_count_needed - len(existing_variations)
         # print(f"[DEBUG MajorityVoteStep run] Need to generate {needed_generations} more votes for key='{key}' (Have {len(existing_variations)}, Need {self.vote_count_needed}).")
-        for i in range(len(existing_variations), self.vote_count_needed):
-            # print(f"[DEBUG MajorityVoteStep run] Starting generation loop iteration {i+1}/{self.vote_count_needed} for key='{key}'.")
-            error_message = ""
-            complete = False
-            attempt = 0
-            current_max_retries = self.max_retries
-            while not complete and attempt < current_max_retries:
-                attempt += 1
-                # print(f"[DEBUG MajorityVoteStep run] Generation attempt {attempt}/{current_max_retries} for key='{key}', iteration {i+1}.")
-                try:
-                    result, full_output, full_response, full_input = (
-                        await self.generate_data(
-                            processed_data,
-                            engine_wrapper,
-                            full_prompt_path,
-                            prompt_folder,
-                            default_prompt_folder,
-                            completion_mode,
-                            use_stop,
-                            error_message=error_message,
-                            **kwargs,
-                            **additional_kwargs,
-                        )
-                    )
-                    # print(f"[DEBUG MajorityVoteStep run] generate_data returned for key='{key}'. Result: {result}.")
-                    validation_result = self.validation_function(result, input_data)
-                    if validation_result["result"]:
-                        # print(f"[DEBUG MajorityVoteStep run] Validation function passed for key='{key}'.")
-                        complete = True
-                    else:
-                        # print(f"[DEBUG MajorityVoteStep run] Validation function failed for key='{key}'.")
-                        error_message = validation_result["message"]
-                        pass  # Explicitly do nothing if validation fails
-                except Exception as e:
-                    # print(f"[DEBUG MajorityVoteStep run] Exception during generate_data for key='{key}', attempt {attempt}: {e}")
-                    error_message = str(e)
-                    traceback.print_exc()
-
-            if not complete:
-                # print(f"[DEBUG MajorityVoteStep run] Failed to generate a valid result after {current_max_retries} attempts for key='{key}'. Returning.")
-                return  # Stop processing this key if generation failed
+        vote_kwargs = dict(
+            processed_data=processed_data,
+            additional_kwargs=additional_kwargs,
+            input_data=input_data,
+            engine_wrapper=engine_wrapper,
+            full_prompt_path=full_prompt_path,
+            prompt_folder=prompt_folder,
+            default_prompt_folder=default_prompt_folder,
+            completion_mode=completion_mode,
+            use_stop=use_stop,
+            **kwargs,
+        )
 
-            # print(f"[DEBUG MajorityVoteStep run] Generation successful for key='{key}', iteration {i+1}. Saving result.")
+        def save_vote(vote):
+            result, full_response, full_input = vote
             self.save(
                 result=result,
                 key=key,
@@ -285,7 +354,24 @@ class MajorityVoteStep(
                 include_details=include_details,
                 completion_mode=completion_mode,
             )
-            # print(f"[DEBUG MajorityVoteStep run] Saved result for key='{key}', iteration {i+1}.")
+
+        if self.parallel_votes:
+            decided = await self.generate_votes_in_parallel(
+                needed_generations, vote_kwargs, save_vote, key, input_dict, rtwl
+            )
+            if not decided:
+                return  # Stop processing this key if generation failed
+        else:
+            for i in range(len(existing_variations), self.vote_count_needed):
+                # print(f"[DEBUG MajorityVoteStep run] Starting generation loop iteration {i+1}/{self.vote_count_needed} for key='{key}'.")
+                vote = await self.generate_vote(vote_index=i, **vote_kwargs)
+                if vote is None:
+                    # print(f"[DEBUG MajorityVoteStep run] Failed to generate a valid result after {self.max_retries} attempts for key='{key}'. Returning.")
+                    return  # Stop processing this key if generation failed
+
+                # print(f"[DEBUG MajorityVoteStep run] Generation successful for key='{key}', iteration {i+1}. Saving result.")
+                save_vote(vote)
+                # print(f"[DEBUG MajorityVoteStep run] Saved result for key='{key}', iteration {i+1}.")
 
         # print(f"[DEBUG MajorityVoteStep run] Finished generation loop for key='{key}'.")
         # Re-check current votes after potential generation
@@ -324,6 +410,7 @@ class MajorityVoteStep(
         # print(f"[DEBUG MajorityVoteStep execute_pipeline] Starting execute_pipeline. Output dir: '{output_dir}'. Initial input_dict size: {len(input_dict)}.")
         # print(f"[DEBUG MajorityVoteStep execute_pipeline] Loading dataset...")
         self.load_dataset(input_dict=input_dict, output_dir=output_dir)
+        self.open_journal(output_dir)
         # print(f"[DEBUG MajorityVoteStep execute_pipeline] Dataset loaded. input_dict size: {len(input_dict)}.")
         num_tasks = len(input_dict)
         # print(f"[DEBUG MajorityVoteStep execute_pipeline] Creating {num_tasks} run tasks.")
@@ -340,14 +427,18 @@ class MajorityVoteStep(
                     completion_mode=completion_mode,
                     use_stop=use_stop,
                     include_details=include_details,
+                    rtwl=rtwl if self.parallel_votes else None,
                     **kwargs,
                 )
-                for key, value in input_dict.items()
+                for key, value in self.dispatch_order(input_dict.items())
             ]
-            coroutines = [rtwl(task) for task in data_generations_tasks]
+            if self.parallel_votes:
+                # the votes inside each run() go through rtwl themselves; wrapping run() as well would hold a slot while waiting for more slots
+                coroutines = data_generations_tasks
+            else:
+                coroutines = [rtwl(task) for task in data_generations_tasks]
             # print(f"[DEBUG MajorityVoteStep execute_pipeline] Submitting {len(coroutines)} tasks to rate limited wrapper.")
             # Adding progress tracking
-            TASK_TIMEOUT_SECONDS = 600  # 10 minutes timeout
             completed_tasks = 0
             num_tasks = len(coroutines)  # Use pre-calculated num_tasks
             for future in tqdmasyncio.tqdm.as_completed(coroutines):
@@ -376,7 +467,10 @@ class MajorityVoteStep(
         finally:
             # print(f"[DEBUG MajorityVoteStep execute_pipeline] Entering finally block.")
             # print(f"[DEBUG MajorityVoteStep execute_pipeline] Saving dataset. Current input_dict size: {len(input_dict)}.")
-            self.save_dataset(input_dict=input_dict, output_dir=output_dir)
+            try:
+                self.save_dataset(input_dict=input_dict, output_dir=output_dir)
+            finally:
+                self.close_journal(output_dir)
             # print(f"[DEBUG MajorityVoteStep execute_pipeline] Dataset saved.")
 
         # print(f"[DEBUG MajorityVoteStep execute_pipeline] Filtering out non-present keys using key '{self.result_key}'. Current input_dict size: {len(input_dict)}.")
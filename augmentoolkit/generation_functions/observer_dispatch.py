@@ -0,0 +1,82 @@
+import asyncio
+import atexit
+import queue
+import threading
+import traceback
+
+# Observers (token counters, the debug output log) used to run inline in submit_completion/submit_chat, on the event loop thread, so every file they wrote and every prompt they tokenized was added to the latency of the request and stalled every other coroutine in flight.
+# EngineWrapper now hands each request's observer calls to a queue that one worker thread drains, several requests at a time and strictly in order. The queue is bounded: if the observers fall behind, the request that wants to enqueue waits (without blocking the event loop) instead of the backlog growing without limit.
+# flush_observers() waits until everything queued so far has run. Cost reports call it before reading the token counters, and it runs again at exit so that nothing queued is lost.
+
+OBSERVER_QUEUE_SIZE = 10000  # requests' worth of observer calls
+OBSERVER_BATCH_SIZE = 256  # requests handled per wake-up of the worker
+
+
+class ObserverDispatcher:
+    def __init__(self, maxsize=OBSERVER_QUEUE_SIZE, batch_size=OBSERVER_BATCH_SIZE):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        self.errors = 0
+        self.backpressure_waits = 0
+
+    def ensure_worker(self):
+        with self.thread_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.work, name="observer-dispatch", daemon=True
+                )
+                self.thread.start()
+
+    def work(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for calls in batch:
+                self.run(calls)
+                self.queue.task_done()
+
+    def run(self, calls):
+        for observer, args, kwargs in calls:
+            try:
+                observer(*args, **kwargs)
+            except Exception:
+                # a broken observer must not take the others (or the worker) down with it
+                self.errors += 1
+                traceback.print_exc()
+
+    async def dispatch(self, calls):
+        """calls is a list of (observer, args, kwargs), run in order on the worker thread."""
+        if not calls:
+            return
+        self.ensure_worker()
+        try:
+            self.queue.put_nowait(calls)
+        except queue.Full:
+            self.backpressure_waits += 1
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.queue.put, calls
+            )
+
+    def flush(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+
+_dispatcher = ObserverDispatcher()
+
+
+async def dispatch_observers(calls):
+    await _dispatcher.dispatch(calls)
+
+
+def flush_observers():
+    _dispatcher.flush()
+
+
+atexit.register(flush_observers)
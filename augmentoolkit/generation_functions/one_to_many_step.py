@@ -10,6 +10,10 @@ import time  # Added for timestamping logs
 import asyncio  # Add asyncio import
 
 from augmentoolkit.generation_functions.pipeline_step_class import PipelineStep
+from augmentoolkit.generation_functions.step_journal import (
+    replay_journal,
+    truncate_journal,
+)
 from filelock import FileLock
 
 # Try importing pyfiglet for banners, provide fallback
@@ -91,13 +95,33 @@ class OneToManyStep(
             **kwargs,
         )
         self.input_file = input_file
+        # parent key -> keys of the items generated from it. Built once per output dict and kept up to date by save(), so resume checks do not scan every output key for every input key.
+        self.children_index = {}
+        self._indexed_dict = None
         # print(f"[DEBUG] OneToManyStep.__init__: Initialization complete for '{output_file}'.") # DEBUG
 
+    def build_children_index(self, output_dict):
+        self.children_index = {}
+        self._indexed_dict = output_dict
+        for item_key in output_dict.keys():
+            self._index_child(item_key)
+
+    def _index_child(self, item_key):
+        # item keys look like f"{key}-{idx}-{item_hash}", and the parent key may itself contain dashes
+        parts = str(item_key).rsplit("-", 2)
+        if len(parts) == 3:
+            self.children_index.setdefault(parts[0], []).append(item_key)
+
+    def child_keys(self, key, output_dict):
+        # keys of the items that were generated from the input item at `key`
+        if output_dict is not self._indexed_dict:
+            self.build_children_index(output_dict)
+        return [k for k in self.children_index.get(str(key), []) if k in output_dict]
+
     async def read_previous_output(self, key, output_dict):
         # print(f"[DEBUG {time.time():.2f}] read_previous_output: Checking for key '{key}' or prefix '{key}-' in output_dict (size {len(output_dict)}).") # DEBUG
         # Check if any keys start with this key followed by separator in the in-memory dict
-        key_prefix = str(key) + "-"
-        matching_entries = [k for k in output_dict.keys() if k.startswith(key_prefix)]
+        matching_entries = self.child_keys(key, output_dict)
         if matching_entries:
             # print(f"[DEBUG {time.time():.2f}] read_previous_output: Found {len(matching_entries)} existing entries for key prefix '{key}-'. Skipping generation.") # DEBUG
             # No need to load from file, data should already be in output_dict if loaded
@@ -168,6 +192,9 @@ class OneToManyStep(
             # print(f"[DEBUG {time.time():.2f}] save: Generated item_key: {item_key}") # DEBUG
             # print(f"Generated item_key: {item_key}")
 
+            if output_dict is self._indexed_dict and str(item_key) not in output_dict:
+                self._index_child(str(item_key))
+
             # Create new entry with ALL original data plus the new result
             output_dict[str(item_key)] = (
                 input_data.copy()
@@ -186,6 +213,8 @@ class OneToManyStep(
                 # print(f"[DEBUG {time.time():.2f}] save: Added details payload under key '{self.details_key}' for item_key '{item_key}'.") # DEBUG
                 # print(f"Added details to output_dict with key: {self.details_key}")
 
+            self.record(item_key, output_dict[str(item_key)])
+
             # Removed file writing logic for each item
 
         # Removed logic that modified the input_file/input_dict for details
@@ -234,6 +263,8 @@ class OneToManyStep(
             # Ensure directory exists even if file doesn't
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
             # print(f"[DEBUG {time.time():.2f}] load_dataset: Ensured directory '{os.path.dirname(output_path)}' exists.") # DEBUG
+        replay_journal(output_dict, output_path)
+        self.build_children_index(output_dict)
 
     def save_dataset(self, output_dict, output_dir):
         output_path = self.make_output_path(output_dir=output_dir)
@@ -304,6 +335,7 @@ class OneToManyStep(
                 os.replace(temp_output_path, output_path)  # Atomic rename/replace
                 # print(f"[DEBUG {time.time():.2f}] save_dataset: Atomic replace successful.") # DEBUG
                 save_successful = True
+                truncate_journal(output_path)
             except Exception as write_error:
                 # print(f"[DEBUG {time.time():.2f}] save_dataset: ERROR during file write/replace: {write_error}") # DEBUG
                 print(
@@ -411,6 +443,7 @@ class OneToManyStep(
                         completion_mode=completion_mode,
                         use_stop=use_stop,
                         error_message=error_message,
+                        cache_variant=self.max_retries - retries_left,
                         **kwargs,
                         **additional_kwargs,
                     )
@@ -483,6 +516,7 @@ class OneToManyStep(
         output_dict = {}  # Initialize the dictionary for this step's results
         # print(f"[DEBUG {time.time():.2f}] execute_pipeline: Loading dataset for '{self.output_file}'.") # DEBUG
         self.load_dataset(output_dict, output_dir)  # Load existing data at the start
+        self.open_journal(output_dir)
         # print(f"[DEBUG {time.time():.2f}] execute_pipeline: Dataset loaded. Current output_dict size: {len(output_dict)}.") # DEBUG
 
         try:
@@ -579,7 +613,10 @@ class OneToManyStep(
             )
             # Robust save called in finally block
             filter_out_nonpresent_keys(output_dict, key_to_check=self.result_key)
-            self.save_dataset(output_dict, output_dir)
+            try:
+                self.save_dataset(output_dict, output_dir)
+            finally:
+                self.close_journal(output_dir)
             # print(f"[DEBUG {time.time():.2f}] execute_pipeline: FINALLY block complete after save_dataset call.") # DEBUG
 
         # print(f"[DEBUG {time.time():.2f}] execute_pipeline: Execution finished for step '{self.output_file}'. Returning output_dict with {len(output_dict)} items.") # DEBUG
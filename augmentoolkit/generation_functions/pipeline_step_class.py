@@ -1,4 +1,5 @@
 from tqdm import asyncio as tqdmasyncio
+import hashlib
 import json
 import logging
 import os
@@ -9,6 +10,12 @@ import time
 import traceback
 import asyncio
 from augmentoolkit.generation_functions.generation_step_class import GenerationStep
+from augmentoolkit.generation_functions.step_journal import (
+    close_journal,
+    open_journal,
+    replay_journal,
+    truncate_journal,
+)
 
 from augmentoolkit.utils.random import noop
 
@@ -57,6 +64,9 @@ def load_dataset_func(input_dict, output_path):
         # Mutate input_dict to contain file_contents
         input_dict.update(file_contents)
 
+    # whatever was completed after the last consolidated save (or before a crash) lives in the journal
+    replay_journal(input_dict, output_path)
+
 
 def save_dataset(input_dict, output_path):
     interrupt_count = 0
@@ -128,6 +138,8 @@ def save_dataset(input_dict, output_path):
                     pass
         # --- Critical operation finished ---
         save_successful = True
+        # the consolidated file now holds everything the journal did
+        truncate_journal(output_path)
     except Exception as e:
         print(f"\nAn error occurred during dataset save: {e}", file=sys.stderr)
         traceback.print_exc()
@@ -181,6 +193,9 @@ class PipelineStep:
         validation_function=lambda x, y: {"result": True, "message": "default message"},
         max_retries=3,
         log_full_outputs=False,
+        cache_responses=False,  # replay identical requests from the engine wrapper's response cache (see response_cache.py) instead of paying for them again
+        stream_responses=None,  # True/False overrides the engine wrapper's stream setting for this step's requests
+        prefix_key=None,  # input field holding the long context that this step's prompts start with (e.g. "text"). Items with the same value are dispatched one after another and pinned to one endpoint, so the server's prefix cache gets reused
         **kwargs,  # Anything run time gets passed into .run() instead of the class at initialization. The only other thing I may have to add to that list are the static arguments.
     ):  # things that are args here are things that would be in the code. Some of these will be live-tweakable.
         self.prompt_path = prompt_path
@@ -196,6 +211,10 @@ class PipelineStep:
         self.static_arguments = kwargs  # any additional arguments are passed in during generation time. Fits the role of stuff read from the config, like special instructions.
         self.details_key = details_key
         self.input_processor = input_processor
+        self.cache_responses = cache_responses
+        self.stream_responses = stream_responses
+        self.prefix_key = prefix_key
+        self.journal = None  # opened for the duration of execute_pipeline; see step_journal.py
 
         # Handle method overrides
         if method_overrides:
@@ -213,6 +232,39 @@ class PipelineStep:
         """Returns full path to the consolidated JSON file"""
         return os.path.join(output_dir, f"{self.output_file}.json")
 
+    def prefix_hint(self, input_data):
+        # the same hint for every item whose prompt shares the prefix_key context; None when the step has no prefix_key
+        if not self.prefix_key or not isinstance(input_data, dict):
+            return None
+        value = input_data.get(self.prefix_key)
+        if value is None:
+            return None
+        return hashlib.sha1(str(value).encode("utf-8")).hexdigest()[:16]
+
+    def dispatch_order(self, items):
+        """Orders (key, entry) pairs so that entries sharing a prefix hint are next to each other, groups in the order they first appear. Without a prefix_key the order is unchanged."""
+        items = list(items)
+        if not self.prefix_key:
+            return items
+        group_rank = {}
+        ranks = []
+        for _, entry in items:
+            ranks.append(group_rank.setdefault(self.prefix_hint(entry), len(group_rank)))
+        order = sorted(range(len(items)), key=ranks.__getitem__)  # stable, so each group keeps its own order
+        return [items[index] for index in order]
+
+    def open_journal(self, output_dir):
+        self.journal = open_journal(self.make_output_path(output_dir))
+
+    def close_journal(self, output_dir):
+        close_journal(self.make_output_path(output_dir))
+        self.journal = None
+
+    def record(self, key, entry):
+        # append the finished entry to the write-ahead journal so it survives a crash before the next consolidated save
+        if self.journal is not None:
+            self.journal.append(key, entry)
+
     def read_previous_output(self, key, output_dict):
         entry = output_dict.get(str(key), {})
         # Check if result key exists in existing entry
@@ -234,6 +286,7 @@ class PipelineStep:
         default_prompt_folder,
         completion_mode,
         use_stop,
+        cache_variant=None,  # which attempt (and vote/variation) this is, so cached responses replay in the same order
         **kwargs,
     ):
         try:
@@ -250,6 +303,10 @@ class PipelineStep:
                 use_stop=use_stop,
                 prompt_folder=prompt_folder,
                 regex=self.regex,
+                cache_responses=self.cache_responses,
+                cache_variant=cache_variant,
+                stream=self.stream_responses,
+                prefix_hint=self.prefix_hint(processed_data),
             )
 
             # print(processed_data)
@@ -288,6 +345,7 @@ class PipelineStep:
             ]
 
         input_dict[str(key)] = input_data
+        self.record(key, input_data)
         return input_data
 
     async def run(
@@ -333,6 +391,7 @@ class PipelineStep:
                         completion_mode,
                         use_stop,
                         error_message=error_message,
+                        cache_variant=self.max_retries - max_retries,
                         **kwargs,
                         **additional_args_dict,
                     )
@@ -390,7 +449,8 @@ class PipelineStep:
         self.load_dataset(
             input_dict=input_dict, output_dir=output_dir
         )  # if it is at the start and end of every pipeline execution, we get the same behavior as before, past thing will load and save just fine, without constant reads/writes.
-        
+        self.open_journal(output_dir)
+
         task_completed_successfully = False
         try:
             data_generations_tasks = [
@@ -406,7 +466,7 @@ class PipelineStep:
                     include_details=include_details,
                     **kwargs,
                 )
-                for key, value in input_dict.items()
+                for key, value in self.dispatch_order(input_dict.items())
             ]
             coroutines = [rtwl(task) for task in data_generations_tasks]
             TASK_TIMEOUT_SECONDS = 600  # 10 minutes timeout
@@ -437,7 +497,10 @@ class PipelineStep:
             # Robust save with interrupt handling
             if task_completed_successfully:
                 filter_out_nonpresent_keys(input_dict, key_to_check=self.result_key)
-            self.save_dataset(input_dict=input_dict, output_dir=output_dir)
+            try:
+                self.save_dataset(input_dict=input_dict, output_dir=output_dir)
+            finally:
+                self.close_journal(output_dir)
 
 
 # we don't want failed items biting us later. Mind, this may not be a complete solution, since other things reading from the file might screw us. Hmm there is clearly a bug case, where on the next step as it iterates through keys it will also iterate through keys that failed and supply things with insufficient context. And you know what the solution is? A filter out failed items dict baked into every execute pipeline. Since if the output key does not exist in the item at this key, then it failed, and it should be dropped.
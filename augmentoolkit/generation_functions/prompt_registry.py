@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+
+import yaml
+
+from augmentoolkit.generation_functions.safe_formatter import SafeFormatter, safe_format
+
+# Process-wide cache of prompt files. GenerationStep used to resolve the prompt path, read the file, yaml.safe_load it and re-scan every message for {placeholders} on every single generation. Prompts are now loaded once per (prompt folder, default folder, path, mode), split into a substitution plan once, and only re-read when the file's mtime changes.
+
+MTIME_CHECK_INTERVAL = 1.0  # seconds between stat() calls for the same prompt
+
+_registry = {}
+_registry_lock = threading.Lock()
+_formatter = SafeFormatter()
+
+
+def compile_template(template):
+    """Pre-parses a format string into [(literal, field_name, format_spec, conversion)], or returns None if it needs the general SafeFormatter path (positional or attribute fields, nested specs, malformed braces...)."""
+    if not isinstance(template, str):
+        return None
+    try:
+        plan = list(_formatter.parse(template))
+    except ValueError:
+        return None
+    for literal, field_name, format_spec, conversion in plan:
+        if field_name is None:
+            continue
+        if not field_name.isidentifier() or (format_spec and "{" in format_spec):
+            return None
+    return plan
+
+
+def render_template(template, plan, **kwargs):
+    # same output as safe_format(template, **kwargs): missing keys are left in place as {key}
+    if plan is None:
+        return safe_format(template, **kwargs)
+    try:
+        parts = []
+        for literal, field_name, format_spec, conversion in plan:
+            if literal:
+                parts.append(literal)
+            if field_name is None:
+                continue
+            value = kwargs.get(field_name, "{" + field_name + "}")
+            if conversion:
+                value = _formatter.convert_field(value, conversion)
+            parts.append(format(value, format_spec or ""))
+        return "".join(parts)
+    except Exception:
+        # let the general path produce exactly the result (or exception) it always has
+        return safe_format(template, **kwargs)
+
+
+class CompiledPrompt:
+    def __init__(self, path, completion_mode):
+        self.path = path
+        self.completion_mode = completion_mode
+        self.mtime = os.path.getmtime(path)
+        self.last_checked = time.monotonic()
+        with open(path, "r", encoding="utf-8", errors="ignore") as pf:
+            self.raw = pf.read()
+        if completion_mode:
+            self.plan = compile_template(self.raw)
+            self.messages = None
+        else:
+            self.plan = None
+            self.messages = [
+                (message, compile_template(message.get("content")))
+                for message in yaml.safe_load(self.raw)
+            ]
+
+    def format(self, **kwargs):
+        return render_template(self.raw, self.plan, **kwargs)
+
+    def format_messages(self, **kwargs):
+        new_messages = []
+        for message, plan in self.messages:
+            try:
+                new_messages.append(
+                    {
+                        "role": message["role"],
+                        "content": render_template(message["content"], plan, **kwargs),
+                    }
+                )
+            except Exception as e:
+                new_messages.append(
+                    {"role": message["role"], "content": message["content"]}
+                )
+        return new_messages
+
+    def is_stale(self):
+        now = time.monotonic()
+        if now - self.last_checked < MTIME_CHECK_INTERVAL:
+            return False
+        self.last_checked = now
+        try:
+            return os.path.getmtime(self.path) != self.mtime
+        except OSError:
+            return True
+
+
+def resolve_prompt_path(prompt_folder, default_prompt_folder, prompt_path):
+    # prompt overrides win over the default prompts; folders are relative to the repository root unless absolute
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    ideal_path = os.path.join(current_dir, "..", "..", prompt_folder, prompt_path)
+    if os.path.exists(ideal_path):
+        return ideal_path
+    return os.path.join(current_dir, "..", "..", default_prompt_folder, prompt_path)
+
+
+def get_prompt(prompt_folder, default_prompt_folder, prompt_path, completion_mode):
+    key = (prompt_folder, default_prompt_folder, prompt_path, bool(completion_mode))
+    compiled = _registry.get(key)
+    if compiled is not None and not compiled.is_stale():
+        return compiled
+    with _registry_lock:
+        path = resolve_prompt_path(prompt_folder, default_prompt_folder, prompt_path)
+        compiled = CompiledPrompt(path, completion_mode)
+        _registry[key] = compiled
+    return compiled
+
+
+def clear_prompt_registry():
+    with _registry_lock:
+        _registry.clear()
@@ -0,0 +1,78 @@
+import asyncio
+import contextvars
+from contextlib import contextmanager
+
+# rtwl's timeout is there to catch a task that hangs, not one that is waiting its turn. But with adaptive concurrency windows and RPM/TPM limits, a task can spend most of a minute queued inside its EngineWrapper before its request is even sent, and a plain asyncio.wait_for counts that against it, so under load tasks got dropped for doing nothing wrong.
+# wait_for_excluding_queue gives the task its own QueueClock (through a context variable, which the task and anything it spawns inherit). AdaptiveConcurrencyLimiter.acquire and RateLimiter.acquire wrap their waiting in queued(), and the deadline is pushed back by however long the task has been queued.
+
+_current_clock = contextvars.ContextVar("queue_clock", default=None)
+
+
+class QueueClock:
+    def __init__(self, parent=None):
+        self.parent = parent  # the clock of an enclosing wait_for_excluding_queue (e.g. the item a vote belongs to), which is queued whenever this one is
+        self.waited = 0.0
+        self.waiters = 0  # overlapping waits of one task (e.g. a hedged request) only count once
+        self.waiting_since = None
+
+    def start(self, now):
+        if self.waiters == 0:
+            self.waiting_since = now
+        self.waiters += 1
+
+    def stop(self, now):
+        self.waiters -= 1
+        if self.waiters == 0:
+            self.waited += now - self.waiting_since
+
+    def total(self, now):
+        if self.waiters:
+            return self.waited + now - self.waiting_since
+        return self.waited
+
+
+@contextmanager
+def queued():
+    # marks the enclosed waiting as queueing for the task's timeout; does nothing outside wait_for_excluding_queue
+    clocks = []
+    clock = _current_clock.get()
+    while clock is not None:
+        clocks.append(clock)
+        clock = clock.parent
+    if not clocks:
+        yield
+        return
+    loop = asyncio.get_running_loop()
+    for clock in clocks:
+        clock.start(loop.time())
+    try:
+        yield
+    finally:
+        for clock in clocks:
+            clock.stop(loop.time())
+
+
+async def wait_for_excluding_queue(coroutine, timeout):
+    """Like asyncio.wait_for, except that time spent in queued() does not count towards the timeout."""
+    if timeout is None:
+        return await coroutine
+    loop = asyncio.get_running_loop()
+    clock = QueueClock(parent=_current_clock.get())
+    token = _current_clock.set(clock)
+    try:
+        task = asyncio.ensure_future(coroutine)  # copies the current context, clock included
+    finally:
+        _current_clock.reset(token)
+    deadline = loop.time() + timeout
+    try:
+        while True:
+            remaining = deadline + clock.total(loop.time()) - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            done, _ = await asyncio.wait({task}, timeout=remaining)
+            if done:
+                return task.result()
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
@@ -36,6 +36,8 @@ class RandomVariationStep(
         log_full_outputs=False,
         method_overrides={},
         details_key=None,
+        cache_responses=False,
+        stream_responses=None,
     ):
         self.variation_generator_count = variation_generator_count
         super().__init__(
@@ -53,6 +55,8 @@ class RandomVariationStep(
             log_full_outputs=log_full_outputs,
             method_overrides=method_overrides,
             details_key=details_key,
+            cache_responses=cache_responses,
+            stream_responses=stream_responses,
         )
 
     async def read_previous_output(self, key, input_dict):
@@ -83,6 +87,7 @@ class RandomVariationStep(
         default_prompt_folder,
         completion_mode,
         use_stop,
+        cache_variant=None,
         **kwargs,
     ):
 
@@ -120,6 +125,9 @@ class RandomVariationStep(
                 use_stop=use_stop,
                 prompt_folder=prompt_folder,
                 regex=self.regex,
+                cache_responses=self.cache_responses,
+                cache_variant=cache_variant,
+                stream=self.stream_responses,
             )
 
             # Note: We don't log the actual return values here as they could be large
@@ -193,6 +201,7 @@ class RandomVariationStep(
             traceback.print_exc()
             raise
 
+        self.record(key, entry)
         return entry
 
     async def run(
@@ -246,6 +255,10 @@ class RandomVariationStep(
                             completion_mode,
                             use_stop,
                             error_message=error_message,
+                            cache_variant=[
+                                num_existing_in_memory + i,
+                                self.max_retries - max_retries,
+                            ],
                             **kwargs,
                             **additional_kwargs,
                         )
@@ -305,6 +318,7 @@ class RandomVariationStep(
         self.load_dataset(
             input_dict=input_dict, output_dir=output_dir
         )  # if it is at the start and end of every pipeline execution, we get the same behavior as before, past thing will load and save just fine, without constant reads/writes.
+        self.open_journal(output_dir)
         try:
             data_generations_tasks = [
                 self.run(
@@ -349,4 +363,7 @@ class RandomVariationStep(
             raise e
         finally:
             # Robust save with interrupt handling
-            self.save_dataset(input_dict=input_dict, output_dir=output_dir)
+            try:
+                self.save_dataset(input_dict=input_dict, output_dir=output_dir)
+            finally:
+                self.close_journal(output_dir)
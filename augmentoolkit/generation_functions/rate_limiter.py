@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+from augmentoolkit.generation_functions.queue_time import queued
+
+# Client-side requests-per-minute / tokens-per-minute limits for one EngineWrapper.
+# Providers enforce RPM and TPM quotas. When a stage starts, thousands of coroutines are released at once, so without a local limit the first burst runs straight into 429s and every failed request is a wasted retry. Each request now reserves one request and an estimate of its tokens from a pair of token buckets before it is sent, and the token reservation is corrected with the real size once the response is in.
+# Waiting callers are served strictly in arrival order (asyncio.Lock is FIFO), so a large request is not starved by a stream of small ones slipping past it.
+
+CHARS_PER_TOKEN = 4  # rough, but only used until the real size of the request is known
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def estimate_payload_tokens(payload):
+    # payload is a completion-mode prompt string, or a list of chat messages
+    if isinstance(payload, str):
+        return estimate_tokens(payload)
+    return sum(estimate_tokens(str(message.get("content", ""))) + 4 for message in payload)
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0  # refill per second
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self.refill()
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= amount
+
+    def give_back(self, amount):
+        # positive: the request was smaller than reserved. Negative: it was larger, and the debt delays the next callers.
+        self.refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, name="engine"):
+        self.name = name
+        self.request_bucket = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.turnstile = None  # created lazily, inside the event loop that uses it
+        self.time_waited = 0.0
+
+    async def acquire(self, estimated_tokens):
+        """Waits until the request fits in both buckets, then takes it out of them. Returns the number of tokens reserved, to be passed to reconcile()."""
+        if self.token_bucket:
+            # a request bigger than a whole minute of quota would otherwise wait forever
+            estimated_tokens = min(estimated_tokens, self.token_bucket.capacity)
+        else:
+            estimated_tokens = 0
+        if self.turnstile is None:
+            self.turnstile = asyncio.Lock()
+        with queued():  # all of this is waiting for quota, which does not count towards rtwl's timeout
+            async with self.turnstile:
+                while True:
+                    wait = 0.0
+                    if self.request_bucket:
+                        wait = max(wait, self.request_bucket.wait_time(1))
+                    if self.token_bucket:
+                        wait = max(wait, self.token_bucket.wait_time(estimated_tokens))
+                    if wait <= 0:
+                        break
+                    self.time_waited += wait
+                    await asyncio.sleep(wait)
+                if self.request_bucket:
+                    self.request_bucket.take(1)
+                if self.token_bucket:
+                    self.token_bucket.take(estimated_tokens)
+        return estimated_tokens
+
+    def reconcile(self, reserved_tokens, actual_tokens):
+        if self.token_bucket:
+            self.token_bucket.give_back(reserved_tokens - actual_tokens)
+
+    def metrics(self):
+        return {
+            "name": self.name,
+            "requests_available": (
+                self.request_bucket.level if self.request_bucket else None
+            ),
+            "tokens_available": self.token_bucket.level if self.token_bucket else None,
+            "seconds_waited": self.time_waited,
+        }
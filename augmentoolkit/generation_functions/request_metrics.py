@@ -0,0 +1,269 @@
+import bisect
+import json
+import os
+import threading
+import time
+import weakref
+from collections import Counter
+
+# Per-request metrics for every EngineWrapper, kept as histograms per (engine, model, step): time spent waiting for a rate-limit reservation and a concurrency slot, time to first token, total latency, output tokens per second, plus counts of requests, timeouts and errors by class (see transport_retry.classify_error).
+# These are what tell you whether a run is limited by our own concurrency (long queue waits), by the provider (long time to first token, 429s) or by generation itself, which is what concurrency_limit and the timeouts should be sized against.
+# The numbers live in this process. run_pipeline_config writes them to <output_dir>/request_metrics.json every METRICS_WRITE_INTERVAL seconds and at the end of the run, and the API's /metrics endpoint turns those files into OpenMetrics text.
+
+METRICS_FILENAME = "request_metrics.json"
+METRICS_WRITE_INTERVAL = 15.0
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 35, 50, 75, 100, 150, 200, 300, 500, 1000)
+
+HISTOGRAMS = {
+    "queue_wait_seconds": SECONDS_BUCKETS,
+    "ttft_seconds": SECONDS_BUCKETS,
+    "latency_seconds": SECONDS_BUCKETS,
+    "output_tokens_per_second": TOKENS_PER_SECOND_BUCKETS,
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket the quantile falls in; None if there are no observations, inf if it is past the last bucket
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self):
+        return {
+            "buckets": list(self.buckets),
+            "counts": list(self.counts),
+            "sum": self.sum,
+            "count": self.count,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class SeriesMetrics:
+    def __init__(self):
+        self.histograms = {name: Histogram(buckets) for name, buckets in HISTOGRAMS.items()}
+        self.requests = 0
+        self.timeouts = 0
+        self.errors = Counter()
+
+
+_series = {}  # (engine, model, step) -> SeriesMetrics
+_lock = threading.Lock()  # records come from the event loop, snapshots from the writer thread
+_engines = weakref.WeakSet()
+
+
+def register_engine(engine):
+    _engines.add(engine)
+
+
+def get_series(engine, model, step):
+    key = (str(engine), str(model), str(step) if step is not None else "")
+    series = _series.get(key)
+    if series is None:
+        series = SeriesMetrics()
+        _series[key] = series
+    return series
+
+
+def record_request(
+    engine,
+    model,
+    step,
+    queue_wait,
+    ttft,
+    latency,
+    service_time,
+    output_tokens,
+    timed_out,
+):
+    with _lock:
+        series = get_series(engine, model, step)
+        series.requests += 1
+        series.histograms["queue_wait_seconds"].observe(queue_wait)
+        if ttft is not None:
+            series.histograms["ttft_seconds"].observe(ttft)
+        series.histograms["latency_seconds"].observe(latency)
+        if output_tokens and service_time > 0:
+            series.histograms["output_tokens_per_second"].observe(
+                output_tokens / service_time
+            )
+        if timed_out:
+            series.timeouts += 1
+
+
+def record_error(engine, model, step, error_class):
+    with _lock:
+        get_series(engine, model, step).errors[error_class] += 1
+
+
+def reset_request_metrics():
+    with _lock:
+        _series.clear()
+
+
+def metrics_snapshot():
+    with _lock:
+        series = [
+            {
+                "engine": engine,
+                "model": model,
+                "step": step,
+                "requests": metrics.requests,
+                "timeouts": metrics.timeouts,
+                "errors": dict(metrics.errors),
+                "histograms": {
+                    name: histogram.to_dict()
+                    for name, histogram in metrics.histograms.items()
+                },
+            }
+            for (engine, model, step), metrics in _series.items()
+        ]
+    engines = []
+    for engine in list(_engines):
+        try:
+            engines.append(engine.runtime_stats())
+        except Exception as e:
+            print(f"[Metrics] could not read the stats of an engine: {e}")
+    return {"updated": time.time(), "series": series, "engines": engines}
+
+
+def write_metrics_summary(output_dir):
+    path = os.path.join(output_dir, METRICS_FILENAME)
+    os.makedirs(output_dir, exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(metrics_snapshot(), f, indent=2, default=str)
+    os.replace(temp_path, path)
+
+
+class MetricsSummaryWriter:
+    def __init__(self, output_dir, interval=METRICS_WRITE_INTERVAL):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.work, name="metrics-summary", daemon=True
+        )
+        self.thread.start()
+
+    def work(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            write_metrics_summary(self.output_dir)
+        except Exception as e:
+            print(f"[Metrics] could not write {METRICS_FILENAME}: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+
+def start_metrics_summary(output_dir, interval=METRICS_WRITE_INTERVAL):
+    """Writes the metrics summary to output_dir periodically until .stop() is called on the result, which writes it one last time."""
+    reset_request_metrics()
+    return MetricsSummaryWriter(output_dir, interval)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + "}"
+
+
+def format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def render_openmetrics(summaries, prefix="augmentoolkit"):
+    """summaries is a list of (extra_labels, summary) pairs, where summary is what metrics_snapshot() returns (or a request_metrics.json file). Returns OpenMetrics text."""
+    lines = []
+    families = {}  # family name -> (type, sample lines); kept in one block per family, as the format requires
+
+    def add(family, family_type, sample):
+        families.setdefault(family, (family_type, []))[1].append(sample)
+
+    for extra_labels, summary in summaries:
+        for series in summary.get("series", []):
+            labels = dict(extra_labels)
+            labels.update(
+                engine=series["engine"], model=series["model"], step=series["step"]
+            )
+            add(
+                f"{prefix}_requests",
+                "counter",
+                f"{prefix}_requests_total{format_labels(labels)} {series['requests']}",
+            )
+            add(
+                f"{prefix}_request_timeouts",
+                "counter",
+                f"{prefix}_request_timeouts_total{format_labels(labels)} {series['timeouts']}",
+            )
+            for error_class, count in series["errors"].items():
+                add(
+                    f"{prefix}_request_errors",
+                    "counter",
+                    f"{prefix}_request_errors_total{format_labels(dict(labels, error_class=error_class))} {count}",
+                )
+            for name, histogram in series["histograms"].items():
+                family = f"{prefix}_request_{name}"
+                cumulative = 0
+                for bound, count in zip(
+                    list(histogram["buckets"]) + [float("inf")], histogram["counts"]
+                ):
+                    cumulative += count
+                    add(
+                        family,
+                        "histogram",
+                        f"{family}_bucket{format_labels(dict(labels, le=format_bound(bound)))} {cumulative}",
+                    )
+                add(family, "histogram", f"{family}_sum{format_labels(labels)} {histogram['sum']}")
+                add(family, "histogram", f"{family}_count{format_labels(labels)} {histogram['count']}")
+        for engine in summary.get("engines", []):
+            concurrency = engine.get("concurrency")
+            if not concurrency:
+                continue
+            labels = dict(extra_labels)
+            labels.update(engine=engine["name"], model=engine["model"])
+            add(
+                f"{prefix}_concurrency_limit",
+                "gauge",
+                f"{prefix}_concurrency_limit{format_labels(labels)} {concurrency['current_limit']}",
+            )
+            add(
+                f"{prefix}_requests_in_flight",
+                "gauge",
+                f"{prefix}_requests_in_flight{format_labels(labels)} {concurrency['in_flight']}",
+            )
+
+    for family, (family_type, samples) in families.items():
+        lines.append(f"# TYPE {family} {family_type}")
+        lines.extend(samples)
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+# On-disk cache of LLM responses, keyed by a hash of everything that determines the response: model, the messages or prompt, and the sampling params. Re-running a pipeline after tweaking a downstream step, or after failed items were dropped, would otherwise send thousands of identical requests again.
+# The cache is opt-in per step (cache_responses=True on the PipelineStep) and only active when an EngineWrapper is given a ResponseCache. Every call also carries a "variant" -- which vote / variation / validation retry it is -- so that a step that samples several times from the same prompt replays each of its samples instead of getting the first one back N times, and a retry after a failed validation does not just replay the failure.
+
+DEFAULT_MAX_MB = 2048
+CACHED_SAMPLING_PARAMS = ["temperature", "top_p", "max_tokens", "stop", "min_p"]
+
+_open_caches = {}  # path -> ResponseCache, so that the small and large engine wrappers can share one database
+_open_caches_lock = threading.Lock()
+
+
+def make_cache_key(model, payload, sampling_params, completion_mode, variant=None):
+    keyed = {
+        "model": model,
+        "completion_mode": bool(completion_mode),
+        "payload": payload,  # the prompt string, or the list of messages
+        "sampling_params": {
+            name: sampling_params[name]
+            for name in CACHED_SAMPLING_PARAMS
+            if name in sampling_params
+        },
+        "variant": variant,
+    }
+    encoded = json.dumps(keyed, sort_keys=True, ensure_ascii=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path, max_mb=DEFAULT_MAX_MB):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = Counter()  # label (usually the prompt path) -> count
+        self.misses = Counter()
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, completion TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self.connection.commit()
+        self.total_bytes = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def get(self, key, label=None):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT completion FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses[label] += 1
+                return None
+            self.connection.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self.connection.commit()
+            self.hits[label] += 1
+            return row[0]
+
+    def put(self, key, completion):
+        size = len(completion.encode("utf-8"))
+        with self.lock:
+            previous = self.connection.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, completion, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, completion, size, time.time()),
+            )
+            self.total_bytes += size - (previous[0] if previous else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        # least recently used first, down to 90% of the bound so that eviction does not run on every single put
+        target = int(self.max_bytes * 0.9)
+        rows = self.connection.execute(
+            "SELECT key, size FROM responses ORDER BY last_used ASC"
+        )
+        to_delete = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            to_delete.append((key,))
+            self.total_bytes -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+
+    def stats(self):
+        labels = set(self.hits) | set(self.misses)
+        return {
+            "hits": sum(self.hits.values()),
+            "misses": sum(self.misses.values()),
+            "size_mb": round(self.total_bytes / (1024 * 1024), 2),
+            "by_label": {
+                str(label): {"hits": self.hits[label], "misses": self.misses[label]}
+                for label in labels
+            },
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        print(
+            f"Response cache {self.path}: {stats['hits']} hits, {stats['misses']} misses, {stats['size_mb']} MB"
+        )
+        for label, counts in sorted(stats["by_label"].items()):
+            print(f"  {label}: {counts['hits']} hits, {counts['misses']} misses")
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+def open_response_cache(path, max_mb=DEFAULT_MAX_MB):
+    path = os.path.abspath(path)
+    with _open_caches_lock:
+        cache = _open_caches.get(path)
+        if cache is None:
+            cache = ResponseCache(path, max_mb=max_mb)
+            _open_caches[path] = cache
+        return cache
@@ -0,0 +1,225 @@
+import io
+import json
+import os
+import re
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Append-only log of LLM calls, stored as a few large segment files instead of one file per call (which left millions of tiny files in debug_outputs/ on big runs, and made zipping and browsing outputs crawl).
+# Records are JSON lines. They are buffered and written out a frame at a time (FRAME_MAX_RECORDS lines, or whatever has piled up after FRAME_INTERVAL_SECONDS); with the optional zstandard package each frame is compressed as an independent zstd frame, so a segment is a valid .zst file that `zstd -d` can read, and without it segments are plain .jsonl.
+# Every segment has a small text index next to it with one line per frame: byte offset, byte length, number of the first record in the frame, record count. Scans don't need it; it is there to jump to a record, or to count records, without decompressing everything.
+# A segment is closed and a new one started after SEGMENT_MAX_BYTES. A crash loses at most the frame that was still buffered.
+
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+FRAME_MAX_RECORDS = 64
+FRAME_MAX_BYTES = 1024 * 1024
+FRAME_INTERVAL_SECONDS = 5.0
+COMPRESSION_LEVEL = 3
+
+SEGMENT_PATTERN = re.compile(r"^segment-(\d+)\.jsonl(\.zst)?$")
+
+_writers = {}  # directory -> SegmentedLogWriter
+_writers_lock = threading.Lock()
+
+
+def segment_name(number, compressed):
+    return f"segment-{number:06d}.jsonl" + (".zst" if compressed else "")
+
+
+def index_path_for(segment_path):
+    return re.sub(r"\.jsonl(\.zst)?$", ".idx", segment_path)
+
+
+def list_segments(directory):
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for filename in os.listdir(directory):
+        match = SEGMENT_PATTERN.match(filename)
+        if match:
+            segments.append((int(match.group(1)), os.path.join(directory, filename)))
+    return [path for _, path in sorted(segments)]
+
+
+class SegmentedLogWriter:
+    def __init__(self, directory, compress=True):
+        self.directory = directory
+        self.compressor = (
+            zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+            if compress and zstandard is not None
+            else None
+        )
+        os.makedirs(directory, exist_ok=True)
+        existing = list_segments(directory)
+        # a new run never appends to an old segment; it starts the next one
+        self.segment_number = (
+            int(SEGMENT_PATTERN.match(os.path.basename(existing[-1])).group(1))
+            if existing
+            else 0
+        )
+        self.file = None
+        self.index = None
+        self.records_in_segment = 0
+        self.pending = []
+        self.pending_bytes = 0
+        self.last_write = time.monotonic()
+        self.lock = threading.Lock()
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+        with self.lock:
+            self.pending.append(line)
+            self.pending_bytes += len(line)
+            if (
+                len(self.pending) >= FRAME_MAX_RECORDS
+                or self.pending_bytes >= FRAME_MAX_BYTES
+                or time.monotonic() - self.last_write >= FRAME_INTERVAL_SECONDS
+            ):
+                self.write_frame()
+
+    def open_next_segment(self):
+        self.close_segment()
+        self.segment_number += 1
+        path = os.path.join(
+            self.directory,
+            segment_name(self.segment_number, self.compressor is not None),
+        )
+        self.file = open(path, "ab")
+        self.index = open(index_path_for(path), "a", encoding="utf-8")
+        self.records_in_segment = 0
+
+    def write_frame(self):
+        # callers hold self.lock
+        self.last_write = time.monotonic()
+        if not self.pending:
+            return
+        if self.file is None or self.file.tell() >= SEGMENT_MAX_BYTES:
+            self.open_next_segment()
+        data = b"".join(self.pending)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        offset = self.file.tell()
+        self.file.write(data)
+        self.file.flush()
+        self.index.write(
+            f"{offset} {len(data)} {self.records_in_segment} {len(self.pending)}\n"
+        )
+        self.index.flush()
+        self.records_in_segment += len(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+
+    def flush(self):
+        with self.lock:
+            self.write_frame()
+
+    def close_segment(self):
+        if self.file is not None:
+            self.file.close()
+            self.index.close()
+            self.file = None
+            self.index = None
+
+    def close(self):
+        with self.lock:
+            self.write_frame()
+            self.close_segment()
+
+
+def get_log_writer(directory):
+    # every observer logging to the same directory shares one writer, so their records go into the same segments instead of clobbering each other
+    directory = os.path.abspath(directory)
+    with _writers_lock:
+        if directory not in _writers:
+            _writers[directory] = SegmentedLogWriter(directory)
+        return _writers[directory]
+
+
+def flush_log_writers():
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.flush()
+
+
+def read_index(segment_path):
+    """Returns the frames of a segment as (offset, length, first_record, record_count) tuples."""
+    frames = []
+    index_path = index_path_for(segment_path)
+    if not os.path.exists(index_path):
+        return frames
+    with open(index_path, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 4:  # a torn last line is skipped
+                frames.append(tuple(int(part) for part in parts))
+    return frames
+
+
+def decode_frame(segment_path, data):
+    if segment_path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError(
+                f"{segment_path} is zstd-compressed; pip install zstandard to read it"
+            )
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return [json.loads(line) for line in data.decode("utf-8").splitlines() if line]
+
+
+def iter_segment(segment_path):
+    if segment_path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError(
+                f"{segment_path} is zstd-compressed; pip install zstandard to read it"
+            )
+        with open(segment_path, "rb") as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                f, read_across_frames=True
+            )
+            lines = io.TextIOWrapper(reader, encoding="utf-8")
+            try:
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+            except (zstandard.ZstdError, json.JSONDecodeError) as e:
+                print(f"[Log] {segment_path} ends in a torn frame, stopping there: {e}")
+    else:
+        with open(segment_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"[Log] skipping a torn record at the end of {segment_path}")
+
+
+def iter_log_records(directory):
+    """Yields every record in the log, oldest first, without holding more than one frame in memory."""
+    for segment_path in list_segments(directory):
+        yield from iter_segment(segment_path)
+
+
+def count_log_records(directory):
+    return sum(
+        count
+        for segment_path in list_segments(directory)
+        for _, _, _, count in read_index(segment_path)
+    )
+
+
+def read_log_record(directory, position):
+    """Returns record number `position` (counting from 0 across all segments), reading only the frame it is in."""
+    for segment_path in list_segments(directory):
+        for offset, length, first_record, count in read_index(segment_path):
+            if position < count:
+                with open(segment_path, "rb") as f:
+                    f.seek(offset)
+                    return decode_frame(segment_path, f.read(length))[position]
+            position -= count
+    raise IndexError("log record index out of range")
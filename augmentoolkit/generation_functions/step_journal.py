@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Write-ahead journal for pipeline steps. Every completed key is appended to <output_file>.journal.jsonl as one line, so a crash in the middle of a step only loses the records that were not yet fsynced instead of every generation since the step started. On load the journal is replayed over the consolidated .json (last record for a key wins), and the consolidated save at the end of the step truncates it again.
+# The journal is only folded back into the .json at the end of a step. Consolidating every few thousand records meant rewriting the whole (possibly multi-GB) dict each time, on the event loop, which is quadratic over a step; the journal instead grows with the step's output and is replayed in one pass.
+# Appends are written and flushed on the event loop (a buffered write), but the fsyncs that make them durable run on a background thread, so a slow disk never stalls generation. Only the final sync when a journal is truncated or closed, once per step, waits for the disk.
+
+FSYNC_EVERY = 64  # records
+FSYNC_INTERVAL_SECONDS = 5.0
+
+_fsync_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal-fsync")
+
+_open_journals = {}  # journal path -> StepJournal. Steps that share an output file must share the journal too, or their records would interleave out of order.
+
+
+def journal_path_for(output_path):
+    return os.path.splitext(output_path)[0] + ".journal.jsonl"
+
+
+class StepJournal:
+    def __init__(
+        self,
+        path,
+        fsync_every=FSYNC_EVERY,
+        fsync_interval=FSYNC_INTERVAL_SECONDS,
+    ):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.lock = threading.Lock()  # keeps the fsync thread off the file while it is truncated or closed
+        self.pending_fsync = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+        if self.file.tell() > 0 and not _ends_with_newline(path):
+            self.file.write("\n")  # seal off a torn record from a crash so new records start on their own line
+
+    def append(self, key, value):
+        self.file.write(json.dumps({"key": str(key), "value": value}, ensure_ascii=True))
+        self.file.write("\n")
+        self.unsynced += 1
+        if (
+            self.unsynced >= self.fsync_every
+            or time.monotonic() - self.last_sync >= self.fsync_interval
+        ):
+            self.sync()
+
+    def sync(self):
+        if self.file.closed:
+            return
+        self.file.flush()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        # an fsync that is queued but has not started yet will cover what was just flushed
+        if self.pending_fsync is None or self.pending_fsync.running() or self.pending_fsync.done():
+            self.pending_fsync = _fsync_executor.submit(self.fsync)
+
+    def fsync(self):
+        with self.lock:
+            if not self.file.closed:
+                os.fsync(self.file.fileno())
+
+    def truncate(self):
+        # only called once the consolidated .json holds everything the journal did
+        with self.lock:
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def open_journal(output_path):
+    path = journal_path_for(output_path)
+    journal = _open_journals.get(path)
+    if journal is None or journal.file.closed:
+        journal = StepJournal(path)
+        _open_journals[path] = journal
+    return journal
+
+
+def close_journal(output_path):
+    journal = _open_journals.pop(journal_path_for(output_path), None)
+    if journal is not None:
+        journal.close()
+        if os.path.getsize(journal.path) == 0:
+            os.remove(journal.path)  # everything made it into the consolidated file
+
+
+def truncate_journal(output_path):
+    path = journal_path_for(output_path)
+    journal = _open_journals.get(path)
+    if journal is not None and not journal.file.closed:
+        journal.truncate()
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def replay_journal(input_dict, output_path):
+    """Applies the records of the journal next to output_path to input_dict. Returns how many records were applied."""
+    path = journal_path_for(output_path)
+    if not os.path.exists(path):
+        return 0
+    replayed = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a torn line from a crash mid-write; the records around it are intact
+                print(f"Skipping incomplete record in journal {path}")
+                continue
+            input_dict[record["key"]] = record["value"]
+            replayed += 1
+    if replayed:
+        print(f"Replayed {replayed} journal records from {path}")
+    return replayed
@@ -0,0 +1,301 @@
+import asyncio
+import itertools
+import sys
+import traceback
+from tqdm import asyncio as tqdmasyncio
+
+from augmentoolkit.generation_functions.majority_vote_step import MajorityVoteStep
+from augmentoolkit.generation_functions.one_to_many_step import OneToManyStep
+from augmentoolkit.generation_functions.pipeline_step_class import (
+    filter_out_nonpresent_keys,
+)
+from augmentoolkit.generation_functions.queue_time import (
+    queued,
+    wait_for_excluding_queue,
+)
+
+# execute_pipeline on its own is a barrier: every item has to finish a step before any item can start the next one. So the slowest few items of every stage hold the whole dataset up, and the semaphore sits half empty at each stage tail.
+# The streaming executor wires several steps together and pushes each item into the next step as soon as it is done with the current one. All stages share one concurrency budget (rtwl + a fixed number of workers), and items further down the chain get priority so that finished work leaves the graph as fast as possible instead of queueing behind thousands of fresh inputs.
+# Within a depth, items of steps with a prefix_key (see PipelineStep) are grouped by the context they share, oldest group first: the questions of one chunk go through the validators back to back instead of interleaved with every other chunk's, so the server's prefix cache still holds the chunk when the next request for it arrives.
+
+TASK_TIMEOUT_SECONDS = 600  # same per-item limit that execute_pipeline uses; time an item spends queued for an engine's concurrency window or rate limit is not counted
+
+
+def make_run_task_with_limit(semaphore):
+    # the rtwl the executor should be given. setup_semaphore_and_engines' rtwl times every task out after 60 s (queueing included) and turns errors into None, which here would silently drop every slow item; the executor applies task_timeout per item and reports errors itself, so this one only holds a slot
+    async def run_task_with_limit(task, timeout=None):
+        with queued():  # e.g. a vote waiting for a slot does not count against its item's timeout
+            await semaphore.acquire()
+        try:
+            return await wait_for_excluding_queue(task, timeout)
+        finally:
+            semaphore.release()
+
+    return run_task_with_limit
+
+
+class StreamingStage:
+    def __init__(
+        self,
+        name,
+        step,
+        engine_wrapper,
+        after=None,
+        passes=None,
+        transform=None,
+        depth=0,
+        **kwargs,  # passed through to step.run, so they are available for prompt templating like the kwargs of execute_pipeline
+    ):
+        self.name = name
+        self.step = step
+        self.engine_wrapper = engine_wrapper
+        self.after = after
+        self.passes = passes if passes else default_passes(step)
+        self.transform = transform
+        self.depth = depth
+        self.run_kwargs = kwargs
+        self.downstream = []
+        self.output_dict = None  # assigned by the executor; shared between all stages that persist to the same file
+
+
+def default_passes(step):
+    # mirrors what the sequential pipelines filter on after each execute_pipeline call
+    if isinstance(step, MajorityVoteStep):
+        return lambda entry: bool(entry.get(step.final_determination_key))
+    return lambda entry: step.result_key in entry
+
+
+class StreamingStepExecutor:
+    """Runs a graph of pipeline steps over a dataset without waiting for a whole step to finish before starting the next.
+
+    Stages are added with add_stage; a stage without `after` is the root and receives the input dict, every other stage receives the items that passed the stage it is attached to. Stages whose steps write to the same output file share one in-memory dict, which is loaded once at the start and saved once at the end, exactly like consecutive execute_pipeline calls on the same dict would.
+    """
+
+    def __init__(
+        self,
+        rtwl,
+        concurrency_limit,
+        output_dir,
+        default_prompt_folder=None,
+        prompt_folder=None,
+        completion_mode=False,
+        use_stop=True,
+        include_details=False,
+        task_timeout=TASK_TIMEOUT_SECONDS,
+        on_stage_complete=None,  # (stage name, {key: entry} of the items that passed it) -> None, called once per stage as soon as every item that will ever reach it is done. Pipelines report progress from it.
+    ):
+        self.rtwl = rtwl
+        self.concurrency_limit = concurrency_limit
+        self.output_dir = output_dir
+        self.default_prompt_folder = default_prompt_folder
+        self.prompt_folder = prompt_folder
+        self.completion_mode = completion_mode
+        self.use_stop = use_stop
+        self.include_details = include_details
+        self.task_timeout = task_timeout
+        self.on_stage_complete = on_stage_complete
+        self.stages = {}
+        self.root = None
+        self._dicts = {}  # output path -> (step that loaded it, dict)
+
+    def add_stage(
+        self,
+        name,
+        step,
+        engine_wrapper,
+        after=None,
+        passes=None,  # entry -> bool, whether the item moves on to downstream stages. Defaults to the same check execute_pipeline + the pipeline's filter would do.
+        transform=None,  # (key, entry) -> None, called on each passing item before it is handed downstream. Use it for the little bits of glue code that normally sit between two execute_pipeline calls. It gets the stored entry itself, not a copy, so what it changes is saved along with the step's output, just as that glue code's changes end up in the file the next step saves.
+        **kwargs,
+    ):
+        assert name not in self.stages, f"Stage {name} was added twice"
+        if after is None:
+            assert self.root is None, "Only one stage can be the root of the graph"
+            depth = 0
+        else:
+            assert after in self.stages, f"Stage {after} must be added before {name}"
+            depth = self.stages[after].depth + 1
+
+        stage = StreamingStage(
+            name=name,
+            step=step,
+            engine_wrapper=engine_wrapper,
+            after=after,
+            passes=passes,
+            transform=transform,
+            depth=depth,
+            **kwargs,
+        )
+        self.stages[name] = stage
+        if after is None:
+            self.root = stage
+        else:
+            self.stages[after].downstream.append(stage)
+        return stage
+
+    def _attach_dict(self, stage, input_dict):
+        output_path = stage.step.make_output_path(self.output_dir)
+        if output_path not in self._dicts:
+            # a root PipelineStep works in place on the input dict, just like execute_pipeline does
+            if stage is self.root and not isinstance(stage.step, OneToManyStep):
+                output_dict = input_dict
+            else:
+                output_dict = {}
+            stage.step.load_dataset(output_dict, self.output_dir)
+            self._dicts[output_path] = (stage.step, output_dict)
+        stage.output_dict = self._dicts[output_path][1]
+        stage.step.open_journal(self.output_dir)  # stages sharing a file also share its journal
+
+    def _save_all(self, completed):
+        # same filtering execute_pipeline does before it saves: items that failed or never got a result are not persisted. A majority vote step filters only after saving, so it does not drop anything here.
+        for stage in self.stages.values():
+            step = stage.step
+            if isinstance(step, MajorityVoteStep):
+                continue
+            if completed or isinstance(step, OneToManyStep):
+                filter_out_nonpresent_keys(stage.output_dict, key_to_check=step.result_key)
+        for step, output_dict in self._dicts.values():
+            try:
+                step.save_dataset(output_dict, self.output_dir)
+            except Exception as e:
+                print(f"\nError saving results for step '{step.output_file}': {e}")
+                traceback.print_exc()
+        for stage in self.stages.values():
+            stage.step.close_journal(self.output_dir)
+
+    async def _run_item(self, stage, key, value):
+        output_dict = stage.output_dict
+        step = stage.step
+        common_kwargs = dict(
+            key=key,
+            engine_wrapper=stage.engine_wrapper,
+            default_prompt_folder=self.default_prompt_folder,
+            prompt_folder=self.prompt_folder,
+            completion_mode=self.completion_mode,
+            use_stop=self.use_stop,
+            include_details=self.include_details,
+            output_dir=self.output_dir,
+            **stage.run_kwargs,
+        )
+
+        if isinstance(step, OneToManyStep):
+            await self.rtwl(
+                wait_for_excluding_queue(
+                    step.run(input_data=value, output_dict=output_dict, **common_kwargs),
+                    self.task_timeout,
+                )
+            )
+            return [
+                (k, output_dict[k])
+                for k in step.child_keys(key, output_dict)
+            ]
+
+        # previously saved progress for this key wins over the incoming value, same as load_dataset updating the dict before execute_pipeline iterates over it
+        entry = output_dict.setdefault(str(key), value)
+        if getattr(step, "parallel_votes", False):
+            # each vote takes its own slot, so the item as a whole must not hold one
+            await wait_for_excluding_queue(
+                step.run(
+                    input_data=entry,
+                    input_dict=output_dict,
+                    rtwl=self.rtwl,
+                    **common_kwargs,
+                ),
+                self.task_timeout,
+            )
+        else:
+            await self.rtwl(
+                wait_for_excluding_queue(
+                    step.run(input_data=entry, input_dict=output_dict, **common_kwargs),
+                    self.task_timeout,
+                )
+            )
+        entry = output_dict.get(str(key), entry)
+        return [(str(key), entry)]
+
+    async def execute(self, input_dict):
+        """Runs every stage over the input dict. Returns {stage name: {key: entry}} holding the items that passed each stage."""
+        assert self.root is not None, "No stages were added to the executor"
+        for stage in self.stages.values():
+            self._attach_dict(stage, input_dict)
+
+        results = {name: {} for name in self.stages}
+        pending = {name: 0 for name in self.stages}  # items queued or running, per stage
+        complete = set()
+        queue = asyncio.PriorityQueue()
+        counter = itertools.count()  # tiebreaker so that entries never get compared
+        group_rank = {}  # prefix hint -> rank of the first item that had it
+        progress_bar = tqdmasyncio.tqdm(total=0, desc="Streaming steps")
+
+        def enqueue(stage, key, value):
+            # deeper stages first: finishing items in flight beats starting new ones
+            order = next(counter)
+            hint = stage.step.prefix_hint(value) if isinstance(value, dict) else None
+            rank = order if hint is None else group_rank.setdefault(hint, order)
+            queue.put_nowait((-stage.depth, rank, order, stage, key, value))
+            pending[stage.name] += 1
+            progress_bar.total += 1
+            progress_bar.refresh()
+
+        def check_complete(stage):
+            # a stage is done once nothing of it is pending and nothing more can arrive from upstream
+            if pending[stage.name] or (stage.after and stage.after not in complete):
+                return
+            complete.add(stage.name)
+            if self.on_stage_complete:
+                try:
+                    self.on_stage_complete(stage.name, results[stage.name])
+                except Exception as e:
+                    print(f"\nError in stage completion callback for '{stage.name}': {e}")
+                    traceback.print_exc()
+            for next_stage in stage.downstream:
+                check_complete(next_stage)
+
+        for key, value in list(input_dict.items()):
+            enqueue(self.root, key, value)
+        check_complete(self.root)  # only does anything for an empty input
+
+        async def worker():
+            while True:
+                _, _, _, stage, key, value = await queue.get()
+                try:
+                    outputs = await self._run_item(stage, key, value)
+                    for out_key, entry in outputs:
+                        if not isinstance(entry, dict) or not stage.passes(entry):
+                            continue
+                        if stage.transform:
+                            stage.transform(out_key, entry)
+                        results[stage.name][out_key] = entry
+                        for next_stage in stage.downstream:
+                            enqueue(next_stage, out_key, entry)
+                except asyncio.TimeoutError:
+                    print(
+                        f"\nWARNING: Item {key} in stage '{stage.name}' timed out after {self.task_timeout} seconds.",
+                        file=sys.stderr,
+                    )
+                except Exception as e:
+                    print(f"\nError processing item {key} in stage '{stage.name}': {e}")
+                    traceback.print_exc()
+                finally:
+                    pending[stage.name] -= 1
+                    check_complete(stage)
+                    progress_bar.update(1)
+                    queue.task_done()
+
+        workers = [
+            asyncio.ensure_future(worker()) for _ in range(max(1, self.concurrency_limit))
+        ]
+        completed = False
+        try:
+            await queue.join()
+            completed = True
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            progress_bar.close()
+            self._save_all(completed)
+
+        for name, passed in results.items():
+            print(f"Stage '{name}': {len(passed)} items passed")
+        return results
@@ -0,0 +1,82 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+# Error classification and backoff for EngineWrapper's transport-level retries.
+# A rate limit, a 502 or a dropped connection says nothing about whether the model can do the task, so these are retried inside the engine wrapper (with backoff, so that an overloaded provider gets room to recover) instead of burning one of the step's max_retries, which exist for outputs that fail validation.
+
+DEFAULT_MAX_TRANSPORT_RETRIES = 5
+DEFAULT_RETRY_BASE_DELAY = 1.0  # seconds
+DEFAULT_RETRY_MAX_DELAY = 60.0
+MAX_RETRY_AFTER = 300.0  # don't let a server park a request for longer than this
+
+RETRYABLE_ERRORS = {"rate_limit", "server_error", "connection", "timeout"}
+
+
+def error_status_code(error):
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def classify_error(error):
+    """Sorts an exception from a request into rate_limit, server_error, connection, timeout, content_filter or other."""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return "timeout"
+    error_name = type(error).__name__
+    status_code = error_status_code(error)
+    if status_code == 429:
+        return "rate_limit"
+    if status_code is not None and status_code >= 500:
+        return "server_error"
+    error_text = f"{getattr(error, 'code', '')} {error}".lower()
+    if "content_filter" in error_text or "content management policy" in error_text:
+        return "content_filter"  # the same request will be refused again; only a different prompt can help
+    if status_code is not None:
+        return "other"  # 400, 401, 404...: retrying the identical request cannot fix these
+    # openai.APITimeoutError / APIConnectionError and httpx's transport errors carry no status code
+    if "Timeout" in error_name:
+        return "timeout"
+    if (
+        "Connection" in error_name
+        or "RemoteProtocol" in error_name
+        or "ReadError" in error_name
+        or isinstance(error, ConnectionError)
+    ):
+        return "connection"
+    return "other"
+
+
+def retry_after_seconds(error):
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms is not None:
+            return float(retry_after_ms) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after is None:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:  # an HTTP date instead of a number of seconds
+            return parsedate_to_datetime(retry_after).timestamp() - time.time()
+    except Exception:
+        return None
+
+
+def retry_delay(
+    error,
+    attempt,
+    base_delay=DEFAULT_RETRY_BASE_DELAY,
+    max_delay=DEFAULT_RETRY_MAX_DELAY,
+):
+    # "full jitter" exponential backoff: waits are spread over [0, base * 2^attempt] so a crowd of failed requests does not come back at the same instant
+    delay = random.uniform(0, min(max_delay, base_delay * 2**attempt))
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None and retry_after > 0:
+        delay = max(delay, min(retry_after, MAX_RETRY_AFTER))
+    return delay
@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    # whenever the loop would sleep, the clock jumps ahead instead, so minutes of asyncio.sleep and timeouts pass instantly
+    def __init__(self):
+        super().__init__()
+        self.offset = 0.0
+        select = self._selector.select
+
+        def select_without_waiting(timeout=None):
+            events = select(0)
+            if not events and timeout:
+                self.offset += timeout
+            return events
+
+        self._selector.select = select_without_waiting
+
+    def time(self):
+        return super().time() + self.offset
+
+
+@pytest.fixture
+def run_virtual():
+    def run(coroutine):
+        loop = VirtualClockLoop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    return run
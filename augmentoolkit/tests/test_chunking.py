@@ -0,0 +1,162 @@
+import hashlib
+import importlib
+import re
+
+import pytest
+
+pytest.importorskip("nltk")
+pytest.importorskip("tqdm")
+
+from generation.core_components import chunking
+from generation.core_components.chunking import pack_chunks, subset_text_list
+
+
+class WhitespaceTokenizer:
+    def __init__(self):
+        self.batch_calls = 0
+
+    def encode(self, text):
+        return text.split()
+
+    def __call__(self, batch, **kwargs):
+        self.batch_calls += 1
+        return {"input_ids": [self.encode(text) for text in batch]}
+
+
+def split_sentences(paragraph):
+    return re.split(r"(?<=\.) ", paragraph)
+
+
+@pytest.fixture
+def tokenizer(monkeypatch):
+    tokenizer = WhitespaceTokenizer()
+    monkeypatch.setattr(chunking, "get_tokenizer", lambda: tokenizer)
+    monkeypatch.setattr(chunking, "sent_tokenize", split_sentences)
+    return tokenizer
+
+
+def per_paragraph_chunks(content, basename, max_token_length, tokenizer):
+    # the packing loop as it was before token counts were batched, one encode call per paragraph and sentence
+    chunks_with_source = []
+    current_chunk = []
+    token_count = 0
+    for paragraph in content.split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        paragraph_token_count = len(tokenizer.encode(paragraph))
+        if paragraph_token_count > max_token_length:
+            for sentence in split_sentences(paragraph):
+                sentence_token_count = len(tokenizer.encode(sentence))
+                if token_count + sentence_token_count <= max_token_length:
+                    current_chunk.append(sentence)
+                    token_count += sentence_token_count
+                else:
+                    chunks_with_source.append(
+                        {"text": " ".join(current_chunk), "metadata": basename}
+                    )
+                    current_chunk = [sentence]
+                    token_count = sentence_token_count
+        else:
+            if token_count + paragraph_token_count <= max_token_length:
+                current_chunk.append(paragraph)
+                token_count += paragraph_token_count
+            else:
+                chunks_with_source.append(
+                    {"text": " ".join(current_chunk), "metadata": basename}
+                )
+                current_chunk = [paragraph]
+                token_count = paragraph_token_count
+    if current_chunk:
+        chunks_with_source.append({"text": " ".join(current_chunk), "metadata": basename})
+    return [chunk for chunk in chunks_with_source if len(chunk["text"]) >= 50]
+
+
+def paragraph(index, words):
+    return " ".join(f"word{index}_{i}" + ("." if i % 7 == 6 else "") for i in range(words))
+
+
+DOCUMENTS = [
+    "",
+    "short",
+    "\n\n\n\n   \n\n",
+    paragraph(0, 30),
+    "\n\n".join(paragraph(i, 10 + (i * 13) % 50) for i in range(40)),
+    # paragraphs longer than the limit are split into sentences
+    "\n\n".join(paragraph(i, 5 + (i * 37) % 400) for i in range(25)),
+    # a single sentence longer than the limit still becomes its own chunk
+    paragraph(0, 20) + "\n\n" + " ".join(f"long{i}" for i in range(300)) + "\n\n" + paragraph(1, 20),
+    "  leading and trailing whitespace is stripped from every paragraph  \n\n\t" + paragraph(2, 60) + "\t",
+]
+
+
+@pytest.mark.parametrize("max_token_length", [1, 25, 100, 250])
+@pytest.mark.parametrize("document", DOCUMENTS)
+def test_pack_chunks_matches_per_paragraph_encoding(tokenizer, document, max_token_length):
+    assert pack_chunks(document, "doc.txt", max_token_length) == per_paragraph_chunks(
+        document, "doc.txt", max_token_length, tokenizer
+    )
+
+
+def test_count_tokens_batch_is_split_into_batches(tokenizer, monkeypatch):
+    monkeypatch.setattr(chunking, "TOKENIZE_BATCH_SIZE", 4)
+    messages = [paragraph(i, i) for i in range(10)]
+    assert chunking.count_tokens_batch(messages) == list(range(10))
+    assert tokenizer.batch_calls == 3
+    assert chunking.count_tokens_batch([]) == []
+
+
+def test_import_does_not_download(monkeypatch):
+    downloads = []
+    monkeypatch.setattr(chunking.nltk, "download", lambda *args, **kwargs: downloads.append(args))
+    importlib.reload(chunking)  # what every spawned ingest worker does
+    assert downloads == []
+
+
+def test_punkt_is_checked_once_and_only_downloaded_when_missing(monkeypatch):
+    found, downloads = [], []
+
+    def find(resource):
+        found.append(resource)
+        raise LookupError(resource)
+
+    monkeypatch.setattr(chunking, "_punkt_checked", False)
+    monkeypatch.setattr(chunking.nltk.data, "find", find)
+    monkeypatch.setattr(chunking.nltk, "download", lambda *args, **kwargs: downloads.append(args))
+    chunking.ensure_punkt()
+    chunking.ensure_punkt()
+    assert found == ["tokenizers/punkt_tab"]
+    assert downloads == [("punkt_tab",)]
+
+    monkeypatch.setattr(chunking, "_punkt_checked", False)
+    monkeypatch.setattr(chunking.nltk.data, "find", lambda resource: resource)
+    chunking.ensure_punkt()
+    assert downloads == [("punkt_tab",)]
+
+
+def sorted_subset(text_list, subset_size=1500, seed=1048596):
+    # subset_text_list as it was before it streamed: a full sort of the list
+    if len(text_list) > subset_size:
+        text_list = sorted(
+            text_list,
+            key=lambda x: hashlib.md5(str(seed).encode() + x["text"].encode()).hexdigest(),
+        )[:subset_size]
+    return text_list
+
+
+CHUNKS = [{"text": f"chunk {i % 37}", "metadata": f"file{i}.txt"} for i in range(100)]
+
+
+@pytest.mark.parametrize("subset_size", [0, 1, 10, 37, 99, 100, 101, 1500])
+@pytest.mark.parametrize("seed", [1048596, 7])
+def test_subset_text_list_matches_sorted_subset(subset_size, seed):
+    expected = sorted_subset(CHUNKS, subset_size, seed)
+    assert subset_text_list(CHUNKS, subset_size, seed) == expected
+    # a generator gives the same subset as a list
+    assert subset_text_list(iter(CHUNKS), subset_size, seed) == expected
+
+
+def test_small_subset_keeps_original_order():
+    assert subset_text_list(CHUNKS, subset_size=100) == CHUNKS
+    assert subset_text_list((chunk for chunk in CHUNKS), subset_size=500) == CHUNKS
+    assert subset_text_list([], subset_size=10) == []
@@ -0,0 +1,95 @@
+import os
+import sqlite3
+
+from generation.core_components import ingest_cache
+from generation.core_components.ingest_cache import (
+    CACHE_FILENAME,
+    IngestCache,
+    chunk_key,
+    read_key,
+)
+
+
+def write(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def test_entries_persist_across_instances(tmp_path):
+    cache = IngestCache(str(tmp_path))
+    assert cache.get("missing") is None
+    cache.put("key", [{"text": "héllo", "metadata": "a.txt"}])
+    cache.close()
+
+    cache = IngestCache(str(tmp_path))
+    assert cache.get("key") == [{"text": "héllo", "metadata": "a.txt"}]
+    cache.close()
+
+
+def test_unchanged_file_is_not_hashed_again(tmp_path, monkeypatch):
+    source = tmp_path / "doc.txt"
+    write(source, "some text")
+    cache = IngestCache(str(tmp_path / "out"))
+    digest = cache.file_digest(str(source))
+
+    hashed = []
+    monkeypatch.setattr(
+        ingest_cache, "hash_file", lambda path: hashed.append(path) or "rehashed"
+    )
+    assert cache.file_digest(str(source)) == digest
+    assert hashed == []
+
+    # a changed size or mtime means it is hashed again
+    write(source, "some other text")
+    assert cache.file_digest(str(source)) == "rehashed"
+    assert len(hashed) == 1
+    cache.close()
+
+
+def test_read_entries_follow_content_not_path(tmp_path):
+    first = tmp_path / "first.txt"
+    renamed = tmp_path / "renamed.txt"
+    write(first, "the same bytes")
+    write(renamed, "the same bytes")
+    cache = IngestCache(str(tmp_path / "out"))
+
+    cache.put(read_key(str(first), cache.file_digest(str(first))), ["the same bytes"])
+    # a renamed or moved copy is a hit
+    assert cache.get(read_key(str(renamed), cache.file_digest(str(renamed)))) == [
+        "the same bytes"
+    ]
+
+    # an edit is a miss, even without a rename
+    write(first, "edited bytes")
+    os.utime(first, ns=(1, 1))  # and even if the mtime went backwards
+    assert cache.get(read_key(str(first), cache.file_digest(str(first)))) is None
+    cache.close()
+
+
+def test_read_key_depends_on_extension_and_extractor_version(tmp_path, monkeypatch):
+    digest = "0" * 64
+    assert read_key("a.txt", digest) == read_key("b.TXT", digest)
+    assert read_key("a.txt", digest) != read_key("a.pdf", digest)
+    before = read_key("a.txt", digest)
+    monkeypatch.setattr(ingest_cache, "EXTRACTOR_VERSION", ingest_cache.EXTRACTOR_VERSION + 1)
+    assert read_key("a.txt", digest) != before
+
+
+def test_chunk_key_invalidation(monkeypatch):
+    key = chunk_key("text", 3000, "tokenizer-a")
+    assert chunk_key("text", 3000, "tokenizer-a") == key
+    assert chunk_key("text!", 3000, "tokenizer-a") != key
+    assert chunk_key("text", 1500, "tokenizer-a") != key
+    assert chunk_key("text", 3000, "tokenizer-b") != key
+    monkeypatch.setattr(ingest_cache, "CHUNKER_VERSION", ingest_cache.CHUNKER_VERSION + 1)
+    assert chunk_key("text", 3000, "tokenizer-a") != key
+
+
+def test_corrupted_cache_starts_over(tmp_path):
+    with open(tmp_path / CACHE_FILENAME, "wb") as f:
+        f.write(b"this is not a sqlite database" * 100)
+    cache = IngestCache(str(tmp_path))
+    cache.put("key", "value")
+    assert cache.get("key") == "value"
+    cache.close()
+    sqlite3.connect(str(tmp_path / CACHE_FILENAME)).close()
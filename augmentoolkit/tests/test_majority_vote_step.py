@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+from augmentoolkit.generation_functions.majority_vote_step import (
+    TASK_TIMEOUT_SECONDS,
+    MajorityVoteStep,
+)
+
+
+def make_step(answers, vote_count_needed=3):
+    step = MajorityVoteStep(
+        prompt_path="judge",
+        regex=None,
+        sampling_params={},
+        output_file="judgements",
+        output_processor=lambda x: x,
+        result_key="votes",
+        final_determination_key="passed",
+        vote_count_needed=vote_count_needed,
+        parallel_votes=True,
+    )
+    step.calls = []
+
+    async def generate_vote(vote_index=0, **kwargs):
+        step.calls.append(vote_index)
+        answer = answers[vote_index]
+        return None if answer is None else (answer, "response", "input")
+
+    step.generate_vote = generate_vote
+    return step
+
+
+def run_key(step, rtwl):
+    input_dict = {"0": {"text": "chunk"}}
+
+    async def main():
+        await step.run(
+            key="0",
+            input_data=input_dict["0"],
+            engine_wrapper=None,
+            input_dict=input_dict,
+            default_prompt_folder=None,
+            prompt_folder=None,
+            output_dir=None,
+            include_details=False,
+            completion_mode=False,
+            use_stop=True,
+            rtwl=rtwl,
+        )
+
+    asyncio.run(main())
+    return input_dict["0"]
+
+
+def flaky_rtwl(failures, swallow):
+    # behaves like setup_semaphore_and_engines' rtwl (swallow=True: a timeout or error becomes None) or make_run_task_with_limit's (the error is raised), for the first `failures` calls
+    timeouts = []
+
+    async def rtwl(task, timeout=60):
+        timeouts.append(timeout)
+        if len(timeouts) <= failures:
+            task.close()
+            if swallow:
+                return None
+            raise asyncio.TimeoutError()
+        return await task
+
+    rtwl.timeouts = timeouts
+    return rtwl
+
+
+@pytest.mark.parametrize("swallow", [True, False])
+def test_timed_out_votes_are_retried(swallow):
+    step = make_step([True, True, True])
+    rtwl = flaky_rtwl(failures=2, swallow=swallow)
+    entry = run_key(step, rtwl)
+    assert entry["passed"] is True
+    assert len(entry["votes"]) >= 2
+    assert set(rtwl.timeouts) == {TASK_TIMEOUT_SECONDS}
+
+
+def test_vote_that_never_finishes_fails_the_key():
+    step = make_step([True, True, True], vote_count_needed=1)
+    rtwl = flaky_rtwl(failures=100, swallow=True)
+    entry = run_key(step, rtwl)
+    assert "passed" not in entry
+    assert len(rtwl.timeouts) == step.max_retries
+
+
+def test_failed_validation_fails_the_key_without_retrying():
+    step = make_step([None], vote_count_needed=1)
+    entry = run_key(step, flaky_rtwl(failures=0, swallow=True))
+    assert "passed" not in entry
+    assert step.calls == [0]
@@ -0,0 +1,96 @@
+import glob
+import os
+
+import pytest
+import yaml
+
+from augmentoolkit.generation_functions.prompt_registry import (
+    compile_template,
+    render_template,
+)
+from augmentoolkit.generation_functions.safe_formatter import safe_format
+
+REPO_ROOT = os.path.join(os.path.dirname(__file__), "..", "..")
+
+ARGUMENTS = {
+    "text": "A paragraph about rivers.",
+    "question": "What is a river?",
+    "answer": 42,
+    "ratio": 0.125,
+    "items": ["a", "b"],
+}
+
+TEMPLATES = [
+    "",
+    "no fields at all",
+    "{text}",
+    "Text: {text}\nQuestion: {question}",
+    "{missing} stays as it is, {text} does not",
+    "{answer:05d} {ratio:.2f} {text:>40}",
+    "{question!r} {answer!s}",
+    "{{escaped}} and {{{text}}}",
+    "{items}",
+    "{0} is positional",
+    "{items[0]} is an index",
+    "{ratio.real} is an attribute",
+    "{ratio:{width}} has a nested spec",
+    "unmatched { brace",
+    "unmatched } brace",
+    "{text",
+    "{}",
+    '{"json": "object", "inside": [1, 2]}',
+]
+
+
+def outcome(function, *args, **kwargs):
+    try:
+        return ("ok", function(*args, **kwargs))
+    except Exception as e:
+        return ("error", type(e))
+
+
+def assert_same_as_safe_format(template, **kwargs):
+    expected = outcome(safe_format, template, **kwargs)
+    actual = outcome(render_template, template, compile_template(template), **kwargs)
+    assert actual == expected, template
+
+
+@pytest.mark.parametrize("template", TEMPLATES)
+def test_render_template_matches_safe_format(template):
+    assert_same_as_safe_format(template, **ARGUMENTS)
+    assert_same_as_safe_format(template)
+
+
+def test_general_cases_are_not_compiled():
+    assert compile_template("{0}") is None
+    assert compile_template("{items[0]}") is None
+    assert compile_template("{ratio:{width}}") is None
+    assert compile_template("unmatched { brace") is None
+    assert compile_template(None) is None
+    assert compile_template("{text} and {question}") is not None
+
+
+def test_shipped_prompts_render_like_safe_format():
+    paths = glob.glob(
+        os.path.join(REPO_ROOT, "generation", "**", "prompts", "*.*"), recursive=True
+    )
+    templates = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            raw = f.read()
+        if path.endswith(".yaml"):
+            try:
+                messages = yaml.safe_load(raw)
+            except yaml.YAMLError:
+                continue
+            if isinstance(messages, list):
+                templates += [
+                    message["content"]
+                    for message in messages
+                    if isinstance(message, dict) and isinstance(message.get("content"), str)
+                ]
+        elif path.endswith(".txt"):
+            templates.append(raw)
+    assert templates, "no prompt files found"
+    for template in templates:
+        assert_same_as_safe_format(template, **ARGUMENTS)
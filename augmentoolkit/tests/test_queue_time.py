@@ -0,0 +1,93 @@
+import asyncio
+import types
+
+import pytest
+
+from augmentoolkit.generation_functions import rate_limiter
+from augmentoolkit.generation_functions.adaptive_limiter import (
+    AdaptiveConcurrencyLimiter,
+)
+from augmentoolkit.generation_functions.queue_time import (
+    queued,
+    wait_for_excluding_queue,
+)
+from augmentoolkit.generation_functions.rate_limiter import RateLimiter
+
+
+async def hold_slot(limiter, seconds):
+    async with limiter.slot():
+        await asyncio.sleep(seconds)
+    return "done"
+
+
+def test_waiting_for_a_window_slot_is_not_timed(run_virtual):
+    # five 40 s requests through a window of one: the last is queued for 160 s, far past the 60 s timeout
+    async def main():
+        limiter = AdaptiveConcurrencyLimiter(1, max_limit=1)
+        return await asyncio.gather(
+            *(wait_for_excluding_queue(hold_slot(limiter, 40), 60) for _ in range(5))
+        )
+
+    assert run_virtual(main()) == ["done"] * 5
+
+
+def test_plain_wait_for_drops_the_queued_tasks(run_virtual):
+    # what rtwl did before: the same load loses every task that queued for more than 20 s
+    async def main():
+        limiter = AdaptiveConcurrencyLimiter(1, max_limit=1)
+        return await asyncio.gather(
+            *(asyncio.wait_for(hold_slot(limiter, 40), 60) for _ in range(5)),
+            return_exceptions=True,
+        )
+
+    results = run_virtual(main())
+    assert results[0] == "done"
+    assert all(isinstance(result, asyncio.TimeoutError) for result in results[1:])
+
+
+def test_work_after_queueing_is_still_timed(run_virtual):
+    async def main():
+        limiter = AdaptiveConcurrencyLimiter(1, max_limit=1)
+        blocker = asyncio.ensure_future(hold_slot(limiter, 100))
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            await wait_for_excluding_queue(hold_slot(limiter, 61), 60)
+        assert limiter.in_flight == 0  # the timed-out request gave its slot back
+        await blocker
+
+    run_virtual(main())
+
+
+def test_queueing_in_a_nested_task_pauses_the_outer_timeout(run_virtual):
+    async def inner():
+        with queued():
+            await asyncio.sleep(100)
+        await asyncio.sleep(10)
+        return "done"
+
+    async def outer():
+        return await wait_for_excluding_queue(inner(), 30)
+
+    async def main():
+        return await wait_for_excluding_queue(outer(), 30)
+
+    assert run_virtual(main()) == "done"
+
+
+def test_waiting_for_rate_limit_quota_is_not_timed(run_virtual, monkeypatch):
+    async def main():
+        loop = asyncio.get_running_loop()
+        monkeypatch.setattr(rate_limiter, "time", types.SimpleNamespace(monotonic=loop.time))
+        limiter = RateLimiter(requests_per_minute=1)
+
+        async def request():
+            await limiter.acquire(10)
+            return loop.time()
+
+        started = loop.time()
+        times = await asyncio.gather(
+            *(wait_for_excluding_queue(request(), 5) for _ in range(3))
+        )
+        return [t - started for t in times]
+
+    assert run_virtual(main()) == pytest.approx([0, 60, 120], abs=0.01)
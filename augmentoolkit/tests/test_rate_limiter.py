@@ -0,0 +1,118 @@
+import asyncio
+import types
+
+import pytest
+
+from augmentoolkit.generation_functions import rate_limiter
+from augmentoolkit.generation_functions.rate_limiter import (
+    RateLimiter,
+    TokenBucket,
+    estimate_payload_tokens,
+    estimate_tokens,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(
+        rate_limiter,
+        "asyncio",
+        types.SimpleNamespace(Lock=asyncio.Lock, sleep=clock.sleep),
+    )
+    return clock
+
+
+def test_bucket_starts_full_and_refills_at_its_rate(clock):
+    bucket = TokenBucket(per_minute=600)  # 10 per second
+    assert bucket.wait_time(600) == 0.0
+    bucket.take(600)
+    assert bucket.wait_time(50) == pytest.approx(5.0)
+    clock.now += 2
+    assert bucket.wait_time(50) == pytest.approx(3.0)
+    clock.now += 1000
+    bucket.refill()
+    assert bucket.level == 600  # never above capacity
+
+
+def test_give_back_corrects_the_reservation_both_ways(clock):
+    bucket = TokenBucket(per_minute=600)
+    bucket.take(500)
+    bucket.give_back(300)  # used 200 of the 500 reserved
+    assert bucket.level == pytest.approx(400)
+    bucket.give_back(-1000)  # used 1000 more than reserved: the debt delays the next callers
+    assert bucket.level == pytest.approx(-600)
+    assert bucket.wait_time(1) == pytest.approx(60.1)
+    bucket.give_back(10_000)
+    assert bucket.level == 600
+
+
+def test_acquire_waits_for_both_buckets(clock):
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000)
+
+    async def run():
+        started = clock.now
+        for _ in range(60):
+            assert await limiter.acquire(10) == 10
+        assert clock.now == started  # a full minute of requests goes out at once
+        await limiter.acquire(10)
+        assert clock.now - started == pytest.approx(1.0)  # then one per second
+
+        started = clock.now
+        await limiter.acquire(6000)  # needs the whole token bucket: 6000 - 610 taken + 100 refilled during the wait above
+        assert clock.now - started == pytest.approx(5.1)
+
+    asyncio.run(run())
+    assert limiter.time_waited == pytest.approx(6.1)
+
+
+def test_oversized_request_is_capped_at_one_minute_of_quota(clock):
+    limiter = RateLimiter(tokens_per_minute=1000)
+
+    async def run():
+        return await limiter.acquire(50_000)
+
+    assert asyncio.run(run()) == 1000
+
+
+def test_reconcile_returns_unused_tokens(clock):
+    limiter = RateLimiter(tokens_per_minute=1000)
+
+    async def run():
+        return await limiter.acquire(800)
+
+    reserved = asyncio.run(run())
+    limiter.reconcile(reserved, 300)
+    assert limiter.token_bucket.level == pytest.approx(700)
+
+
+def test_without_limits_nothing_is_reserved(clock):
+    limiter = RateLimiter()
+
+    async def run():
+        return await limiter.acquire(10_000)
+
+    assert asyncio.run(run()) == 0
+    limiter.reconcile(0, 500)
+    assert clock.now == 1000.0
+
+
+def test_estimates():
+    assert estimate_tokens("") == 1
+    assert estimate_tokens("a" * 400) == 101
+    assert estimate_payload_tokens("a" * 400) == 101
+    assert estimate_payload_tokens(
+        [{"role": "system", "content": "a" * 40}, {"role": "user", "content": "b" * 80}]
+    ) == (11 + 4) + (21 + 4)
@@ -0,0 +1,76 @@
+import json
+import os
+
+from augmentoolkit.generation_functions import step_journal
+from augmentoolkit.generation_functions.step_journal import (
+    close_journal,
+    journal_path_for,
+    open_journal,
+    replay_journal,
+    truncate_journal,
+)
+
+
+def test_replay_applies_records_in_order(tmp_path):
+    output_path = str(tmp_path / "step_output.json")
+    journal = open_journal(output_path)
+    for i in range(200):
+        journal.append(i, {"result": i})
+    journal.append(7, {"result": "rewritten"})  # the last record for a key wins
+    journal.sync()
+
+    replayed = {}
+    assert replay_journal(replayed, output_path) == 201
+    assert len(replayed) == 200
+    assert replayed["7"] == {"result": "rewritten"}
+    assert replayed["199"] == {"result": 199}
+    close_journal(output_path)
+
+
+def test_replay_skips_torn_record(tmp_path):
+    output_path = str(tmp_path / "step_output.json")
+    with open(journal_path_for(output_path), "w", encoding="utf-8") as f:
+        f.write(json.dumps({"key": "a", "value": 1}) + "\n")
+        f.write('{"key": "b", "val')  # crashed mid-write
+
+    # reopening seals off the torn line, so records appended afterwards are readable
+    journal = open_journal(output_path)
+    journal.append("c", 3)
+    close_journal(output_path)
+
+    replayed = {}
+    assert replay_journal(replayed, output_path) == 2
+    assert replayed == {"a": 1, "c": 3}
+    os.remove(journal_path_for(output_path))
+
+
+def test_truncate_empties_journal_and_close_removes_it(tmp_path):
+    output_path = str(tmp_path / "step_output.json")
+    journal = open_journal(output_path)
+    for i in range(10):
+        journal.append(i, i)
+    truncate_journal(output_path)
+    assert os.path.getsize(journal.path) == 0
+    assert replay_journal({}, output_path) == 0
+
+    close_journal(output_path)
+    assert not os.path.exists(journal_path_for(output_path))
+
+
+def test_close_keeps_unconsolidated_records(tmp_path):
+    output_path = str(tmp_path / "step_output.json")
+    journal = open_journal(output_path)
+    journal.append("kept", True)
+    close_journal(output_path)
+
+    assert os.path.exists(journal_path_for(output_path))
+    replayed = {}
+    assert replay_journal(replayed, output_path) == 1
+    assert replayed == {"kept": True}
+
+
+def test_steps_sharing_an_output_file_share_the_journal(tmp_path):
+    output_path = str(tmp_path / "step_output.json")
+    assert open_journal(output_path) is open_journal(output_path)
+    close_journal(output_path)
+    assert journal_path_for(output_path) not in step_journal._open_journals
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+from augmentoolkit.generation_functions.pipeline_step_class import PipelineStep
+from augmentoolkit.generation_functions.streaming_executor import (
+    StreamingStepExecutor,
+    make_run_task_with_limit,
+)
+
+
+def make_step(name, seconds, result_key):
+    async def run(self, key, input_data, input_dict, **kwargs):
+        await asyncio.sleep(seconds)
+        input_dict[str(key)][result_key] = f"{name} done"
+
+    return PipelineStep(
+        output_file=name, result_key=result_key, method_overrides={"run": run}
+    )
+
+
+def test_stage_slower_than_a_minute_still_finishes(tmp_path, run_virtual):
+    async def main():
+        loop = asyncio.get_running_loop()
+        executor = StreamingStepExecutor(
+            rtwl=make_run_task_with_limit(asyncio.Semaphore(2)),
+            concurrency_limit=2,
+            output_dir=str(tmp_path),
+        )
+        executor.add_stage("fast", make_step("fast", 1, "fast_result"), None)
+        executor.add_stage(
+            "slow", make_step("slow", 90, "slow_result"), None, after="fast"
+        )
+        started = loop.time()
+        results = await executor.execute({str(i): {"text": i} for i in range(4)})
+        return results, loop.time() - started
+
+    results, elapsed = run_virtual(main())
+    assert len(results["slow"]) == 4
+    assert all(entry["slow_result"] == "slow done" for entry in results["slow"].values())
+    assert elapsed >= 180  # four 90 s items through two slots; queueing does not time anything out either
+
+
+def test_stage_slower_than_task_timeout_is_dropped(tmp_path, run_virtual):
+    async def main():
+        executor = StreamingStepExecutor(
+            rtwl=make_run_task_with_limit(asyncio.Semaphore(1)),
+            concurrency_limit=1,
+            output_dir=str(tmp_path),
+            task_timeout=600,
+        )
+        executor.add_stage("stuck", make_step("stuck", 601, "stuck_result"), None)
+        return await executor.execute({"0": {"text": 0}})
+
+    assert run_virtual(main()) == {"stuck": {}}
+
+
+def test_errors_reach_the_executor(run_virtual):
+    async def fail():
+        raise ValueError("bad item")
+
+    async def main():
+        rtwl = make_run_task_with_limit(asyncio.Semaphore(1))
+        with pytest.raises(ValueError):
+            await rtwl(fail())
+        with pytest.raises(asyncio.TimeoutError):
+            await rtwl(asyncio.sleep(10), timeout=5)
+        return await rtwl(asyncio.sleep(120, result="finished"))
+
+    assert run_virtual(main()) == "finished"
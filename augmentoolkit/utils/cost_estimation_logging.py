@@ -2,6 +2,8 @@ import logging
 from typing import Dict, List, Union, Optional
 from tabulate import tabulate
 
+from augmentoolkit.generation_functions.observer_dispatch import flush_observers
+
 
 def calculate_pipeline_cost_efficiency(
     total_input_tokens: int,
@@ -30,6 +32,8 @@ def calculate_pipeline_cost_efficiency(
         }
     """
 
+    flush_observers()  # the token counters are updated on the observer thread; wait for the last requests' counts
+
     # Initialize counters
     total_model_input_tokens = 0
     total_model_output_tokens = 0
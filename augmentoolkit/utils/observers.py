@@ -1,10 +1,78 @@
 import os
-import yaml
 import uuid
 import json
+import atexit
 import asyncio
+import threading
 from typing import Callable, Dict, List, Any, Union
 
+from augmentoolkit.generation_functions.observer_dispatch import flush_observers
+from augmentoolkit.generation_functions.segmented_log import (
+    flush_log_writers,
+    get_log_writer,
+)
+
+# Token counters prefer the usage block the provider sends back with each response (EngineWrapper passes it to observers as usage=...); count_tokens_fn is only run when there is none, e.g. with servers that do not report usage or on failed requests.
+# The counter files are rewritten at most once every COUNTER_PERSIST_INTERVAL seconds, and once more when the process exits, instead of after every request.
+
+COUNTER_PERSIST_INTERVAL = 5.0
+
+_counter_persisters = {}
+
+
+class CounterPersister:
+    def __init__(self, counter, path, interval=COUNTER_PERSIST_INTERVAL):
+        self.counter = counter
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def mark_dirty(self):
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is None:
+                return  # nothing changed since the last write
+            self.timer.cancel()
+            self.timer = None
+            snapshot = dict(self.counter)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(temp_path, self.path)
+
+
+def get_counter_persister(counter, path):
+    # the input and output counters of one model share a counter and a file, so they share a persister too
+    persister = _counter_persisters.get(path)
+    if persister is None or persister.counter is not counter:
+        if persister is not None:
+            persister.flush()
+        persister = CounterPersister(counter, path)
+        _counter_persisters[path] = persister
+    return persister
+
+
+def flush_token_counters():
+    flush_observers()  # counts still waiting in the observer queue
+    for persister in list(_counter_persisters.values()):
+        persister.flush()
+
+
+def flush_observer_files():
+    # the observer queue first, then the files it was feeding
+    flush_token_counters()
+    flush_log_writers()
+
+
+atexit.register(flush_observer_files)
+
 
 def create_log_observer(
     log_dir: str, active: bool = False
@@ -12,7 +80,7 @@ def create_log_observer(
     Callable
 ):  # TODO maybe put these in a class so that I can have type checking and warn when I am putting an input observer in an output observer list?
     """
-    Creates an output observer that logs all inputs and outputs to files.
+    Creates an output observer that logs all inputs and outputs to a segmented log.
 
     Args:
         log_dir: Directory path where logs will be saved
@@ -30,7 +98,7 @@ def create_log_observer(
         **kwargs,
     ) -> None:
         """
-        Logs the input and output to a file with a UUID.
+        Appends the input and output to the segmented log in debug_outputs (see segmented_log.py; read it back with iter_log_records).
 
         Args:
             input_data: Either a prompt string (completion mode) or messages list (chat mode)
@@ -52,26 +120,14 @@ def create_log_observer(
         # Create log ID with prefix
         log_id = f"{prefix}_{str(uuid.uuid4())}"
 
-        os.makedirs(full_output_path, exist_ok=True)
-        if completion_mode:
-            print(f"Saving output to {log_id}.txt")
-            # For completion mode, save as .txt
-            file_path = os.path.join(full_output_path, f"{log_id}.txt")
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(input_data + output)
-        else:
-            print(f"Saving output to {log_id}.yaml")
-            # For chat mode, save as .yaml
-            file_path = os.path.join(full_output_path, f"{log_id}.yaml")
-
-            # Create a full conversation history including the assistant's response
-            full_conversation = input_data.copy()  # Copy the input messages
-            full_conversation.append({"role": "assistant", "content": output})
-
-            with open(file_path, "w", encoding="utf-8") as f:
-                yaml.dump(
-                    full_conversation, f, default_flow_style=False, allow_unicode=True
-                )
+        get_log_writer(full_output_path).append(
+            {
+                "id": log_id,
+                "completion_mode": completion_mode,
+                "input": input_data,
+                "output": output,
+            }
+        )
 
     return log_observer
 
@@ -94,8 +150,7 @@ def create_input_token_counter(
     Returns:
         A callback function that updates the counter
     """
-    # Initialize lock for file access
-    json_path = None
+    persister = None
 
     if persistence_path:
         os.makedirs(os.path.dirname(persistence_path), exist_ok=True)
@@ -111,11 +166,13 @@ def create_input_token_counter(
             except (json.JSONDecodeError, FileNotFoundError):
                 # If file is corrupted or doesn't exist, start fresh
                 pass
+        persister = get_counter_persister(counter, json_path)
 
     def input_token_counter(
         input_data: Union[str, List[Dict[str, str]]],
         completion_mode: bool,
         *args,
+        usage: Dict[str, int] = None,
         **kwargs,
     ) -> None:
         """
@@ -124,8 +181,11 @@ def create_input_token_counter(
         Args:
             input_data: Either a prompt string (completion mode) or messages list (chat mode)
             completion_mode: Whether this was a completion (True) or chat (False) request
+            usage: The provider's token counts for the request, if it reported them
         """
-        if completion_mode:
+        if usage is not None:
+            token_count = usage["prompt_tokens"]
+        elif completion_mode:
             # For completion mode, input is a string
             token_count = count_tokens_fn(input_data)
         else:
@@ -143,10 +203,9 @@ def create_input_token_counter(
         counter["input_tokens"] += token_count
         counter["input_cost"] += (token_count / 1_000_000) * cost_per_million
 
-        # Persist counter to file if path was provided
-        if json_path:
-            with open(json_path, "w", encoding="utf-8") as f:
-                json.dump(counter, f)
+        # Persist counter to file (debounced) if path was provided
+        if persister:
+            persister.mark_dirty()
 
     return input_token_counter
 
@@ -169,8 +228,7 @@ def create_output_token_counter(
     Returns:
         A callback function that updates the counter
     """
-    # Initialize lock for file access
-    json_path = None
+    persister = None
 
     if persistence_path:
         os.makedirs(os.path.dirname(persistence_path), exist_ok=True)
@@ -186,12 +244,14 @@ def create_output_token_counter(
             except (json.JSONDecodeError, FileNotFoundError):
                 # If file is corrupted or doesn't exist, start fresh
                 pass
+        persister = get_counter_persister(counter, json_path)
 
     def output_token_counter(
         input_data: Union[str, List[Dict[str, str]]],
         output: str,
         completion_mode: bool,
         *args,
+        usage: Dict[str, int] = None,
         **kwargs,
     ) -> None:
         """
@@ -201,8 +261,12 @@ def create_output_token_counter(
             input_data: Either a prompt string (completion mode) or messages list (chat mode)
             output: The model's response
             completion_mode: Whether this was a completion (True) or chat (False) request
+            usage: The provider's token counts for the request, if it reported them
         """
-        token_count = count_tokens_fn(output)
+        if usage is not None:
+            token_count = usage["completion_tokens"]
+        else:
+            token_count = count_tokens_fn(output)
 
         # Update counter
         if "output_tokens" not in counter:
@@ -213,9 +277,8 @@ def create_output_token_counter(
         counter["output_tokens"] += token_count
         counter["output_cost"] += (token_count / 1_000_000) * cost_per_million
 
-        # Persist counter to file if path was provided
-        if json_path:
-            with open(json_path, "w", encoding="utf-8") as f:
-                json.dump(counter, f)
+        # Persist counter to file (debounced) if path was provided
+        if persister:
+            persister.mark_dirty()
 
     return output_token_counter
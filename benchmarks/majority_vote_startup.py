@@ -0,0 +1,116 @@
+"""Measures how long a MajorityVoteStep takes to get through a resumed validation stage.
+
+Every key starts with some of its votes already saved, which is the situation after an interrupted run. The LLM call is replaced with an instant fake, so the timing is pure orchestration overhead: looking up existing votes, generating the missing ones, evaluating the final count.
+
+The "legacy" number reproduces what run() used to do before counting votes -- open and json.load the whole output file once per key -- on a sample of keys and extrapolates to the full stage.
+
+Run from the repository root:
+    python -m benchmarks.majority_vote_startup --keys 50000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from augmentoolkit.generation_functions.majority_vote_step import MajorityVoteStep
+
+
+class InstantVoteStep(MajorityVoteStep):
+    async def generate_data(self, processed_data, *args, **kwargs):
+        return True, None, None, None
+
+
+def make_dataset(num_keys, existing_votes):
+    return {
+        str(i): {
+            "text": f"Paragraph {i}. " * 20,
+            "question": f"What is in paragraph {i}?",
+            "answer": f"Paragraph {i} says things.",
+            "votes": [True] * existing_votes,
+        }
+        for i in range(num_keys)
+    }
+
+
+def legacy_existing_votes(output_path, key, result_key):
+    # the per-key file read that used to sit on the hot path of MajorityVoteStep.run
+    with open(output_path, "r", encoding="utf-8") as f:
+        existing_data = json.load(f)
+    return existing_data.get(str(key), {}).get(result_key, [])
+
+
+async def run_stage(step, input_dict, output_dir):
+    started = time.perf_counter()
+    await asyncio.gather(
+        *[
+            step.run(
+                key=key,
+                input_data=value,
+                engine_wrapper=None,
+                input_dict=input_dict,
+                default_prompt_folder=None,
+                prompt_folder=None,
+                output_dir=output_dir,
+                include_details=False,
+                completion_mode=False,
+                use_stop=True,
+            )
+            for key, value in list(input_dict.items())
+        ]
+    )
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark MajorityVoteStep startup on a resumed validation stage."
+    )
+    parser.add_argument("--keys", type=int, default=50000)
+    parser.add_argument("--vote-count-needed", type=int, default=3)
+    parser.add_argument("--existing-votes", type=int, default=1)
+    parser.add_argument(
+        "--legacy-sample",
+        type=int,
+        default=50,
+        help="How many keys to time the legacy per-key file read on before extrapolating.",
+    )
+    args = parser.parse_args()
+
+    output_dir = tempfile.mkdtemp(prefix="majority_vote_bench_")
+    step = InstantVoteStep(
+        prompt_path="unused",
+        regex=None,
+        sampling_params={},
+        output_file="votes_bench",
+        output_processor=None,
+        result_key="votes",
+        final_determination_key="final",
+        vote_count_needed=args.vote_count_needed,
+    )
+
+    input_dict = make_dataset(args.keys, args.existing_votes)
+    output_path = step.make_output_path(output_dir)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(input_dict, f)
+    file_mb = os.path.getsize(output_path) / 1_000_000
+
+    started = time.perf_counter()
+    sample_keys = list(input_dict.keys())[: args.legacy_sample]
+    for key in sample_keys:
+        legacy_existing_votes(output_path, key, step.result_key)
+    legacy_per_key = (time.perf_counter() - started) / max(1, len(sample_keys))
+
+    elapsed = asyncio.run(run_stage(step, input_dict, output_dir))
+
+    print(f"keys: {args.keys}, output file: {file_mb:.1f} MB")
+    print(
+        f"legacy file reads alone (extrapolated from {len(sample_keys)} keys): {legacy_per_key * args.keys:.1f} s"
+    )
+    print(f"in-memory vote tracking, whole stage: {elapsed:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""A deterministic, offline stand-in for an OpenAI-compatible inference server, for benchmarking pipelines without paying a provider.
+
+Responses are canned but prompt-appropriate. Every core prompt is few-shot, so the request itself already contains answers in exactly the format the step's regex and output processor expect: for chat requests the server replies with one of the request's own assistant turns, and for completion requests with one of the example responses in the prompt (the text after earlier occurrences of one of the prompt's last lines, cut at the request's stop sequences). Which example is used is a pure function of --seed and the request's last message, so a run is reproducible. Prompts with no examples get the first matching rule from --responses (see mock_responses.yaml), or a generic paragraph.
+
+Latency and failures are drawn from per-attempt seeded RNGs: time to first token is log-normal around --ttft-ms, output is paced at --tokens-per-second, and --rate-limit-rate / --server-error-rate / --hang-rate make that share of attempts return a 429, a 500 or never finish (until --hang-seconds). Retries of the same request are separate attempts, so they can succeed.
+
+Run from the repository root, then point a pipeline's base_url at http://127.0.0.1:8100/v1:
+    python -m benchmarks.mock_server --port 8100 --ttft-ms 300 --tokens-per-second 80 --rate-limit-rate 0.02
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import uvicorn
+import yaml
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DEFAULT_RESPONSES_PATH = "benchmarks/mock_responses.yaml"
+MARKER_LINES_TRIED = 3
+FALLBACK_RESPONSE = (
+    "The passage describes a sequence of events and the reasons behind them. "
+    "Each claim it makes is supported by the surrounding text, and the overall "
+    "argument is coherent and complete."
+)
+
+
+def digest(*parts):
+    return hashlib.sha256(
+        "\x1f".join(str(part) for part in parts).encode("utf-8")
+    ).hexdigest()
+
+
+def approximate_tokens(text):
+    return max(1, len(text) // 4) if text else 0
+
+
+def apply_stop(text, stop):
+    if not stop:
+        return text, False
+    if isinstance(stop, str):
+        stop = [stop]
+    cut = min((text.find(s) for s in stop if s and s in text), default=-1)
+    if cut == -1:
+        return text, False
+    return text[:cut], True
+
+
+def truncate_to_tokens(text, max_tokens):
+    if not max_tokens or approximate_tokens(text) <= max_tokens:
+        return text, False
+    return text[: max_tokens * 4], True
+
+
+def load_response_rules(path):
+    """Reads a YAML list of {match: regex, response: text}. Rules answer prompts that have no few-shot examples to copy from."""
+    if not path:
+        return []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            rules = yaml.safe_load(f) or []
+    except FileNotFoundError:
+        print(f"[Mock] no response rules at {path}, using the generic fallback")
+        return []
+    return [(re.compile(rule["match"], re.DOTALL), rule["response"]) for rule in rules]
+
+
+def example_completions(prompt, stop):
+    # completion prompts repeat the same marker (e.g. "### Response:") before every example answer and once more at the end, where the model is meant to continue. The very last line is sometimes a prefill that the examples do not share, so the last few lines are tried in turn
+    lines = [line.strip() for line in prompt.rstrip().splitlines() if line.strip()]
+    for marker in reversed(lines[-MARKER_LINES_TRIED:]):
+        pieces = prompt.split(marker)[1:-1]
+        examples = []
+        for piece in pieces:
+            example, _ = apply_stop(piece, stop)
+            example = example.strip()
+            if example:
+                examples.append(example)
+        if examples:
+            return examples
+    return []
+
+
+def choose_response(settings, examples, rule_text, key):
+    if examples:
+        return examples[int(digest(settings.seed, key), 16) % len(examples)]
+    for pattern, response in settings.rules:
+        if pattern.search(rule_text):
+            return response
+    return FALLBACK_RESPONSE
+
+
+def chat_response_text(settings, body):
+    messages = body.get("messages", [])
+    examples = [
+        message["content"]
+        for message in messages[:-1]
+        if message.get("role") == "assistant" and message.get("content")
+    ]
+    key = messages[-1].get("content", "") if messages else ""
+    rule_text = "\n".join(str(message.get("content", "")) for message in messages)
+    return choose_response(settings, examples, rule_text, key)
+
+
+def completion_response_text(settings, body):
+    prompt = body.get("prompt", "")
+    if isinstance(prompt, list):
+        prompt = prompt[0] if prompt else ""
+    examples = example_completions(prompt, body.get("stop"))
+    # the key is the tail of the prompt, which is where the actual input is
+    return choose_response(settings, examples, prompt, prompt[-2000:])
+
+
+class MockSettings:
+    def __init__(self, args):
+        self.seed = args.seed
+        self.ttft_ms = args.ttft_ms
+        self.ttft_sigma = args.ttft_sigma
+        self.tokens_per_second = args.tokens_per_second
+        self.rate_limit_rate = args.rate_limit_rate
+        self.server_error_rate = args.server_error_rate
+        self.hang_rate = args.hang_rate
+        self.hang_seconds = args.hang_seconds
+        self.chunk_tokens = args.chunk_tokens
+        self.rules = load_response_rules(args.responses)
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.attempts = Counter()  # request digest -> attempts seen, so retries draw fresh latencies and failures
+        self.started = time.time()
+
+    def next_attempt(self, request_digest):
+        with self.lock:
+            self.attempts[request_digest] += 1
+            return self.attempts[request_digest]
+
+    def add(self, **counts):
+        with self.lock:
+            self.counts.update(counts)
+
+    def to_dict(self):
+        with self.lock:
+            return {"uptime_seconds": time.time() - self.started, **self.counts}
+
+
+def draw_outcome(settings, rng):
+    roll = rng.random()
+    if roll < settings.rate_limit_rate:
+        return "rate_limited"
+    roll -= settings.rate_limit_rate
+    if roll < settings.server_error_rate:
+        return "server_error"
+    roll -= settings.server_error_rate
+    if roll < settings.hang_rate:
+        return "hung"
+    return "ok"
+
+
+def draw_ttft(settings, rng):
+    if settings.ttft_ms <= 0:
+        return 0.0
+    return settings.ttft_ms / 1000 * math.exp(rng.gauss(0, settings.ttft_sigma))
+
+
+def generation_seconds(settings, tokens):
+    if settings.tokens_per_second <= 0:
+        return 0.0
+    return tokens / settings.tokens_per_second
+
+
+def error_response(outcome):
+    if outcome == "rate_limited":
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": "1"},
+            content={"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_exceeded"}},
+        )
+    return JSONResponse(
+        status_code=500,
+        content={"error": {"message": "Internal server error (mock)", "type": "server_error"}},
+    )
+
+
+def make_app(settings):
+    app = FastAPI(title="Augmentoolkit mock inference server")
+    stats = MockStats()
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats.to_dict()
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]}
+
+    async def handle(request, chat):
+        body = await request.json()
+        request_digest = digest(json.dumps(body, sort_keys=True))
+        attempt = stats.next_attempt(request_digest)
+        rng = random.Random(digest(settings.seed, request_digest, attempt))
+        stats.add(requests=1)
+
+        outcome = draw_outcome(settings, rng)
+        if outcome == "hung":
+            stats.add(hung=1)
+            await asyncio.sleep(settings.hang_seconds)
+            return error_response("server_error")
+        if outcome != "ok":
+            stats.add(**{outcome: 1})
+            return error_response(outcome)
+
+        text = chat_response_text(settings, body) if chat else completion_response_text(settings, body)
+        text, stopped = apply_stop(text, body.get("stop"))
+        text, truncated = truncate_to_tokens(text, body.get("max_tokens"))
+        finish_reason = "length" if truncated else "stop"
+        payload = body.get("messages") if chat else body.get("prompt")
+        usage = {
+            "prompt_tokens": approximate_tokens(json.dumps(payload)),
+            "completion_tokens": approximate_tokens(text),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        stats.add(completed=1, completion_tokens=usage["completion_tokens"])
+
+        ttft = draw_ttft(settings, rng)
+        response_id = f"mock-{request_digest[:12]}-{attempt}"
+        model = body.get("model", "mock")
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await asyncio.sleep(ttft + generation_seconds(settings, usage["completion_tokens"]))
+            choice = (
+                {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}
+                if chat
+                else {"index": 0, "text": text, "finish_reason": finish_reason, "logprobs": None}
+            )
+            return {
+                "id": response_id,
+                "object": "chat.completion" if chat else "text_completion",
+                "created": created,
+                "model": model,
+                "choices": [choice],
+                "usage": usage,
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+        object_name = "chat.completion.chunk" if chat else "text_completion"
+
+        def chunk(choices, **extra):
+            return "data: " + json.dumps(
+                {"id": response_id, "object": object_name, "created": created, "model": model, "choices": choices, **extra}
+            ) + "\n\n"
+
+        def choice(piece, finish=None):
+            if chat:
+                return {"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": finish}
+            return {"index": 0, "text": piece, "finish_reason": finish, "logprobs": None}
+
+        async def events():
+            await asyncio.sleep(ttft)
+            step = settings.chunk_tokens * 4
+            delay = generation_seconds(settings, settings.chunk_tokens)
+            for start in range(0, len(text), step):
+                yield chunk([choice(text[start : start + step])])
+                if delay:
+                    await asyncio.sleep(delay)
+            yield chunk([choice("", finish_reason)])
+            if include_usage:
+                yield chunk([], usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        return await handle(request, chat=True)
+
+    @app.post("/v1/completions")
+    async def completions(request: Request):
+        return await handle(request, chat=False)
+
+    return app
+
+
+def add_mock_arguments(parser):
+    parser.add_argument("--seed", type=int, default=1048596)
+    parser.add_argument("--ttft-ms", type=float, default=200.0, help="Median time to first token.")
+    parser.add_argument("--ttft-sigma", type=float, default=0.5, help="Log-normal spread of the time to first token.")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0, help="Output pacing; 0 sends everything at once.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of attempts answered with a 429.")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="Share of attempts answered with a 500.")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="Share of attempts that never finish.")
+    parser.add_argument("--hang-seconds", type=float, default=600.0, help="How long a hung attempt stays open.")
+    parser.add_argument("--chunk-tokens", type=int, default=4, help="Approximate tokens per streamed chunk.")
+    parser.add_argument("--responses", default=DEFAULT_RESPONSES_PATH, help="YAML rules for prompts without few-shot examples.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic mock OpenAI-compatible server for offline benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(make_app(MockSettings(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""Runs the core pipelines end to end against the mock inference server and reports how fast the orchestration layer gets through them.
+
+Each pipeline runs in its own process, over a synthetic corpus of --docs plain-text documents of about --words-per-doc words each, with its own config.yaml (placeholders filled in, subsets and phases off) pointed at the mock server from benchmarks/mock_server.py. Because the mock is deterministic and answers from the prompts' own few-shot examples, two runs with the same arguments send the same requests, and differences in the numbers come from our code.
+
+Reported per pipeline:
+  items/s            synthetic documents processed per second of wall-clock time
+  stages             wall-clock window of every step, from its first run() starting to its last one finishing, and how many runs it had
+  peak RSS           of the process the pipeline ran in
+  event-loop lag     how late a 50 ms timer on the pipeline's loop fired (p50/p99/max); anything large means something is blocking the loop
+  requests           per-step request counts, errors and p95 latency from request_metrics.py
+
+Run from the repository root:
+    python -m benchmarks.pipeline_benchmark --docs 200 --pipelines factual repvar --ttft-ms 50 --tokens-per-second 0 --report bench.json
+
+Needs the pipelines' own requirements plus fastapi and uvicorn for the mock server. Chunking and the token counters still load a real tokenizer; on a machine that cannot reach the Hugging Face hub, set AUGMENTOOLKIT_TOKENIZER to a local tokenizer directory (any will do, the counts only have to be consistent between runs) and HF_HUB_OFFLINE=1.
+
+Reference run (--docs 20 --ttft-ms 50 --tokens-per-second 0, streaming, default concurrency, a small local BPE tokenizer):
+  factual     3.9 s, 5.10 items/s,  25 requests, peak RSS 381 MB, loop lag p99 0.9 s
+  repvar     13.0 s, 1.54 items/s, 120 requests, peak RSS 339 MB, loop lag p99 0.8 s
+  rptoolkit  47.7 s, 0.42 items/s, 120 requests, peak RSS 709 MB, loop lag max 24.7 s
+The rptoolkit lag is its repetition validator (find_frequent_substrings in rptoolkit_helpers.py), which runs on the event loop; one stall was long enough for a request to fail with a connection error and be retried.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import yaml
+
+from benchmarks.mock_server import add_mock_arguments
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PIPELINES = {
+    "factual": {
+        "node": "generation.core_pipelines.factual_generation_individual.factual_generation.generate_factual_qa_dataset",
+        "config": "generation/core_pipelines/factual_generation_individual/config.yaml",
+        "overrides": {
+            "use_subset": False,
+            "work_in_phases": False,
+            "use_gutenberg": False,
+            "push_to_hub": False,
+            "do_meta_datagen": False,
+            "use_response_cache": False,
+        },
+    },
+    "repvar": {
+        "node": "generation.core_pipelines.representation_variation.repvar.representation_variation_pipeline",
+        "config": "generation/core_pipelines/representation_variation/config.yaml",
+        "overrides": {
+            "use_subset": False,
+            "do_meta_datagen": False,
+            "dataset_context": "Synthetic benchmark corpus",
+        },
+    },
+    "rptoolkit": {
+        "node": "generation.core_pipelines.rptoolkit.rptoolkit.rptoolkit_pipeline",
+        "config": "generation/core_pipelines/rptoolkit/config.yaml",
+        "overrides": {
+            "use_subset": False,
+            "work_in_phases": False,
+            "do_meta_datagen": False,
+        },
+    },
+}
+
+LOOP_LAG_INTERVAL = 0.05
+
+WORDS = (
+    "river harbor council merchant engine winter archive soldier garden treaty "
+    "lantern village theory signal market bridge captain letter voyage record "
+    "mountain forest canal factory scholar harvest charter fortress island machine"
+).split()
+VERBS = "built crossed studied described changed recorded defended measured opened carried".split()
+ADJECTIVES = "old northern quiet famous narrow distant careful early large stubborn".split()
+
+
+def make_corpus(input_dir, docs, words_per_doc, seed):
+    rng = random.Random(seed)
+    os.makedirs(input_dir, exist_ok=True)
+    for doc in range(docs):
+        sentences = []
+        words = 0
+        while words < words_per_doc:
+            sentence = (
+                f"The {rng.choice(ADJECTIVES)} {rng.choice(WORDS)} {rng.choice(VERBS)} "
+                f"the {rng.choice(WORDS)} near the {rng.choice(ADJECTIVES)} {rng.choice(WORDS)} "
+                f"in the year {rng.randint(1500, 1950)}."
+            )
+            sentences.append(sentence)
+            words += len(sentence.split())
+        paragraphs = [" ".join(sentences[i : i + 6]) for i in range(0, len(sentences), 6)]
+        with open(os.path.join(input_dir, f"document_{doc:05d}.txt"), "w", encoding="utf-8") as f:
+            f.write("\n\n".join(paragraphs))
+
+
+def load_benchmark_config(pipeline, input_dir, output_dir, mock_url, args):
+    from run_augmentoolkit import flatten_config
+
+    with open(pipeline["config"], "r", encoding="utf-8") as f:
+        # shipped configs use !!PLACEHOLDER!! for things the user must fill in, which is not loadable YAML on its own
+        config = yaml.safe_load(f.read().replace("!!PLACEHOLDER!!", "placeholder")) or {}
+    flattened = flatten_config(config, no_flatten_keys=config.get("no_flatten", []))
+    flattened.update(pipeline["overrides"])
+    flattened.update(
+        input_dir=input_dir,
+        output_dir=output_dir,
+        small_base_url=mock_url,
+        large_base_url=mock_url,
+        small_api_key="mock",
+        large_api_key="mock",
+        small_model="mock-small",
+        large_model="mock-large",
+        small_mode="api",
+        large_mode="api",
+        task_id=None,
+    )
+    if args.concurrency is not None:
+        flattened["concurrency_limit"] = args.concurrency
+    if args.stream is not None:
+        flattened["stream_responses"] = args.stream
+    return flattened
+
+
+class StageTimer:
+    """Wraps run() on the step classes to record, per step, when its first run started, when its last one finished, and how many there were."""
+
+    def __init__(self):
+        self.stages = {}
+        self.active = contextvars.ContextVar("timed_step", default=None)
+
+    def install(self):
+        from augmentoolkit.generation_functions.depth_first_pipeline_step_class import DepthFirstPipelineStep
+        from augmentoolkit.generation_functions.majority_vote_step import MajorityVoteStep
+        from augmentoolkit.generation_functions.one_to_many_step import OneToManyStep
+        from augmentoolkit.generation_functions.pipeline_step_class import PipelineStep
+        from augmentoolkit.generation_functions.random_variation_step_class import RandomVariationStep
+        from augmentoolkit.generation_functions.single_generation_step import SingleGenerationStep
+
+        for step_class in (
+            PipelineStep,
+            MajorityVoteStep,
+            OneToManyStep,
+            RandomVariationStep,
+            DepthFirstPipelineStep,
+            SingleGenerationStep,
+        ):
+            if "run" in step_class.__dict__:
+                step_class.run = self.wrap(step_class.run)
+
+    def wrap(self, run):
+        timer = self
+
+        async def timed_run(step, *args, **kwargs):
+            if timer.active.get() is step:  # a subclass calling super().run(); already being timed
+                return await run(step, *args, **kwargs)
+            token = timer.active.set(step)
+            started = time.perf_counter()
+            try:
+                return await run(step, *args, **kwargs)
+            finally:
+                timer.record(step, started, time.perf_counter())
+                timer.active.reset(token)
+
+        return timed_run
+
+    def record(self, step, started, finished):
+        label = step.prompt_path or step.output_file or type(step).__name__
+        stage = self.stages.setdefault(
+            label, {"first_start": started, "last_end": finished, "runs": 0}
+        )
+        stage["first_start"] = min(stage["first_start"], started)
+        stage["last_end"] = max(stage["last_end"], finished)
+        stage["runs"] += 1
+
+    def report(self, origin):
+        return {
+            label: {
+                "start_seconds": round(stage["first_start"] - origin, 3),
+                "wall_seconds": round(stage["last_end"] - stage["first_start"], 3),
+                "runs": stage["runs"],
+            }
+            for label, stage in sorted(self.stages.items(), key=lambda item: item[1]["first_start"])
+        }
+
+
+async def monitor_loop_lag(samples, interval=LOOP_LAG_INTERVAL):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB elsewhere
+
+
+def run_pipeline_benchmark(name, args, mock_url, work_dir, results):
+    # runs in a child process, so that peak RSS and the loaded modules belong to this pipeline alone
+    from augmentoolkit.generation_functions.request_metrics import metrics_snapshot
+    from run_augmentoolkit import load_function_from_path
+
+    pipeline = PIPELINES[name]
+    input_dir = os.path.join(work_dir, "inputs")
+    output_dir = os.path.join(work_dir, "outputs")
+    make_corpus(input_dir, args.docs, args.words_per_doc, args.seed)
+    config = load_benchmark_config(pipeline, input_dir, output_dir, mock_url, args)
+    function = load_function_from_path(pipeline["node"])
+
+    stage_timer = StageTimer()
+    stage_timer.install()
+    lag_samples = []
+
+    async def run():
+        monitor = asyncio.create_task(monitor_loop_lag(lag_samples))
+        try:
+            await function(**config)
+        finally:
+            monitor.cancel()
+
+    started = time.perf_counter()
+    error = None
+    try:
+        asyncio.run(run())
+    except Exception as e:
+        error = repr(e)
+    elapsed = time.perf_counter() - started
+
+    series = metrics_snapshot()["series"]
+    results.put(
+        {
+            "pipeline": name,
+            "error": error,
+            "docs": args.docs,
+            "wall_seconds": round(elapsed, 3),
+            "items_per_second": round(args.docs / elapsed, 3) if elapsed else None,
+            "peak_rss_mb": peak_rss_mb(),
+            "loop_lag_ms": {
+                "p50": (percentile(lag_samples, 0.5) or 0) * 1000,
+                "p99": (percentile(lag_samples, 0.99) or 0) * 1000,
+                "max": max(lag_samples, default=0) * 1000,
+            },
+            "stages": stage_timer.report(started),
+            "requests": [
+                {
+                    "engine": s["engine"],
+                    "step": s["step"],
+                    "requests": s["requests"],
+                    "timeouts": s["timeouts"],
+                    "errors": s["errors"],
+                    "latency_p95_seconds": s["histograms"]["latency_seconds"]["p95"],
+                }
+                for s in series
+            ],
+        }
+    )
+
+
+def wait_for_server(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"mock server did not come up at {url}")
+
+
+def get_json(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.load(response)
+
+
+def start_mock_server(args):
+    command = [sys.executable, "-m", "benchmarks.mock_server", "--port", str(args.port)]
+    for option in (
+        "seed",
+        "ttft_ms",
+        "ttft_sigma",
+        "tokens_per_second",
+        "rate_limit_rate",
+        "server_error_rate",
+        "hang_rate",
+        "hang_seconds",
+        "chunk_tokens",
+        "responses",
+    ):
+        command += ["--" + option.replace("_", "-"), str(getattr(args, option))]
+    server = subprocess.Popen(command)
+    try:
+        wait_for_server(f"http://127.0.0.1:{args.port}/health")
+    except Exception:
+        server.terminate()
+        raise
+    return server
+
+
+def collect_result(name, process, results):
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                return {"pipeline": name, "error": f"benchmark process exited with code {process.exitcode}"}
+
+
+def print_result(result, mock_stats):
+    print(f"\n=== {result['pipeline']} ===")
+    if result["error"]:
+        print(f"FAILED: {result['error']}")
+    if "wall_seconds" not in result:
+        return
+    print(
+        f"{result['docs']} docs in {result['wall_seconds']:.1f} s -> {result['items_per_second']:.2f} items/s, "
+        f"peak RSS {result['peak_rss_mb'] or 0:.0f} MB"
+    )
+    lag = result["loop_lag_ms"]
+    print(f"event-loop lag: p50 {lag['p50']:.1f} ms, p99 {lag['p99']:.1f} ms, max {lag['max']:.1f} ms")
+    print("stages:")
+    for label, stage in result["stages"].items():
+        print(
+            f"  {label}: {stage['wall_seconds']:.2f} s (from {stage['start_seconds']:.2f} s, {stage['runs']} runs)"
+        )
+    total_requests = sum(r["requests"] for r in result["requests"])
+    total_errors = sum(sum(r["errors"].values()) for r in result["requests"])
+    print(f"requests: {total_requests} completed, {total_errors} transport errors; mock server: {mock_stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the core pipelines offline against the mock inference server."
+    )
+    parser.add_argument("--pipelines", nargs="+", choices=sorted(PIPELINES), default=sorted(PIPELINES))
+    parser.add_argument("--docs", type=int, default=50, help="Synthetic documents in the corpus.")
+    parser.add_argument("--words-per-doc", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=None, help="Override the configs' concurrency_limit.")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=None, help="Override stream_responses.")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--mock-url", default=None, help="Use an already running mock server (its /v1 base URL) instead of starting one.")
+    parser.add_argument("--report", default=None, help="Write all results to this JSON file.")
+    parser.add_argument("--keep-outputs", action="store_true", help="Keep each run's corpus and outputs and print where they are.")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server = None
+    mock_url = args.mock_url
+    if mock_url is None:
+        server = start_mock_server(args)
+        mock_url = f"http://127.0.0.1:{args.port}/v1"
+    stats_url = mock_url.rstrip("/").rsplit("/v1", 1)[0] + "/stats"
+
+    context = multiprocessing.get_context("spawn")
+    all_results = []
+    try:
+        for name in args.pipelines:
+            work_dir = tempfile.mkdtemp(prefix=f"atk_bench_{name}_")
+            before = get_json(stats_url)
+            results = context.Queue()
+            process = context.Process(
+                target=run_pipeline_benchmark, args=(name, args, mock_url, work_dir, results)
+            )
+            process.start()
+            result = collect_result(name, process, results)
+            process.join()
+            after = get_json(stats_url)
+            mock_stats = {
+                key: value - before.get(key, 0)
+                for key, value in after.items()
+                if key != "uptime_seconds"
+            }
+            result["mock_server"] = mock_stats
+            all_results.append(result)
+            print_result(result, mock_stats)
+            if args.keep_outputs:
+                print(f"outputs kept in {work_dir}")
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"arguments": vars(args), "results": all_results}, f, indent=2)
+        print(f"\nreport written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,29 @@
 # import glob
 import glob
 import hashlib
+import heapq
+import itertools
 import json
+import multiprocessing
 import os
 import io
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from generation.core_components.ingest_cache import (
+    IngestCache,
+    chunk_key,
+    read_key,
+)
+from generation.core_components.tokenizer_registry import (
+    count_tokens,
+    count_tokens_specific_model,
+    default_tokenizer_name,
+    get_tokenizer,
+)
 from nltk.tokenize import sent_tokenize
 import nltk  # NOTE to get this performing at all I need to make it so that chunking is cached and read from that cache instead ofbeing redone each time. Way too slow for large datasets. Which we are doing often and thus need to be cognizant of.
-
-nltk.download("punkt_tab")
 from tqdm import tqdm
-from transformers import AutoTokenizer
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 try:
@@ -200,70 +214,67 @@ except ImportError as e:
         )
 
 
-tokenizer = AutoTokenizer.from_pretrained("TheBloke/OpenHermes-2.5-Mistral-7B-GPTQ")
-
-
-def count_tokens(message):
-    return len(tokenizer.encode(message))
-
+TOKENIZE_BATCH_SIZE = 1024
 
-def count_tokens_specific_model(model):
-    tokenizer = AutoTokenizer.from_pretrained(model)
+# Reading and chunking fan out over a pool of worker processes, since every file and every document is independent of the others. Results come back in input order, so the chunk list, and the hash_input_list keys made from it, are exactly what the serial loop produced.
+# Starting workers is not free (each one imports this module, and a chunking worker loads the tokenizer, once, then keeps it for every document it is given), so small inputs are still handled in-process.
+# Both stages stream: iter_text yields documents and iter_chunks yields chunks as they are ready, with at most IN_FLIGHT_PER_WORKER items per worker being worked on, and .jsonl files are parsed a line at a time. read_text and chunk_text_list are list() of those; read_and_chunk_text with use_subset only ever holds the subset it is selecting, so its memory does not grow with the corpus.
+INGEST_MAX_WORKERS = 16
+PARALLEL_MIN_FILES = 16
+PARALLEL_MIN_CHARS = 4_000_000
+IN_FLIGHT_PER_WORKER = 4
 
-    def inner(message):
-        return len(tokenizer.encode(message))
 
-    return inner
+_punkt_checked = False
 
 
-def chunking_algorithm_file(
-    file_path="./input/input.txt",
-    max_token_length=1500,
-    keep_folder_structure=False,
-    input_dir="",
-):
+def ensure_punkt():
+    # sent_tokenize needs nltk's punkt_tab data. This used to be downloaded at import, which every spawned ingest worker repeated (and failed at, offline); now the parent process checks once, before chunking starts, and only downloads when the data is missing
+    global _punkt_checked
+    if _punkt_checked:
+        return
+    try:
+        nltk.data.find("tokenizers/punkt_tab")
+    except LookupError:
+        nltk.download("punkt_tab", quiet=True)
+    _punkt_checked = True
+
+
+def count_tokens_batch(messages):
+    # one call into the tokenizer for the whole list instead of one per string; gives the same counts as count_tokens. Done TOKENIZE_BATCH_SIZE strings at a time so a huge document's token ids are never all held at once
+    counts = []
+    for start in range(0, len(messages), TOKENIZE_BATCH_SIZE):
+        encoded = get_tokenizer()(
+            messages[start : start + TOKENIZE_BATCH_SIZE],
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )["input_ids"]
+        counts.extend(len(ids) for ids in encoded)
+    return counts
+
+
+def pack_chunks(content, basename, max_token_length):
     """
-    Combines format handling from Algorithm 1 with token-based chunking from Algorithm 2
-    Adds minimum length filtering from Algorithm 1
+    Splits content on blank lines and packs the paragraphs into chunks of at most max_token_length tokens. Paragraphs that are too long on their own are split into sentences. Chunks under 50 characters are dropped.
     """
+    # Paragraph token counts are computed for the whole document up front in batched tokenizer calls (the per-paragraph calls were what chunking spent its time on); sentences are only tokenized, again batched, for the rare paragraph that is over the limit. The packing itself is unchanged, so chunks come out exactly as before.
     chunks_with_source = []
     current_chunk = []
     token_count = 0
 
-    # From Algorithm 1: Enhanced format handling
-    if file_path.endswith(".pdf") or file_path.endswith(".docx"):
-        content = extract_text(file_path)
-    else:
-        with open(file_path, "r", encoding="utf-8", errors="ignore") as file:
-            content = file.read()
-
-    if not keep_folder_structure:
-        basename = os.path.basename(file_path)
-    else:
-        specific_source = (
-            file_path.replace(str(input_dir), "").lstrip("/").lstrip("./").lstrip("\\")
-        )
-        basename = specific_source
-        # print("BASENAME")
-        # print(basename)
-
-    # basename = os.path.basename(file_path)
-
     # From Algorithm 2: Paragraph splitting and token-based logic
-    paragraphs = content.split("\n\n")
-
-    for paragraph in paragraphs:
-        paragraph = paragraph.strip()
-        if not paragraph:
-            continue
-
-        paragraph_token_count = count_tokens(paragraph)
+    paragraphs = [paragraph.strip() for paragraph in content.split("\n\n")]
+    paragraphs = [paragraph for paragraph in paragraphs if paragraph]
+    paragraph_token_counts = count_tokens_batch(paragraphs)
 
+    for paragraph, paragraph_token_count in zip(paragraphs, paragraph_token_counts):
         if paragraph_token_count > max_token_length:
             # Algorithm 2's sentence tokenization approach
             sentences = sent_tokenize(paragraph)
-            for sentence in sentences:
-                sentence_token_count = count_tokens(sentence)
+            sentence_token_counts = count_tokens_batch(sentences)
+            for sentence, sentence_token_count in zip(
+                sentences, sentence_token_counts
+            ):
                 if token_count + sentence_token_count <= max_token_length:
                     current_chunk.append(sentence)
                     token_count += sentence_token_count
@@ -299,9 +310,17 @@ def chunking_algorithm_file(
     return chunks_with_source
 
 
-def chunking_algorithm_str(
-    content=None,
-    source_name="None",
+def chunk_source_name(source_name, keep_folder_structure=False, input_dir=""):
+    # the "metadata" every chunk of a source gets
+    if not keep_folder_structure:
+        return os.path.basename(source_name)
+    return (
+        source_name.replace(str(input_dir), "").lstrip("/").lstrip("./").lstrip("\\")
+    )
+
+
+def chunking_algorithm_file(
+    file_path="./input/input.txt",
     max_token_length=1500,
     keep_folder_structure=False,
     input_dir="",
@@ -310,70 +329,32 @@ def chunking_algorithm_str(
     Combines format handling from Algorithm 1 with token-based chunking from Algorithm 2
     Adds minimum length filtering from Algorithm 1
     """
-    chunks_with_source = []
-    current_chunk = []
-    token_count = 0
-    if not keep_folder_structure:
-        basename = os.path.basename(source_name)
+    # From Algorithm 1: Enhanced format handling
+    if file_path.endswith(".pdf") or file_path.endswith(".docx"):
+        content = extract_text(file_path)
     else:
-        specific_source = (
-            source_name.replace(str(input_dir), "")
-            .lstrip("/")
-            .lstrip("./")
-            .lstrip("\\")
-        )
-        basename = specific_source
-        # print("BASENAME")
-        # print(basename)
-
-    # From Algorithm 2: Paragraph splitting and token-based logic
-    paragraphs = content.split("\n\n")
-
-    for paragraph in paragraphs:
-        paragraph = paragraph.strip()
-        if not paragraph:
-            continue
-
-        paragraph_token_count = count_tokens(paragraph)
-
-        if paragraph_token_count > max_token_length:
-            # Algorithm 2's sentence tokenization approach
-            sentences = sent_tokenize(paragraph)
-            for sentence in sentences:
-                sentence_token_count = count_tokens(sentence)
-                if token_count + sentence_token_count <= max_token_length:
-                    current_chunk.append(sentence)
-                    token_count += sentence_token_count
-                else:
-                    chunks_with_source.append(
-                        {"text": " ".join(current_chunk), "metadata": basename}
-                    )
-                    current_chunk = [sentence]
-                    token_count = sentence_token_count
-        else:
-            # Algorithm 2's paragraph accumulation logic
-            if token_count + paragraph_token_count <= max_token_length:
-                current_chunk.append(paragraph)
-                token_count += paragraph_token_count
-            else:
-                chunks_with_source.append(
-                    {"text": " ".join(current_chunk), "metadata": basename}
-                )
-                current_chunk = [paragraph]
-                token_count = paragraph_token_count
+        with open(file_path, "r", encoding="utf-8", errors="ignore") as file:
+            content = file.read()
 
-    # Add final chunk
-    if current_chunk:
-        chunks_with_source.append(
-            {"text": " ".join(current_chunk), "metadata": basename}
-        )
+    basename = chunk_source_name(file_path, keep_folder_structure, input_dir)
+    ensure_punkt()
+    return pack_chunks(content, basename, max_token_length)
 
-    # From Algorithm 1: Minimum length filtering
-    chunks_with_source = [
-        chunk for chunk in chunks_with_source if len(chunk["text"]) >= 50
-    ]
 
-    return chunks_with_source
+def chunking_algorithm_str(
+    content=None,
+    source_name="None",
+    max_token_length=1500,
+    keep_folder_structure=False,
+    input_dir="",
+):
+    """
+    Combines format handling from Algorithm 1 with token-based chunking from Algorithm 2
+    Adds minimum length filtering from Algorithm 1
+    """
+    basename = chunk_source_name(source_name, keep_folder_structure, input_dir)
+    ensure_punkt()
+    return pack_chunks(content, basename, max_token_length)
 
 
 def read_jsonl_completions(input_dir="./input"):
@@ -402,82 +383,113 @@ def read_jsonl_completions(input_dir="./input"):
     return output_list
 
 
-def read_jsonl_file(file_path):
-    """
-    Reads a single JSONL file and extracts items with 'text' key.
-
-    Args:
-        file_path (str): Path to the JSONL file
-
-    Returns:
-        list: List of dictionaries with 'text' and 'metadata' keys
-    """
-    output_list = []
+def iter_jsonl_file(file_path):
+    # yields the 'text' of every object in the file; .jsonl is read a line at a time, a .json array has to be loaded whole
+    # Blank lines are skipped. A malformed line ends the file there: the texts before it have already been yielded and are kept, where reading the whole file up front used to drop all of it.
     try:
         with open(file_path, "r", encoding="utf-8") as f:
             if file_path.endswith(".json"):
                 data = json.load(f)  # Load entire JSON array
             else:  # JSONL
-                data = [json.loads(line) for line in f]
+                data = (json.loads(line) for line in f if line.strip())
 
             for item in data:
                 if "text" in item:
-                    output_list.append(
-                        {"text": item["text"], "metadata": os.path.basename(file_path)}
-                    )
+                    yield item["text"]
     except Exception as e:
         print(f"Error reading {file_path}: {e}")
 
-    return output_list
-
 
-def read_text(
-    input_dir=None,
-    extensions=[".txt", ".md", ".pdf", ".docx", ".epub", ".html", ".jsonl"],
-    output_dir=None,
-):
+def read_jsonl_file(file_path):
     """
-    Reads text files from a directory, handling various formats and optionally caching results.
+    Reads a single JSONL file and extracts items with 'text' key.
 
     Args:
-        input_dir (str): Directory to search for files.
-        extensions (list): File extensions to include.
-        output_dir (str, optional): Directory to save/load cached read results. If None, caching is disabled.
+        file_path (str): Path to the JSONL file
 
     Returns:
-        list: List of dictionaries, each with 'text' and 'metadata' keys.
+        list: List of dictionaries with 'text' and 'metadata' keys
     """
-    cache_path = None
-    if output_dir:
-        # Use absolute path for input_dir for consistent hashing
-        abs_input_dir = os.path.abspath(input_dir)
-        # Create a deterministic hash based on input directory and sorted extensions
-        extensions_string = json.dumps(sorted(extensions))
-        hash_content = f"{abs_input_dir}_{extensions_string}"
-        hasher = hashlib.md5(hash_content.encode())
-        cache_hash = hasher.hexdigest()
-        cache_filename = f"read_cache_{cache_hash}.json"
-        cache_path = os.path.join(output_dir, cache_filename)
-
-        # Ensure output directory exists
-        os.makedirs(output_dir, exist_ok=True)
-
-        # Check if cache exists
-        if os.path.exists(cache_path):
-            print(f"Loading cached read results from {cache_path}")
-            try:
-                with open(cache_path, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                print(
-                    f"Warning: Read cache file {cache_path} is corrupted. Re-reading."
-                )
-            except Exception as e:
-                print(
-                    f"Warning: Could not load read cache file {cache_path} due to error: {e}. Re-reading."
-                )
+    return [
+        {"text": text, "metadata": os.path.basename(file_path)}
+        for text in iter_jsonl_file(file_path)
+    ]
+
+
+def ingest_worker_count(workers=None):
+    if workers is None:
+        workers = min(multiprocessing.cpu_count(), INGEST_MAX_WORKERS)
+    return max(1, workers)
 
-    # Proceed with reading if no cache or cache failed
+
+def iter_in_order(
+    function, items, workers, desc, lookup=None, size=None, serial_until=0
+):
+    """
+    Yields (item, result, computed) for every item, in order. The result is lookup(item) when that is not None, otherwise function(item) (and computed is True).
+    With workers > 1, function runs in a pool of worker processes once the items seen so far add up to serial_until (counting size(item) each, or 1), with at most IN_FLIGHT_PER_WORKER items per worker submitted ahead of the one being yielded.
+    """
+    pool = None
+    pending = deque()  # (item, result or Future, computed), in input order
+    window = max(1, workers) * IN_FLIGHT_PER_WORKER
+    seen = 0
+    try:
+        for item in tqdm(items, desc=desc):
+            result = lookup(item) if lookup is not None else None
+            if result is not None:
+                pending.append((item, result, False))
+            else:
+                if pool is None and workers > 1 and seen >= serial_until:
+                    # spawn, not fork: pipelines call this from inside a running event loop, next to background threads (engine observers, the metrics writer) that fork would copy in whatever state they happen to be in
+                    pool = ProcessPoolExecutor(
+                        max_workers=workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                if pool is None:
+                    pending.append((item, function(item), True))
+                else:
+                    pending.append((item, pool.submit(function, item), True))
+            seen += size(item) if size is not None else 1
+
+            while pending and (
+                not isinstance(pending[0][1], Future) or len(pending) >= window
+            ):
+                item, result, computed = pending.popleft()
+                if isinstance(result, Future):
+                    result = result.result()
+                yield item, result, computed
+        while pending:
+            item, result, computed = pending.popleft()
+            if isinstance(result, Future):
+                result = result.result()
+            yield item, result, computed
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def read_source_file(text):
+    # returns the texts in a file (several for .jsonl, one otherwise); they depend only on the file's contents, which is what lets the ingest cache key them by its hash
+    if text.endswith(".pdf") or text.endswith(".docx"):
+        return [extract_text(text)]
+    elif text.endswith(".jsonl"):
+        return list(iter_jsonl_file(text))
+    else:
+        # Handle potential decoding errors by replacing problematic characters
+        with open(text, "r", encoding="utf-8", errors="replace") as f:
+            return [f.read()]
+
+
+def source_file_items(text, input_dir, loaded):
+    if text.endswith(".jsonl"):
+        metadata = text
+    else:
+        metadata = text.replace(input_dir, "").lstrip("/")
+    for item_text in loaded:
+        yield {"text": item_text, "metadata": metadata}
+
+
+def list_source_files(input_dir, extensions):
     source_texts = []
     for extension in extensions:
         print("Checking extension")
@@ -494,41 +506,77 @@ def read_text(
         absolute_input_dir = os.path.abspath(input_dir)
         print(f"Full absolute path of input directory: {absolute_input_dir}")
 
-    output_text_list = []
-    for text in tqdm(source_texts, desc="Reading"):
+    files = []
+    for text in source_texts:
         # Confirm if the path points to a file, not a folder with an extension
         if os.path.isdir(text):
             print(f"Skipping {text} as it's a directory with an extension, not a file")
             continue
-        if text.endswith(".pdf") or text.endswith(".docx"):
-            loaded = extract_text(text)
-        elif text.endswith(".jsonl"):
-            loaded = read_jsonl_file(text)
-            loaded_list = [
-                {"text": item_obj["text"], "metadata": text} for item_obj in loaded
-            ]
-            output_text_list.extend(loaded_list)
-            continue
-        else:
-            # Handle potential decoding errors by replacing problematic characters
-            loaded = open(text, "r", encoding="utf-8", errors="replace").read()
+        files.append(text)
+    return files
 
-        output_text_list.append(
-            {"text": loaded, "metadata": text.replace(input_dir, "").lstrip("/")}
-        )
 
-    # Save to cache if output_dir was provided
-    if cache_path:
-        print(f"Saving read results to cache: {cache_path}")
-        try:
-            with open(cache_path, "w", encoding="utf-8") as f:
-                json.dump(output_text_list, f, indent=4)
-        except Exception as e:
+def iter_text(
+    input_dir=None,
+    extensions=[".txt", ".md", ".pdf", ".docx", ".epub", ".html", ".jsonl"],
+    output_dir=None,
+    workers=None,
+):
+    """
+    Yields the documents read_text returns, in the same order, one at a time. .jsonl files are streamed a line at a time and are not cached (reading one is just parsing it).
+    """
+    files = list_source_files(input_dir, extensions)
+    workers = ingest_worker_count(workers)
+    if len(files) < PARALLEL_MIN_FILES:
+        workers = 1
+    cache = IngestCache(output_dir) if output_dir else None
+    counts = Counter()
+
+    def lookup(text):
+        if text.endswith(".jsonl"):
+            return iter_jsonl_file(text)
+        if cache is None:
+            return None
+        return cache.get(read_key(text, cache.file_digest(text)))
+
+    try:
+        for text, loaded, computed in iter_in_order(
+            read_source_file, files, workers, desc="Reading", lookup=lookup
+        ):
+            if cache is not None and not text.endswith(".jsonl"):
+                counts["read" if computed else "unchanged"] += 1
+                if computed:
+                    cache.put(read_key(text, cache.file_digest(text)), loaded)
+            yield from source_file_items(text, input_dir, loaded)
+    finally:
+        if cache is not None:
+            cache.close()
             print(
-                f"Warning: Could not save read cache file {cache_path} due to error: {e}"
+                f"[Ingest cache] Reading: {counts['unchanged']} files unchanged, {counts['read']} read"
             )
 
-    return output_text_list
+
+def read_text(
+    input_dir=None,
+    extensions=[".txt", ".md", ".pdf", ".docx", ".epub", ".html", ".jsonl"],
+    output_dir=None,
+    workers=None,
+):
+    """
+    Reads text files from a directory, handling various formats and optionally caching results.
+
+    Args:
+        input_dir (str): Directory to search for files.
+        extensions (list): File extensions to include.
+        output_dir (str, optional): Directory holding the ingest cache (see ingest_cache.py); only new or changed files are read. If None, caching is disabled.
+        workers (int, optional): Worker processes to read files with. Defaults to one per CPU (up to INGEST_MAX_WORKERS).
+
+    Returns:
+        list: List of dictionaries, each with 'text' and 'metadata' keys.
+    """
+    return list(
+        iter_text(input_dir, extensions, output_dir=output_dir, workers=workers)
+    )
 
 
 def write_text(output_dir, text_list):
@@ -576,12 +624,76 @@ def write_text(output_dir, text_list):
     return files_written
 
 
+def chunk_document(document, chunk_size):
+    # just the chunk texts; the metadata is added back by the caller, so what the cache stores depends only on the document's text
+    return [
+        chunk["text"]
+        for chunk in pack_chunks(document["text"], None, max_token_length=chunk_size)
+    ]
+
+
+def iter_chunks(
+    documents,
+    chunk_size=1500,
+    keep_folder_structure=False,
+    input_dir="",
+    output_dir=None,
+    workers=None,
+):
+    """
+    Yields the chunks chunk_text_list returns, in the same order, one at a time. documents can be any iterable, e.g. iter_text(...), and is only read as far as needed.
+    """
+    workers = ingest_worker_count(workers)
+    ensure_punkt()  # here, before any worker starts; chunk_document in the workers only reads the data
+    cache = IngestCache(output_dir) if output_dir else None
+    counts = Counter()
+
+    def lookup(document):
+        if cache is None:
+            return None
+        return cache.get(
+            chunk_key(document["text"], chunk_size, default_tokenizer_name())
+        )
+
+    try:
+        for document, chunk_list, computed in iter_in_order(
+            partial(chunk_document, chunk_size=chunk_size),
+            documents,
+            workers,
+            desc="Chunking",
+            lookup=lookup,
+            size=lambda document: len(document["text"]),
+            serial_until=PARALLEL_MIN_CHARS,
+        ):
+            if cache is not None:
+                counts["chunked" if computed else "unchanged"] += 1
+                if computed:
+                    cache.put(
+                        chunk_key(
+                            document["text"], chunk_size, default_tokenizer_name()
+                        ),
+                        chunk_list,
+                    )
+            basename = chunk_source_name(
+                document["metadata"], keep_folder_structure, input_dir
+            )
+            for chunk in chunk_list:
+                yield {"text": chunk, "metadata": basename}
+    finally:
+        if cache is not None:
+            cache.close()
+            print(
+                f"[Ingest cache] Chunking: {counts['unchanged']} documents unchanged, {counts['chunked']} chunked"
+            )
+
+
 def chunk_text_list(
     text_list,
     chunk_size=1500,
     keep_folder_structure=False,
     input_dir="",
     output_dir=None,
+    workers=None,
 ):
     """
     Chunks a list of text dictionaries, with optional caching.
@@ -591,61 +703,22 @@ def chunk_text_list(
         chunk_size (int): Maximum token length for chunks.
         keep_folder_structure (bool): Whether to preserve folder structure in metadata.
         input_dir (str): Input directory path (used if keep_folder_structure is True).
-        output_dir (str, optional): Directory to save/load cached chunks. If None, caching is disabled.
+        output_dir (str, optional): Directory holding the ingest cache (see ingest_cache.py); only new or changed documents are chunked. If None, caching is disabled.
+        workers (int, optional): Worker processes to chunk documents with. Defaults to one per CPU (up to INGEST_MAX_WORKERS).
 
     Returns:
         list: List of chunked dictionaries.
     """
-    cache_path = None
-    if output_dir:
-        # Create a deterministic hash based on sorted metadata
-        metadata_list = sorted([item["metadata"] for item in text_list])
-        metadata_string = json.dumps(
-            metadata_list
-        )  # Use json dump for consistent string representation
-        hasher = hashlib.md5(metadata_string.encode())
-        cache_hash = hasher.hexdigest()
-        cache_filename = f"chunk_cache_{cache_hash}_size{chunk_size}.json"
-        cache_path = os.path.join(output_dir, cache_filename)
-
-        # Ensure output directory exists
-        os.makedirs(output_dir, exist_ok=True)
-
-        # Check if cache exists
-        if os.path.exists(cache_path):
-            print(f"Loading cached chunks from {cache_path}")
-            try:
-                with open(cache_path, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                print(f"Warning: Cache file {cache_path} is corrupted. Re-chunking.")
-            except Exception as e:
-                print(
-                    f"Warning: Could not load cache file {cache_path} due to error: {e}. Re-chunking."
-                )
-
-    # Proceed with chunking if no cache or cache failed
-    chunks = []
-    for text in tqdm(text_list, desc="Chunking"):
-        new_chunks = chunking_algorithm_str(
-            text["text"],
-            text["metadata"],
-            max_token_length=chunk_size,
-            keep_folder_structure=keep_folder_structure,
-            input_dir=input_dir,
+    return list(
+        iter_chunks(
+            text_list,
+            chunk_size,
+            keep_folder_structure,
+            input_dir,
+            output_dir=output_dir,
+            workers=workers,
         )
-        chunks.extend(new_chunks)
-
-    # Save to cache if output_dir was provided
-    if cache_path:
-        print(f"Saving chunked data to cache: {cache_path}")
-        try:
-            with open(cache_path, "w", encoding="utf-8") as f:
-                json.dump(chunks, f, indent=4)
-        except Exception as e:
-            print(f"Warning: Could not save cache file {cache_path} due to error: {e}")
-
-    return chunks
+    )
 
 
 def read_and_chunk_text(
@@ -657,6 +730,7 @@ def read_and_chunk_text(
     keep_folder_structure=False,
     output_dir=None,
     seed=1048596,
+    workers=None,
 ):  # for splitting up documents
     # Print source texts for debugging
     # source_texts = []
@@ -664,38 +738,43 @@ def read_and_chunk_text(
     #         path = f"{input_dir}/**/*" + extension
     #         source_texts = source_texts + glob.glob(path, recursive=True)
 
-    # Use composition of read_text and chunk_text_list
-    text_list = read_text(input_dir, extensions, output_dir=output_dir)
-    sentence_chunks = chunk_text_list(
-        text_list, chunk_size, keep_folder_structure, input_dir, output_dir=output_dir
+    # Use composition of iter_text and iter_chunks; nothing is held in memory until the chunks are collected below
+    sentence_chunks = iter_chunks(
+        iter_text(input_dir, extensions, output_dir=output_dir, workers=workers),
+        chunk_size,
+        keep_folder_structure,
+        input_dir,
+        output_dir=output_dir,
+        workers=workers,
     )
     # print("Ran this")
 
     if (
         use_subset
     ):  # NOTE that because we subset after chunking, we can reuse the same chunk cache even for different runs with different seeds! Automatically! Good design by accident
-        if len(sentence_chunks) > subset_size:
-            # Sort chunks by hash of their text for deterministic selection
-            sentence_chunks = sorted(
-                sentence_chunks,
-                key=lambda x: hashlib.md5(
-                    str(seed).encode() + x["text"].encode()
-                ).hexdigest(),
-            )[:subset_size]
+        return subset_text_list(sentence_chunks, subset_size, seed)
 
-    return sentence_chunks
+    return list(sentence_chunks)
 
 
 def subset_text_list(text_list, subset_size=1500, seed=1048596):
-    if len(text_list) > subset_size:
-        # Sort chunks by hash of their text for deterministic selection
-        text_list = sorted(
-            text_list,
-            key=lambda x: hashlib.md5(
-                str(seed).encode() + x["text"].encode()
-            ).hexdigest(),
-        )[:subset_size]
-    return text_list
+    # text_list can be any iterable (e.g. iter_chunks(...)); only subset_size items are held at a time
+    # Sort chunks by hash of their text for deterministic selection. Ties keep their original order, and if there are no more than subset_size items they are all returned in their original order
+    counter = itertools.count()
+    selected = heapq.nsmallest(
+        subset_size,
+        (
+            (
+                hashlib.md5(str(seed).encode() + x["text"].encode()).hexdigest(),
+                next(counter),
+                x,
+            )
+            for x in text_list
+        ),
+    )
+    if next(counter) <= subset_size:
+        selected.sort(key=lambda entry: entry[1])
+    return [x for _, _, x in selected]
 
 
 def read_sharegpt_conversations(input_dir="./input"):
@@ -948,6 +1027,7 @@ def format_conversation_history(message_list):
     # Truncate if necessary
     if token_count > 30000:
         # Encode the string to get tokens
+        tokenizer = get_tokenizer()
         encoded_tokens = tokenizer.encode(conv_history_str)
         # Keep only the last 30000 tokens
         truncated_tokens = encoded_tokens[-30000:]
@@ -2,17 +2,11 @@ import datasets  # Add this with other importsimport json
 import argparse
 import random
 import numpy as np
-from transformers import AutoTokenizer
 import pandas as pd
 import os
 import logging
 
-# Initialize the tokenizer
-tokenizer = AutoTokenizer.from_pretrained("TheBloke/OpenHermes-2.5-Mistral-7B-GPTQ")
-
-
-def count_tokens(message):
-    return len(tokenizer.encode(message))
+from generation.core_components.tokenizer_registry import count_tokens
 
 
 def count_item_tokens(item, count_all_turns=False):
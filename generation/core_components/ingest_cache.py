@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import sqlite3
+import zlib
+
+# Per-file cache for read_text and chunk_text_list. Replaces the old whole-corpus caches (one JSON file keyed by the input directory, or by the sorted list of file names), where adding a single file threw everything away and editing a file without renaming it silently kept its stale chunks.
+# Read results are keyed by the hash of the file's bytes, chunks by the hash of the document's text, chunk_size and the tokenizer, and both by a version number that is bumped whenever reading or chunking changes what they produce. So only new or changed files are read and chunked again, and a file that was renamed or moved is not.
+# Everything lives in one sqlite file in the output directory (values are zlib-compressed JSON), written one entry at a time as files are read and documents chunked, so an interrupted run keeps what it got through. It also remembers the size and mtime each file had when it was hashed, like git's index, so unchanged files are not even read to find their hash; an incremental run costs time in proportion to what changed.
+
+EXTRACTOR_VERSION = 1  # bump when read_source_file / extract_text change what they return
+CHUNKER_VERSION = 1  # bump when pack_chunks changes how it splits text
+CACHE_FILENAME = "ingest_cache.sqlite"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def text_digest(text):
+    return hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def read_key(path, digest):
+    # the extension decides how a file is read, so the same bytes as .pdf and as .txt are different entries
+    extension = os.path.splitext(path)[1].lower()
+    return f"read|{EXTRACTOR_VERSION}|{extension}|{digest}"
+
+
+def chunk_key(text, chunk_size, tokenizer_id):
+    return f"chunk|{CHUNKER_VERSION}|{tokenizer_id}|{chunk_size}|{text_digest(text)}"
+
+
+class IngestCache:
+    def __init__(self, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        self.path = os.path.join(output_dir, CACHE_FILENAME)
+        try:
+            self.connection = self.connect()
+        except sqlite3.DatabaseError as e:
+            print(f"Warning: Ingest cache {self.path} is corrupted ({e}). Starting over.")
+            os.remove(self.path)
+            self.connection = self.connect()
+
+    def connect(self):
+        # autocommit, in WAL mode: reading and chunking stream through the same file with a connection each, and neither may hold a write lock while the other waits on it
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB)"
+        )
+        return connection
+
+    def file_digest(self, path):
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, digest FROM files WHERE path = ?", (path,)
+        ).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        digest = hash_file(path)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, digest),
+        )
+        return digest
+
+    def get(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?)",
+            (key, zlib.compress(json.dumps(value).encode("utf-8"))),
+        )
+
+    def close(self):
+        self.connection.close()
+
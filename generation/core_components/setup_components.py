@@ -1,9 +1,29 @@
 import asyncio
+from augmentoolkit.generation_functions.adaptive_limiter import (
+    AdaptiveConcurrencyLimiter,
+)
 from augmentoolkit.generation_functions.engine_wrapper_class import EngineWrapper
+from augmentoolkit.generation_functions.hedging import DEFAULT_HEDGE_BUDGET
+from augmentoolkit.generation_functions.queue_time import wait_for_excluding_queue
 import os
 import inspect
 
 
+def count_endpoints(base_url):
+    return len(base_url) if isinstance(base_url, (list, tuple)) else 1
+
+
+def make_limiter(concurrency_limit, max_concurrency_limit, base_url, name):
+    endpoints = count_endpoints(base_url)
+    return AdaptiveConcurrencyLimiter(
+        concurrency_limit * endpoints,
+        max_limit=(
+            max_concurrency_limit * endpoints if max_concurrency_limit else None
+        ),
+        name=name,
+    )
+
+
 def setup_semaphore_and_engines(
     concurrency_limit: int,
     small_model: str,
@@ -18,13 +38,37 @@ def setup_semaphore_and_engines(
     engine_output_observers=[],
     large_engine_input_observers=[],
     large_engine_output_observers=[],
+    response_cache=None,  # a ResponseCache shared by both engines; steps still have to opt in with cache_responses=True
+    adaptive_concurrency=False,  # opt-in: let each engine grow/shrink its own window of in-flight requests (see adaptive_limiter.py). concurrency_limit then stops being a global cap and becomes each engine's starting window per endpoint, which can grow to max_concurrency_limit
+    max_concurrency_limit=None,  # upper bound for each engine's window; defaults to 4x concurrency_limit
+    small_requests_per_minute=None,  # provider quotas; None means no client-side limit (see rate_limiter.py)
+    small_tokens_per_minute=None,
+    large_requests_per_minute=None,
+    large_tokens_per_minute=None,
+    hedge_percentile=None,  # opt-in request hedging for both engines; see hedging.py
+    hedge_budget=DEFAULT_HEDGE_BUDGET,
+    stream_responses=True,  # False fetches each response in one piece instead of token by token; batch steps never look at partial output
 ):
-    semaphore = asyncio.Semaphore(concurrency_limit)
+    small_limiter = None
+    large_limiter = None
+    if adaptive_concurrency:
+        # concurrency_limit is per endpoint, so an engine spread over several replicas gets a proportionally larger window
+        small_limiter = make_limiter(
+            concurrency_limit, max_concurrency_limit, small_base_url, "small model"
+        )
+        large_limiter = make_limiter(
+            concurrency_limit, max_concurrency_limit, large_base_url, "large model"
+        )
+        # the engines' windows do the real limiting now; this only keeps the number of tasks alive at once bounded. Tasks waiting for a window slot are queued, not timed (see queue_time.py)
+        semaphore = asyncio.Semaphore(small_limiter.max_limit + large_limiter.max_limit)
+    else:
+        semaphore = asyncio.Semaphore(concurrency_limit)
 
     async def run_task_with_limit(task, timeout=60):
         async with semaphore:
             try:
-                return await asyncio.wait_for(task, timeout=timeout)
+                # time spent waiting for an engine's concurrency window or rate limit does not count towards the timeout
+                return await wait_for_excluding_queue(task, timeout)
             except asyncio.TimeoutError:
                 print("[Timeout] A task exceeded the timeout limit.")
                 return None
@@ -34,20 +78,36 @@ def setup_semaphore_and_engines(
 
     engine_wrapper = EngineWrapper(
         model=small_model,
+        name="small model",
         api_key=small_api_key,
         base_url=small_base_url,
         mode=small_mode,
         input_observers=engine_input_observers,
         output_observers=engine_output_observers,
+        response_cache=response_cache,
+        concurrency_limiter=small_limiter,
+        requests_per_minute=small_requests_per_minute,
+        tokens_per_minute=small_tokens_per_minute,
+        hedge_percentile=hedge_percentile,
+        hedge_budget=hedge_budget,
+        stream=stream_responses,
     )
 
     engine_wrapper_large = EngineWrapper(
         model=large_model,
+        name="large model",
         api_key=large_api_key,
         base_url=large_base_url,
         mode=large_mode,
         input_observers=large_engine_input_observers,
         output_observers=large_engine_output_observers,
+        response_cache=response_cache,
+        concurrency_limiter=large_limiter,
+        requests_per_minute=large_requests_per_minute,
+        tokens_per_minute=large_tokens_per_minute,
+        hedge_percentile=hedge_percentile,
+        hedge_budget=hedge_budget,
+        stream=stream_responses,
     )
 
     return run_task_with_limit, engine_wrapper, engine_wrapper_large, semaphore
@@ -1,7 +1,7 @@
 import asyncio
 import logging
 from augmentoolkit.generation_functions.engine_wrapper_class import EngineWrapper
-from generation.core_components.chunking import count_tokens_specific_model
+from generation.core_components.tokenizer_registry import count_tokens_specific_model
 from jinja2 import Template
 import re
 
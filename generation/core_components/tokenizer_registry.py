@@ -0,0 +1,59 @@
+import os
+import threading
+
+from augmentoolkit.generation_functions.rate_limiter import estimate_tokens
+
+# Tokenizers are loaded on first use and then kept for the life of the process, one per model id. chunking.py and data_prep_operations.py used to load the default tokenizer at import time, so every pipeline subprocess paid for it (plus a hub lookup when the cache was cold) even if it never counted a token, and count_tokens_specific_model loaded a fresh copy on every call.
+# transformers itself is only imported on the first load too; importing it is a good part of the cost.
+# The default tokenizer is DEFAULT_TOKENIZER unless the AUGMENTOOLKIT_TOKENIZER environment variable (which the pipeline subprocesses started by tasks.py inherit) or set_default_tokenizer() says otherwise.
+# count_tokens_approximate needs no tokenizer at all (it is the characters-per-token estimate the rate limiter uses). Pass it as count_tokens_fn to the cost-estimation observers when rough numbers are enough.
+
+DEFAULT_TOKENIZER = "TheBloke/OpenHermes-2.5-Mistral-7B-GPTQ"
+
+_tokenizers = {}  # model id -> tokenizer
+_lock = threading.Lock()  # token counts are also taken on the observer thread
+_default_tokenizer = os.environ.get("AUGMENTOOLKIT_TOKENIZER") or DEFAULT_TOKENIZER
+
+
+def set_default_tokenizer(name):
+    global _default_tokenizer
+    _default_tokenizer = name or DEFAULT_TOKENIZER
+    # so worker processes started from here on (e.g. chunking's process pool) use the same one
+    os.environ["AUGMENTOOLKIT_TOKENIZER"] = _default_tokenizer
+
+
+def default_tokenizer_name():
+    return _default_tokenizer
+
+
+def get_tokenizer(name=None):
+    name = name or _default_tokenizer
+    tokenizer = _tokenizers.get(name)
+    if tokenizer is not None:
+        return tokenizer
+    with _lock:
+        if name not in _tokenizers:
+            from transformers import AutoTokenizer
+
+            os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+            _tokenizers[name] = AutoTokenizer.from_pretrained(name)
+        return _tokenizers[name]
+
+
+def count_tokens(message):
+    return len(get_tokenizer().encode(message))
+
+
+def count_tokens_specific_model(model):
+    tokenizer = get_tokenizer(
+        model
+    )  # loaded here rather than on the first count, so a missing tokenizer is reported by the caller that asked for it
+
+    def inner(message):
+        return len(tokenizer.encode(message))
+
+    return inner
+
+
+def count_tokens_approximate(message):
+    return estimate_tokens(message)
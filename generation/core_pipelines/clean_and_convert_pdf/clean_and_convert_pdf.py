@@ -102,7 +102,7 @@ async def pdf_clean_and_convert_pipeline(
         "name": "Large model",
     }
 
-    run_task_with_limit, engine_wrapper, engine_wrapper_large, _ = (
+    run_task_with_limit, engine_wrapper, engine_wrapper_large, semaphore = (
         setup_semaphore_and_engines(
             concurrency_limit,
             small_model,
@@ -158,8 +158,6 @@ async def pdf_clean_and_convert_pipeline(
         )
     )
 
-    semaphore = asyncio.Semaphore(concurrency_limit)
-
     async def run_task_with_limit(task):
         async with semaphore:
             return await task
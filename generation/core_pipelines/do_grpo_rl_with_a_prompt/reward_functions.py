@@ -15,6 +15,10 @@ REWARD_FUNCTIONS_DICT = {
     # "key": func
 }
 
+EVAL_ENGINE_WRAPPERS = {
+    # (model, base_url, api_key, mode): EngineWrapper
+}
+
 
 def register_reward_function(name):
     """Decorator to register a reward function."""
@@ -34,6 +38,19 @@ def get_func_for_str(str):
     return REWARD_FUNCTIONS_DICT[str]
 
 
+def get_eval_engine_wrapper(model, base_url, api_key, mode):
+    # reward functions are built again for every completion that gets scored, so the eval engine is kept around instead of being rebuilt each time
+    key = (model, base_url, api_key, mode)
+    if key not in EVAL_ENGINE_WRAPPERS:
+        EVAL_ENGINE_WRAPPERS[key] = EngineWrapper(
+            model=model,
+            base_url=base_url,
+            api_key=api_key,
+            mode=mode,
+        )
+    return EVAL_ENGINE_WRAPPERS[key]
+
+
 ###################### NOTE -- CUSTOM HELPERS #######################################
 
 
@@ -233,7 +250,7 @@ def llm_reward_func(
     assert (
         eval_llm_mode is not None
     ), "eval_llm_mode must be provided for generic_llm_reward"
-    engine_wrapper = EngineWrapper(
+    engine_wrapper = get_eval_engine_wrapper(
         model=eval_llm_name,
         base_url=eval_llm_base_url,
         api_key=eval_llm_api_key,
@@ -8,6 +8,11 @@ from augmentoolkit.generation_functions.hashing_and_ordering import hash_input_l
 from augmentoolkit.generation_functions.majority_vote_step import MajorityVoteStep
 from augmentoolkit.generation_functions.one_to_many_step import OneToManyStep
 from augmentoolkit.generation_functions.pipeline_step_class import PipelineStep
+from augmentoolkit.generation_functions.response_cache import open_response_cache
+from augmentoolkit.generation_functions.streaming_executor import (
+    StreamingStepExecutor,
+    make_run_task_with_limit,
+)
 from augmentoolkit.utils.cost_estimation_logging import (
     calculate_pipeline_cost_efficiency,
 )
@@ -54,8 +59,6 @@ from augmentoolkit.generation_functions.process_multiturn_functions import (
 import augmentoolkit.utils.create_pretraining_set
 import augmentoolkit.utils.sentence_chunking_algorithm
 from augmentoolkit.utils.parse_bool import parse_bool
-import asyncio
-import traceback
 
 import augmentoolkit.utils.group_by_text
 
@@ -130,6 +133,17 @@ async def generate_factual_qa_dataset(
     chunking_output_dir=None,
     task_id=None,
     seed=1048596,
+    use_response_cache=False,  # replay the filter, validation and repair responses of previous runs from output_dir/response_cache.sqlite
+    response_cache_max_mb=2048,
+    small_requests_per_minute=None,
+    small_tokens_per_minute=None,
+    large_requests_per_minute=None,
+    large_tokens_per_minute=None,
+    hedge_percentile=None,
+    hedge_budget=0.05,
+    stream_responses=True,
+    adaptive_concurrency=False,
+    max_concurrency_limit=None,
     **kwargs,
 ):
 
@@ -172,6 +186,7 @@ async def generate_factual_qa_dataset(
         result_key="judged_worthy_for_questions",
         output_file="judge_paragraph",
         details_key="judgement_details",
+        cache_responses=use_response_cache,
     )
 
     qatuples_gen_regex = re.compile(
@@ -247,7 +262,10 @@ async def generate_factual_qa_dataset(
         percent_true_to_pass=0.5,
         output_file="factual_questions",
         final_determination_key="question_validation_final",
+        parallel_votes=True,
         details_key="question_validation_details",
+        cache_responses=use_response_cache,
+        prefix_key="text",  # every question of a chunk is checked against the same text, which the prompt puts right after the few-shot examples
     )
 
     answer_relevancy_validation_step = MajorityVoteStep(
@@ -279,7 +297,10 @@ async def generate_factual_qa_dataset(
         output_file="factual_questions",
         result_key="answer_rel_votes",
         final_determination_key="answer_rel_validation_final",
+        parallel_votes=True,
         details_key="answer_relevancy_validation_details",
+        cache_responses=use_response_cache,
+        prefix_key="text",
     )  # I may want a prompt set for doing this with reasoning models. So that I can train my own model to do reasoning things on the distil
 
     answer_accuracy_validation_step = MajorityVoteStep(
@@ -311,7 +332,10 @@ async def generate_factual_qa_dataset(
         output_file="factual_questions",
         result_key="answer_acc_votes",
         final_determination_key="answer_acc_validation_final",
+        parallel_votes=True,
         details_key="answer_accuracy_validation_details",
+        cache_responses=use_response_cache,
+        prefix_key="text",
     )
 
     context_repairer_path = "check_qatuple_context_no_filenames"
@@ -344,6 +368,10 @@ async def generate_factual_qa_dataset(
         output_processor=extract_reasoning_from_context_check,
         result_key="repaired_context",  # we do not employ the result key because we replace the question and answer in the qa dict.
         details_key="context_repair_details",
+        cache_responses=use_response_cache,
+        prefix_key=(
+            "metadata" if use_filenames else None
+        ),  # this prompt does not include the chunk; after the few-shot examples (shared by every item anyway) it starts with the source's details
     )
 
     ### NOTE end definitions of pipeline steps
@@ -365,7 +393,14 @@ async def generate_factual_qa_dataset(
         "name": "Large model",
     }
 
-    run_task_with_limit, engine_wrapper, engine_wrapper_large, _ = (
+    response_cache = None
+    if use_response_cache:
+        response_cache = open_response_cache(
+            os.path.join(output_dir, "response_cache.sqlite"),
+            max_mb=response_cache_max_mb,
+        )
+
+    run_task_with_limit, engine_wrapper, engine_wrapper_large, semaphore = (
         setup_semaphore_and_engines(
             concurrency_limit,
             small_model,
@@ -376,6 +411,15 @@ async def generate_factual_qa_dataset(
             large_api_key,
             large_base_url,
             large_mode,
+            small_requests_per_minute=small_requests_per_minute,
+            small_tokens_per_minute=small_tokens_per_minute,
+            large_requests_per_minute=large_requests_per_minute,
+            large_tokens_per_minute=large_tokens_per_minute,
+            hedge_percentile=hedge_percentile,
+            hedge_budget=hedge_budget,
+            stream_responses=stream_responses,
+            adaptive_concurrency=adaptive_concurrency,
+            max_concurrency_limit=max_concurrency_limit,
             engine_input_observers=[
                 create_input_token_counter(
                     counter=small_token_counter,
@@ -421,11 +465,8 @@ async def generate_factual_qa_dataset(
         )
     )
 
-    semaphore = asyncio.Semaphore(concurrency_limit)
-
-    async def run_task_with_limit(task):
-        async with semaphore:
-            return await task
+    # shadows the rtwl from setup on purpose: no 60 s timeout and no errors turned into None (see make_run_task_with_limit)
+    run_task_with_limit = make_run_task_with_limit(semaphore)
 
     # notably, to be used as a node these things need to take their sentence chunks as input, not an input dir path. Which means that this step wouldn't actually fire. We won't be making a pretraining dataset in the original pipeline anymore since that's handled by repvar when run as part of a larger system.
     # We need to engineer better how to make pipelines vs nodes work. When in node mode, these things will behave different. When in pipeline mode they'll take a certain set of args vs when in node mode they'll take a certain other set. How do we represent this best? Perhaps ask AI. What is the cleanest and best way to engineer this such that pipelines can fulfill both the role of pipeline and node 1) without cluttering the code too much, 2) while maintaining the nice modularity of everything so far?
@@ -491,161 +532,138 @@ async def generate_factual_qa_dataset(
     )
 
     # The good thing about the api -- it extends into the future. The progress thing is as fundamental as you can get. So if/when we gain the ability to tie it directly to pipeline execution progress, the interface can stay the same, we'll just gain finer control. Until then, logfile viewing hack. We need to output things to a logfile...
-    await filter_all_questions_step.execute_pipeline(
-        input_dict=sentence_dict,
-        engine_wrapper=engine_wrapper,
-        rtwl=run_task_with_limit,
-        default_prompt_folder=default_prompts,
-        prompt_folder=prompts,
-        output_dir=output_dir,
-        completion_mode=completion_mode,
-        use_stop=use_stop,
-        include_details=do_meta_datagen,
-    )
 
-    filter_out_failed_items_dict(
-        sentence_dict, key_to_check="judged_worthy_for_questions"
-    )
-    set_progress(
-        task_id,
-        progress=0.2,
-        message=f"Chunks filtered! {len(sentence_dict.items())} items left; proceeding with questions dict generation",
-    )
-
-    # Right I forgot that to create one-to-many with the dicts it's pretty easy. Make a new dict and hash along the new output key + the hash of the para + the inner-index to control for duplicates within a group. Just got to change saving and loading?
+    # Everything from chunk filtering to context repair is per-item, so the steps are wired into one streaming graph: a question can be validated while other chunks are still being filtered, instead of every stage waiting on the slowest item of the previous one.
+    def copy_question_and_answer(key, entry):
+        entry["question"] = entry["qa_tuples"]["question"]
+        entry["answer"] = entry["qa_tuples"]["answer"]
+
+    def apply_repaired_context(key, entry):
+        if isinstance(entry["repaired_context"], bool):
+            # if this is the case, we need to set the repaired context question and answer to the same as the actual question and answer
+            entry["repaired_context"] = [entry["question"], entry["answer"]]
+        else:
+            # if the repaired context is a q/a tuple
+            entry["question"] = entry["repaired_context"][0]
+            entry["answer"] = entry["repaired_context"][1]
+
+    stage_progress = {
+        "filter_chunks": (
+            0.2,
+            "Chunks filtered! {} items left; proceeding with questions dict generation",
+        ),
+        "question_generation": (
+            0.3,
+            "Questions generated! {} questions made; proceeding with validation (if no steps are skipped)",
+        ),
+        "question_validation": (
+            0.4,
+            "Question validation completed! {} questions validated; proceeding with answer relevancy check (if not skipped)",
+        ),
+        "answer_relevancy_validation": (
+            0.5,
+            "Answer relevancy check completed! {} questions passed relevancy check; proceeding with answer accuracy check (if not skipped)",
+        ),
+        "answer_accuracy_validation": (
+            0.6,
+            "Answer accuracy check completed! {} questions passed accuracy check; proceeding with context repair (if not skipped)",
+        ),
+    }
 
-    # Generate questions
-    questions_dict = await question_generation_step.execute_pipeline(
-        input_dict=sentence_dict,
-        engine_wrapper=engine_wrapper_large,
+    def report_stage_progress(stage_name, passed):
+        if stage_name in stage_progress:
+            progress, message = stage_progress[stage_name]
+            set_progress(task_id, progress=progress, message=message.format(len(passed)))
+
+    # with adaptive_concurrency the engines' windows decide how many requests are really in flight, and the executor needs enough workers to fill them; otherwise concurrency_limit stays the global cap
+    executor_workers = (
+        sum(
+            wrapper.concurrency_limiter.max_limit
+            for wrapper in (engine_wrapper, engine_wrapper_large)
+            if wrapper.concurrency_limiter
+        )
+        or concurrency_limit
+    )
+    executor = StreamingStepExecutor(
         rtwl=run_task_with_limit,
+        concurrency_limit=executor_workers,
+        output_dir=output_dir,
         default_prompt_folder=default_prompts,
         prompt_folder=prompts,
-        output_dir=output_dir,
         completion_mode=completion_mode,
         use_stop=use_stop,
         include_details=do_meta_datagen,
+        on_stage_complete=report_stage_progress,
     )
-
-    for key, value in questions_dict.items():
-        # print("Iterating over items")
-        questions_dict[key]["question"] = value["qa_tuples"]["question"]
-        questions_dict[key]["answer"] = value["qa_tuples"]["answer"]
-        # print(value)
-
-    set_progress(
-        task_id,
-        progress=0.3,
-        message=f"Questions generated! {len(questions_dict.items())} questions made; proceeding with validation (if no steps are skipped)",
+    executor.add_stage(
+        "filter_chunks",
+        filter_all_questions_step,
+        engine_wrapper,
+        passes=lambda entry: bool(entry.get("judged_worthy_for_questions")),
     )
-
-    save_data(questions_dict, output_dir, "factual_questions")
+    executor.add_stage(
+        "question_generation",
+        question_generation_step,
+        engine_wrapper_large,
+        after="filter_chunks",
+        transform=copy_question_and_answer,
+    )
+    last_stage = "question_generation"
 
     if not skip_question_check:
-        await question_validation_step.execute_pipeline(
-            input_dict=questions_dict,
-            engine_wrapper=engine_wrapper_large,
-            rtwl=run_task_with_limit,
-            default_prompt_folder=default_prompts,
-            prompt_folder=prompts,
-            output_dir=output_dir,
-            completion_mode=completion_mode,
-            use_stop=use_stop,
-            include_details=do_meta_datagen,
-        )
-
-        filter_out_failed_items_dict(
-            questions_dict, key_to_check="question_validation_final"
+        executor.add_stage(
+            "question_validation",
+            question_validation_step,
+            engine_wrapper_large,
+            after=last_stage,
         )
-
-    set_progress(
-        task_id,
-        progress=0.4,
-        message=f"Question validation completed! {len(questions_dict.items())} questions validated; proceeding with answer relevancy check (if not skipped)",
-    )
+        last_stage = "question_validation"
 
     if not skip_answer_relevancy_check:
-        await answer_relevancy_validation_step.execute_pipeline(
-            input_dict=questions_dict,
-            engine_wrapper=engine_wrapper_large,
-            rtwl=run_task_with_limit,
-            default_prompt_folder=default_prompts,
-            prompt_folder=prompts,
-            output_dir=output_dir,
-            completion_mode=completion_mode,
-            use_stop=use_stop,
-            include_details=do_meta_datagen,
-        )
-
-        filter_out_failed_items_dict(
-            questions_dict, key_to_check="answer_rel_validation_final"
+        executor.add_stage(
+            "answer_relevancy_validation",
+            answer_relevancy_validation_step,
+            engine_wrapper_large,
+            after=last_stage,
         )
-    # INSERT_YOUR_CODE
-    set_progress(
-        task_id,
-        progress=0.5,
-        message=f"Answer relevancy check completed! {len(questions_dict.items())} questions passed relevancy check; proceeding with answer accuracy check (if not skipped)",
-    )
+        last_stage = "answer_relevancy_validation"
 
     if not skip_answer_accuracy_check:
-        await answer_accuracy_validation_step.execute_pipeline(
-            input_dict=questions_dict,
-            engine_wrapper=engine_wrapper_large,
-            rtwl=run_task_with_limit,
-            default_prompt_folder=default_prompts,
-            prompt_folder=prompts,
-            output_dir=output_dir,
-            completion_mode=completion_mode,
-            use_stop=use_stop,
-            include_details=do_meta_datagen,
+        executor.add_stage(
+            "answer_accuracy_validation",
+            answer_accuracy_validation_step,
+            engine_wrapper_large,
+            after=last_stage,
         )
+        last_stage = "answer_accuracy_validation"
 
-        filter_out_failed_items_dict(
-            questions_dict, key_to_check="answer_acc_validation_final"
+    if not skip_repair_qa_tuples:
+        executor.add_stage(
+            "context_repair",
+            context_repairer_step,
+            engine_wrapper_large,
+            after=last_stage,
+            passes=lambda entry: bool(
+                entry.get("repaired_context")
+            ),  # removes all failed items
+            transform=apply_repaired_context,
         )
+        last_stage = "context_repair"
 
-    # INSERT_YOUR_CODE
-    set_progress(
-        task_id,
-        progress=0.6,
-        message=f"Answer accuracy check completed! {len(questions_dict.items())} questions passed accuracy check; proceeding with context repair (if not skipped)",
-    )
+    stage_results = await executor.execute(sentence_dict)
 
-    if not skip_repair_qa_tuples:
-        await context_repairer_step.execute_pipeline(
-            input_dict=questions_dict,
-            engine_wrapper=engine_wrapper_large,
-            rtwl=run_task_with_limit,
-            default_prompt_folder=default_prompts,
-            prompt_folder=prompts,
-            output_dir=output_dir,
-            completion_mode=completion_mode,
-            use_stop=use_stop,
-            include_details=do_meta_datagen,
-        )
+    filter_out_failed_items_dict(
+        sentence_dict, key_to_check="judged_worthy_for_questions"
+    )
+    questions_dict = stage_results[last_stage]
+    print(
+        f"{len(sentence_dict)} chunks passed filtering, {len(stage_results['question_generation'])} questions generated, {len(questions_dict)} questions passed every check"
+    )
 
-        filter_out_failed_items_dict(
-            questions_dict, key_to_check="repaired_context"
-        )  # removes all failed items
-
-        print("Original length, pre-context-repair:")
-        print(len(questions_dict))
-        for key, value in questions_dict.items():
-            if isinstance(value["repaired_context"], bool):
-                # if this is the case, we need to set the repaired context question and answer to the same as the actual question and answer
-                value["repaired_context"] = [value["question"], value["answer"]]
-            else:
-                # if the repaired context is a q/a tuple
-                value["question"] = value["repaired_context"][0]
-                value["answer"] = value["repaired_context"][1]
-        print("New length, post-context repair")
-        print(len(questions_dict))
-
-    # INSERT_YOUR_CODE
     set_progress(
         task_id,
         progress=0.7,
-        message="Context repair completed; proceeding with cleanup and preparation for conversation generation",
+        message=f"Question generation, validation and context repair completed! {len(questions_dict.items())} questions left; proceeding with cleanup and preparation for conversation generation",
     )
 
     for key in questions_dict:
@@ -732,6 +750,9 @@ async def generate_factual_qa_dataset(
 
     cleanup_dir(output_dir=output_dir)
 
+    if response_cache:
+        response_cache.print_stats()
+
     calculate_pipeline_cost_efficiency(
         total_input_tokens=total_tokens,
         token_counters=[small_token_counter, large_token_counter],
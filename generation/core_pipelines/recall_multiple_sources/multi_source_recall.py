@@ -243,7 +243,7 @@ async def generate_multi_source_dataset(
         "name": "Large model",
     }
 
-    run_task_with_limit, engine_wrapper, engine_wrapper_large, _ = (
+    run_task_with_limit, engine_wrapper, engine_wrapper_large, semaphore = (
         setup_semaphore_and_engines(
             concurrency_limit,
             small_model,
@@ -299,8 +299,6 @@ async def generate_multi_source_dataset(
         )
     )
 
-    semaphore = asyncio.Semaphore(concurrency_limit)
-
     async def run_task_with_limit(task, timeout=180):
         async with semaphore:
             try:
@@ -368,6 +368,7 @@ async def rptoolkit_pipeline(
     chunking_output_dir=None,
     task_id=None,
     seed=1048596,
+    stream_responses=True,
     **kwargs,
 ):
     # in the final datagen for the meta thing, I will go over each of the outputs with R1 and classify whether it actually follows the instructions to the letter. And only take the best of them.  This additioanl quality control will ensure only the best gets through.
@@ -454,6 +455,7 @@ async def rptoolkit_pipeline(
             large_api_key,
             large_base_url,
             large_mode,
+            stream_responses=stream_responses,
             engine_input_observers=[
                 create_input_token_counter(
                     counter=small_token_counter,
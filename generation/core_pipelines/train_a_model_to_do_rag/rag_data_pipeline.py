@@ -138,7 +138,7 @@ async def rag_data_pipeline(
         "name": "Large model",
     }
 
-    run_task_with_limit, engine_wrapper, engine_wrapper_large, _ = (
+    run_task_with_limit, engine_wrapper, engine_wrapper_large, semaphore = (
         setup_semaphore_and_engines(
             concurrency_limit,
             small_model,
@@ -194,8 +194,6 @@ async def rag_data_pipeline(
         )
     )
 
-    semaphore = asyncio.Semaphore(concurrency_limit)
-
     async def run_task_with_limit(task):
         async with semaphore:
             return await task
@@ -117,7 +117,7 @@ async def example_pipeline(  # NOTE requirement: the pipeline must have the same
             large_api_key,
             large_base_url,
             large_mode,  # The most common pattern is for pipelines to have a large powerful model and a small less powerful but cheaper model, so that is what the semaphore and engines setup function creates. If you want more engine wrappers, you can make one with the EngineWrapper() class in engine_wrapper_class.py. pass the model, api key, base url, and mode. If you want just one engine wrapper, you can use this functoin but pass the same settings for both the small and large engine wrapper and assign the large engine wrapper to _
-            engine_input_observers=[  # input observers are called on all inputs JUST before they get sent to the LLM. They are useful for things like cost estimation or intermediate output logging for debugging purposes. create_input_token_counter, like most observers, is a higher-order function and returns a function.
+            engine_input_observers=[  # input observers are called on every input once its request is over (with the provider's token usage, when it reports one). They are useful for things like cost estimation or intermediate output logging for debugging purposes. create_input_token_counter, like most observers, is a higher-order function and returns a function.
                 create_input_token_counter(
                     counter=small_token_counter,
                     cost_per_million=cost_per_million_small_input,
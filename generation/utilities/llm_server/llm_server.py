@@ -30,7 +30,7 @@ from typing import List, Dict
 from nltk.tokenize import word_tokenize
 import nltk
 from augmentoolkit.generation_functions.engine_wrapper_class import EngineWrapper
-from generation.core_components.chunking import count_tokens_specific_model
+from generation.core_components.tokenizer_registry import count_tokens_specific_model
 from generation.core_components.simple_chat_loop import (
     format_messages_into_string,
     get_stop_tokens,
@@ -78,13 +78,12 @@ import uvicorn
 from augmentoolkit.generation_functions.engine_wrapper_class import EngineWrapper
 from tqdm import tqdm  # Import tqdm for progress bars
 import secrets
-from transformers import AutoTokenizer
 import string
 import re
 import json
-from generation.core_components.chunking import (
+from generation.core_components.chunking import chunking_algorithm_str, ensure_punkt
+from generation.core_components.tokenizer_registry import (
     count_tokens_specific_model,
-    chunking_algorithm_str,
 )
 from generation.core_components.simple_chat_loop import (
     format_messages_into_string,
@@ -114,6 +113,7 @@ try:
     nltk.data.find("tokenizers/punkt")
 except:
     nltk.download("punkt", quiet=True)
+ensure_punkt()  # word_tokenize needs punkt_tab too; chunking no longer downloads it at import
 
 
 def find_robust_offsets(haystack_raw: str, needle_raw: str):
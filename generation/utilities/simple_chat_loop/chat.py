@@ -9,7 +9,7 @@ from openai import AsyncOpenAI
 import uvicorn
 
 from augmentoolkit.generation_functions.engine_wrapper_class import EngineWrapper
-from generation.core_components.chunking import count_tokens
+from generation.core_components.tokenizer_registry import count_tokens
 from generation.core_components.simple_chat_loop import (
     format_messages_into_string,
     get_stop_tokens,
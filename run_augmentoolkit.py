@@ -23,6 +23,8 @@ if sys.stderr.encoding != 'utf-8':
 # ==============================================================================
 
 from resolve_path import resolve_path
+from augmentoolkit.generation_functions.request_metrics import start_metrics_summary
+from augmentoolkit.generation_functions.client_registry import close_clients
 
 
 def load_function_from_path(function_path):
@@ -126,6 +128,9 @@ def run_pipeline(node, config, override_fields={}):
     )
 
 
+pipeline_run_depth = 0  # how many run_pipeline_config calls are in progress in this process
+
+
 def run_pipeline_config(
     config, resolved_node_path, override_fields={}
 ):  # the second half of run_pipeline, extracted so that it is easier to use in isolation as an api.
@@ -148,6 +153,31 @@ def run_pipeline_config(
         print(f"Skipping pipeline: resolved_node_path")  # Use name if available
         return  # Skip this pipeline if function cannot be loaded
 
+    # request latency/TTFT/throughput metrics are written to <output_dir>/request_metrics.json while the pipeline runs (see request_metrics.py)
+    # Only the outermost run does this: a pipeline that runs other pipelines through here would otherwise reset the metrics it has collected so far and start a second writer. The nested pipelines' requests are recorded in the outer run's summary.
+    global pipeline_run_depth
+    metrics_writer = None
+    if pipeline_run_depth == 0 and isinstance(flattened_config.get("output_dir"), str):
+        metrics_writer = start_metrics_summary(flattened_config["output_dir"])
+    pipeline_run_depth += 1
+    try:
+        run_pipeline_function(function, flattened_config, resolved_node_path)
+    finally:
+        pipeline_run_depth -= 1
+        if metrics_writer is not None:
+            metrics_writer.stop()
+
+    print(f"Completed pipeline: {resolved_node_path}")
+
+
+async def run_async_pipeline(function, flattened_config):
+    try:
+        return await function(**flattened_config)
+    finally:
+        await close_clients()  # the pooled connections belong to this event loop, which asyncio.run closes next
+
+
+def run_pipeline_function(function, flattened_config, resolved_node_path):
     if asyncio.iscoroutinefunction(function):
         print(f"Running async pipeline: {resolved_node_path}")
 
@@ -155,7 +185,7 @@ def run_pipeline_config(
         # print(flattened_config)
 
         try:
-            asyncio.run(function(**flattened_config))
+            asyncio.run(run_async_pipeline(function, flattened_config))
         except Exception as e:
             print(f"Error running async pipeline {resolved_node_path}: {e}")
             traceback.print_exc()
@@ -170,8 +200,6 @@ def run_pipeline_config(
             # Optionally re-raise or handle error reporting
             raise
 
-    print(f"Completed pipeline: {resolved_node_path}")
-
 
 def main():
     parser = argparse.ArgumentParser(description="Run Augmentoolkit pipelines.")